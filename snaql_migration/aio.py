@@ -0,0 +1,268 @@
+# -*- coding: utf-8 -*-
+"""
+    snaql-migration asyncio support (Python 3.5+)
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Applies migrations over a connection of the application pool (asyncpg or aiomysql).
+
+    :copyright: (c) 2016 by Egor Komissarov.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import re
+import asyncio
+
+from functools import partial
+
+import click
+
+from snaql_migration.snaql_migration import Migrator, DBWrapper, EventLog, _parse_config, _generate_config
+
+PARAMETER_RE = re.compile(r'%\((\w+)\)s|%s|%%')
+
+
+class AsyncMigrator(object):
+    """
+    Asyncio front of Migrator. Migrations are executed by Migrator in a worker thread over the borrowed connection,
+    every query is awaited on the event loop, so the loop is never blocked::
+
+        async with pool.acquire() as connection:
+            await AsyncMigrator.from_file('migrations.yml', connection).apply('all')
+
+    Connection is neither closed nor released, parallel applying (jobs) is not supported
+    """
+
+    def __init__(self, config, connection, cache_dir=None, events=None):
+        self.config = config  # db_uri is not used
+        self.connection = connection
+        self.cache_dir = cache_dir
+        self.events = events or EventLog()
+        self._migrator = None
+        self._lock = None
+
+    @classmethod
+    def from_file(cls, config_file, connection, **kwargs):
+        with open(config_file, 'rb') as f:
+            return cls(_parse_config(f), connection, **kwargs)
+
+    @classmethod
+    def from_path(cls, migrations, app, connection, **kwargs):
+        return cls(_generate_config(None, migrations, app), connection, **kwargs)
+
+    async def plan(self, name='all', direction='apply', state=None):
+        return await self._run('plan', name, direction, state)
+
+    async def apply(self, name='all', verbose=False, atomic=False, batch_size=None):
+        return await self._run('apply', name, verbose, atomic=atomic, batch_size=batch_size)
+
+    async def revert(self, name, verbose=False, atomic=False, batch_size=None):
+        return await self._run('revert', name, verbose, atomic=atomic, batch_size=batch_size)
+
+    async def _run(self, method, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:  # one connection, one migration run at a time
+            return await loop.run_in_executor(None, partial(self._call, loop, method, args, kwargs))
+
+    def _call(self, loop, method, args, kwargs):
+        if self._migrator is None:
+            scheme, connection = _bridge(self.connection, loop)
+            db = DBWrapper(scheme + '://', events=self.events, connection=connection)
+            self._migrator = Migrator(self.config, db=db, cache_dir=self.cache_dir, events=self.events)
+
+        return getattr(self._migrator, method)(*args, **kwargs)
+
+
+def _bridge(connection, loop):
+    """
+    Returns (scheme, DB-API like connection) wrapping asyncpg or aiomysql connection
+    """
+    module = type(connection).__module__
+
+    if module.startswith('asyncpg'):
+        return 'postgres', AsyncpgConnection(connection, loop)
+    elif module.startswith('aiomysql'):
+        return 'mysql', AiomysqlConnection(connection, loop)
+
+    raise click.ClickException('Unsupported connection type "{0}"'.format(type(connection).__name__))
+
+
+def _wait(loop, awaitable):
+    """
+    Awaits on the loop from the worker thread
+    """
+    async def wait():
+        return await awaitable
+
+    return asyncio.run_coroutine_threadsafe(wait(), loop).result()
+
+
+def _numbered(sql, args):
+    """
+    Converts format (%s) and pyformat (%(name)s) parameters of sql to asyncpg ($1) ones
+    """
+    values, names = [], {}
+
+    def replace(match):
+        if match.group(0) == '%%':
+            return '%'
+
+        if match.group(1) is None:
+            values.append(args[len(values)])
+            return '${0}'.format(len(values))
+
+        if match.group(1) not in names:
+            values.append(args[match.group(1)])
+            names[match.group(1)] = len(values)
+
+        return '${0}'.format(names[match.group(1)])
+
+    return PARAMETER_RE.sub(replace, sql), values
+
+
+class AsyncpgConnection(object):
+    """
+    DB-API like (psycopg2 like) connection over asyncpg one, used by DBWrapper from the worker thread.
+    Transactions are started implicitly, unless autocommit is set
+    """
+
+    def __init__(self, connection, loop):
+        self.connection = connection
+        self.autocommit = False
+        self._loop = loop
+        self._transaction = False
+
+    def cursor(self):
+        return AsyncpgCursor(self)
+
+    def commit(self):
+        if self._transaction:
+            self._transaction = False
+            _wait(self._loop, self.connection.execute('COMMIT'))
+
+    def rollback(self):
+        if self._transaction:
+            self._transaction = False
+            _wait(self._loop, self.connection.execute('ROLLBACK'))
+
+    def close(self):
+        pass  # the connection belongs to the application
+
+    def execute(self, sql, args=None):
+        """
+        Returns (rows, description, rowcount) of the query
+        """
+        return _wait(self._loop, self._execute(sql, args))
+
+    async def _execute(self, sql, args):
+        if not self.autocommit and not self._transaction:
+            await self.connection.execute('BEGIN')
+            self._transaction = True
+
+        if args is None and ';' in sql.strip().rstrip(';'):
+            await self.connection.execute(sql)  # multiple statements could not be prepared
+            return [], None, -1
+
+        sql, args = _numbered(sql, args) if args is not None else (sql, [])
+
+        statement = await self.connection.prepare(sql)
+        rows = await statement.fetch(*args)
+        description = [(attribute.name, None, None, None, None, None, None)
+                       for attribute in statement.get_attributes()]
+        status = statement.get_statusmsg().split()  # 'UPDATE 10'
+
+        return ([tuple(row) for row in rows], description or None,
+                int(status[-1]) if status and status[-1].isdigit() else -1)
+
+
+class AsyncpgCursor(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = None
+        self.rowcount = -1
+        self._rows = []
+
+    def execute(self, sql, args=None):
+        self._rows, self.description, self.rowcount = self.connection.execute(sql, args)
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+    def nextset(self):
+        return None
+
+    def close(self):
+        self._rows = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class AiomysqlConnection(object):
+    """
+    DB-API like (pymysql like) connection over aiomysql one, used by DBWrapper from the worker thread
+    """
+
+    def __init__(self, connection, loop):
+        self.connection = connection
+        self._loop = loop
+
+    def cursor(self):
+        return AiomysqlCursor(self._loop, _wait(self._loop, self.connection.cursor()))
+
+    def commit(self):
+        _wait(self._loop, self.connection.commit())
+
+    def rollback(self):
+        _wait(self._loop, self.connection.rollback())
+
+    def autocommit(self, enabled):
+        _wait(self._loop, self.connection.autocommit(enabled))
+
+    def close(self):
+        pass  # the connection belongs to the application
+
+
+class AiomysqlCursor(object):
+    def __init__(self, loop, cursor):
+        self.cursor = cursor
+        self._loop = loop
+
+    @property
+    def description(self):
+        return self.cursor.description
+
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
+
+    def execute(self, sql, args=None):
+        return _wait(self._loop, self.cursor.execute(sql, args))
+
+    def fetchone(self):
+        return _wait(self._loop, self.cursor.fetchone())
+
+    def fetchall(self):
+        return _wait(self._loop, self.cursor.fetchall())
+
+    def nextset(self):
+        return _wait(self._loop, self.cursor.nextset())
+
+    def close(self):
+        pass  # could be called by DBWrapper.__del__ when the loop is already gone, results are always read
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -11,267 +11,2647 @@
 
 import warnings
 
+import io
 import os
+import re
+import csv
+import json
+import time
+import random
+import hashlib
+
+import threading
+import multiprocessing
+
+from contextlib import contextmanager
+from functools import partial
+from datetime import datetime
+from timeit import default_timer
+
+try:
+    from urllib.parse import urlparse, unquote, parse_qs
+except ImportError:
+    from urlparse import urlparse, parse_qs
+    from urllib2 import unquote as unquote
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import click
+
+# yaml, snaql (with jinja2) and database drivers are imported on demand, keeping startup of the commands fast
+
+__version__ = '0.1.2'
+
+MANIFEST_FILE = '.snaql-manifest.json'
+CHECK_CACHE_FILE = 'check.json'  # results of check command, in the cache directory
+MANIFEST_VERSION = 1
+
+BASELINE_MARKER = '-- snaql-block: '
+
+LOCK_ID = 8317692701578193255  # key of PostgreSQL advisory lock held while migrating (b'snaqlmig' as bigint)
+
+# execution settings, could be set globally or per app in config file, or per migration (and block)
+# with {# snaql: setting=value ... #} ({# snaql block_name: setting=value ... #}) comments of migration files
+SETTINGS = ('lock_timeout', 'statement_timeout', 'lock_wait_timeout', 'retries', 'retry_delay', 'retry_max_delay')
+
+DIRECTIVE_RE = re.compile(r'\{#\s*snaql(?:\s+([^\s:#]+))?\s*:(.*?)#\}', re.DOTALL)
+
+# preflight classification of DDL statements (upper-cased, whitespace collapsed) as (pattern, kind, note),
+# the first matching rule wins. DML statements are classified by EXPLAIN, falling back to these rules
+PREFLIGHT_RULES = [
+    (r'^ALTER TABLE .* ADD (COLUMN )?.*\b(SMALLSERIAL|BIGSERIAL|SERIAL|AUTO_INCREMENT)\b', 'rewrite',
+     'column is filled for every row'),
+    (r'^ALTER TABLE .* ADD (COLUMN )?.*\bGENERATED ALWAYS AS .*\bSTORED\b', 'rewrite',
+     'column is filled for every row'),
+    (r'^ALTER TABLE .* ADD (COLUMN )?.*\bDEFAULT .*\b(RANDOM|CLOCK_TIMESTAMP|GEN_RANDOM_UUID|UUID_GENERATE_\w+|'
+     r'NEXTVAL|UUID)\s*\(', 'rewrite', 'volatile default'),
+    (r'^ALTER TABLE .* ALTER (COLUMN )?\S+ (SET DATA )?TYPE\b', 'rewrite', 'column type change'),
+    (r'^ALTER TABLE .* (MODIFY|CHANGE) (COLUMN )?', 'rewrite', 'column redefinition'),
+    (r'^(VACUUM FULL|CLUSTER|OPTIMIZE TABLE)\b', 'rewrite', ''),
+    (r'^ALTER TABLE .* SET NOT NULL\b', 'full scan', 'NOT NULL validation'),
+    (r'^ALTER TABLE .* ADD (CONSTRAINT \S+ )?(CHECK|FOREIGN KEY)\b(?!.*\bNOT VALID\b)', 'full scan',
+     'constraint validation'),
+    (r'^ALTER TABLE .* VALIDATE CONSTRAINT\b', 'full scan', 'constraint validation'),
+    (r'^ALTER TABLE .* ADD (CONSTRAINT \S+ )?(PRIMARY KEY|UNIQUE|INDEX|KEY|FULLTEXT)\b', 'full scan', 'index build'),
+    (r'^CREATE (UNIQUE )?INDEX CONCURRENTLY\b', 'full scan', 'online index build'),
+    (r'^CREATE (UNIQUE )?INDEX\b', 'full scan', 'index build, writes are blocked'),
+    (r'^(UPDATE|DELETE)\b(?!.*\bWHERE\b)', 'full scan', 'no WHERE clause'),
+    (r'^(COPY|LOAD DATA)\b', 'bulk load', ''),
+    (r'^(CREATE|DROP|ALTER|COMMENT|GRANT|REVOKE|TRUNCATE|RENAME|SET|SELECT)\b', 'metadata-only', '')
+]
+
+# preflight rules of ADD COLUMN on servers rewriting tables for added columns (see _rewrites_added_columns), checked
+# before PREFLIGHT_RULES: PostgreSQL before 11 writes a non-NULL default to every row, MySQL before 8.0.12
+# (MariaDB before 10.3.2) rebuilds the table for any added column
+ADDED_COLUMN = r'^ALTER TABLE .* ADD (COLUMN )?(?!(CONSTRAINT|PRIMARY KEY|UNIQUE|INDEX|KEY|FULLTEXT|SPATIAL|CHECK|' \
+               r'FOREIGN KEY)\b)\S+ '
+ADDED_COLUMN_RULES = {
+    'default': (ADDED_COLUMN + r'.*\bDEFAULT (?!NULL\b)', 'rewrite', 'default is written to every row'),
+    'any': (ADDED_COLUMN, 'rewrite', 'table is rebuilt')
+}
+
+# preflight kinds, from the most expensive
+PREFLIGHT_KINDS = ('rewrite', 'full scan', 'bulk load', 'unknown', 'index scan', 'metadata-only')
+
+# table touched by the statement (upper-cased, whitespace collapsed)
+TABLE_RE = re.compile(r'^(?:ALTER TABLE(?: IF EXISTS)?(?: ONLY)?|UPDATE(?: ONLY)?|DELETE FROM(?: ONLY)?|INSERT INTO|'
+                      r'REPLACE INTO|TRUNCATE(?: TABLE)?|DROP TABLE(?: IF EXISTS)?|VACUUM FULL|CLUSTER|'
+                      r'OPTIMIZE TABLE|COPY|LOAD DATA .*? INTO TABLE|'
+                      r'CREATE (?:UNIQUE )?INDEX(?: CONCURRENTLY)?(?: IF NOT EXISTS)?(?: (?!ON )\S+)? ON(?: ONLY)?) '
+                      r'([\w."`]+)')
+
+# snaql_migrations columns added after the first version, as (name, definition)
+MIGRATIONS_COLUMNS = [
+    ('duration', 'FLOAT'),  # seconds spent on applying
+    ('checksum', 'VARCHAR(40)')  # digest of .apply.sql file as it was applied, see redo command
+]
+
+
+@click.group()
+@click.option('--db-uri', default=None, help='Database URI, ignored if --config is set')
+@click.option('--migrations', default=None, help='Migrations location, ignored if --config is set',
+              type=click.Path(exists=True))
+@click.option('--app', default=None, help='App name, ignored if --config is set')
+@click.option('--config', default=None,
+              help='Configuration file (migrations.yml by default), overlaps usage of the --db-uri/--migrations/--app '
+                   'group', type=click.File('rb'))
+@click.option('--cache-dir', default=None, help='Directory for the compiled migrations cache, disabled if not set')
+@click.option('--event-log', default=None, type=click.Path(dir_okay=False),
+              help='File to append timing events to, as JSON lines')
+@click.pass_context
+def snaql_migration(ctx, db_uri, migrations, app, config, cache_dir, event_log):
+    """
+    Lightweight SQL Schema migration tool based on Snaql queries
+    """
+
+    if config:
+        migrations_config = _parse_config(config)
+    elif migrations and app:  # --db-uri is checked only by commands actually using the database
+        migrations_config = _generate_config(db_uri, migrations, app)
+    elif os.path.isfile('migrations.yml'):
+        with open('migrations.yml', 'rb') as config:
+            migrations_config = _parse_config(config)
+    else:
+        raise click.ClickException('If --config is not set, then --db-uri, --migrations and --app must be provided')
+
+    ctx.obj = Migrator(migrations_config, cache_dir=cache_dir)
+
+    if event_log:
+        ctx.obj.events.subscribe(JsonLinesWriter(event_log))
+
+
+@click.command()
+@click.option('--timings', is_flag=True, default=False, help='Show durations of applied migrations')
+@click.option('--top', default=10, type=click.IntRange(0), help='Number of the slowest migrations shown with --timings')
+@click.option('--shard-jobs', default=None, type=click.IntRange(1),
+              help='Number of shards queried in parallel (default is 4 or shard_jobs from config)')
+@click.pass_context
+def show(ctx, timings, top, shard_jobs):
+    """
+    Show migrations list
+    """
+
+    if ctx.obj.config.get('shards'):
+        if timings:
+            raise click.ClickException('--timings could not be used with shards')
+
+        total = sum(len(app['migrations']) for app in ctx.obj.config['apps'].values())
+
+        def count(migrator):
+            state = migrator.db.load_state()
+            return sum(state.is_applied(app_name, migration) for app_name, app in migrator.config['apps'].items()
+                       for migration in app['migrations'])
+
+        results = _run_shards(ctx.obj, count, shard_jobs, keep_going=True)
+        _echo_shards(results, ('Applied', 'Pending'), lambda applied: (applied, total - applied))
+        return
+
+    db = ctx.obj.db
+    state = db.load_state()
+    durations = db.load_durations() if timings else {}
+
+    for app_name, app in ctx.obj.config['apps'].items():
+        click.echo(click.style(app_name, fg='green', bold=True))
+        for migration in app['migrations']:
+            applied = state.is_applied(app_name, migration)
+            if applied and durations.get((app_name, migration)) is not None:
+                mark = '(applied in {0:.3f}s)'.format(durations[(app_name, migration)])
+            else:
+                mark = '(applied)' if applied else ''
+            click.echo('  {0} {1}'.format(migration, click.style(mark, bold=True)))
+
+    if timings and top:
+        slowest = sorted(((duration, key) for key, duration in durations.items() if duration is not None),
+                         reverse=True)[:top]
+
+        click.echo(click.style('Slowest migrations', fg='green', bold=True))
+        for duration, (app_name, migration) in slowest:
+            click.echo('  {0:>10.3f}s {1}/{2}'.format(duration, app_name, migration))
+
+
+@click.command(name='list')
+@click.pass_context
+def list_migrations(ctx):
+    """
+    Show migrations list without connecting to the database
+    """
+
+    for app_name in _apps_order(ctx.obj.config['apps']):
+        click.echo(click.style(app_name, fg='green', bold=True))
+        for migration in ctx.obj.config['apps'][app_name]['migrations']:
+            click.echo('  ' + migration)
+
+
+@click.command()
+@click.argument('database')
+@click.option('--replace', is_flag=True, default=False, help='Drop the database first, if it exists')
+@click.option('--maintenance-db', default='postgres', help='Database to connect to for creating databases')
+@click.option('--verbose', is_flag=True, default=False, help='Dump SQL queries')
+@click.pass_context
+def provision(ctx, database, replace, maintenance_db, verbose):
+    """
+    Create fully migrated database from a cached template (PostgreSQL only)
+    """
+
+    db_uri = ctx.obj.config.get('db_uri')
+    if not db_uri or urlparse(db_uri).scheme != 'postgres':
+        raise click.ClickException('provision is supported by PostgreSQL only')
+
+    # templates are named after the configured database and the digest of all migrations
+    prefix = _template_prefix(unquote(urlparse(db_uri).path).lstrip('/'))
+    template = prefix + _migrations_digest(ctx.obj.config['apps'])[:16]
+
+    admin = _connect(_replace_database(db_uri, maintenance_db), prepare=False)
+    admin.set_autocommit(True)
+
+    databases = set(row[0] for row in admin.query_all('SELECT datname FROM pg_database'))
+
+    if template not in databases:
+        # built under temporary name, so concurrent provisioning never sees half-migrated template
+        build = '{0}_build{1}'.format(template, os.getpid())
+        click.echo(click.style('Building template {0}...'.format(click.style(template, bold=True)), fg='blue'))
+
+        try:
+            admin.query('CREATE DATABASE {0}'.format(_quote_identifier(build)))
+            db = _connect(_replace_database(db_uri, build), events=ctx.obj.events)
+            try:
+                ctx.obj._apply_all(db, verbose)
+                db.save_head(_head_digest(ctx.obj.config['apps']))
+            finally:
+                db.close()
+
+            admin.query('ALTER DATABASE {0} RENAME TO {1}'.format(_quote_identifier(build),
+                                                                  _quote_identifier(template)))
+        except Exception as e:
+            admin.query('DROP DATABASE IF EXISTS {0}'.format(_quote_identifier(build)))
+            if template not in set(row[0] for row in admin.query_all('SELECT datname FROM pg_database')):
+                raise click.ClickException('template building failed\n{0}'.format(e))
+            # otherwise it was built concurrently
+
+    for stale in _stale_templates(databases, prefix, template):
+        click.echo('Dropping stale template {0}...'.format(stale))
+        try:
+            admin.query('DROP DATABASE IF EXISTS {0}'.format(_quote_identifier(stale)))
+        except Exception as e:  # it's still being cloned from, next provisioning will drop it
+            click.echo(click.style('  Warning: {0}'.format(str(e).strip()), fg='yellow'))
+
+    if replace:
+        admin.query('DROP DATABASE IF EXISTS {0}'.format(_quote_identifier(database)))
+
+    click.echo(click.style('Creating {0} from template {1}...'.format(click.style(database, bold=True), template),
+                           fg='blue'))
+    try:
+        admin.query('CREATE DATABASE {0} TEMPLATE {1}'.format(_quote_identifier(database),
+                                                              _quote_identifier(template)))
+    except Exception as e:
+        raise click.ClickException('database creation failed\n{0}'.format(e))
+
+    click.echo(click.style('  OK.', fg='green'))
+
+
+def _template_prefix(database):
+    """
+    Returns prefix of template names of the database. Long names are hashed, so templates
+    (and their build databases) fit 63 bytes long identifiers of PostgreSQL
+    """
+    if len(database.encode('utf-8')) > 28:
+        database = hashlib.sha1(database.encode('utf-8')).hexdigest()[:16]
+
+    return database + '_tpl_'
+
+
+def _stale_templates(databases, prefix, template):
+    """
+    Returns templates of the prefix, except the current one (build databases are never matched)
+    """
+    pattern = re.compile('^{0}[0-9a-f]{{16}}$'.format(re.escape(prefix)))
+    return [database for database in sorted(databases) if pattern.match(database) and database != template]
+
+
+@click.command()
+@click.argument('name')
+@click.pass_context
+def squash(ctx, name):
+    """
+    Squash migrations up to the given one into a baseline, used to bootstrap fresh databases
+    """
+
+    if '/' not in name:
+        raise click.ClickException('NAME format is <app>/<migration>')
+
+    app_name, migrations = _select_migrations(ctx.obj.config['apps'], name, 'apply')[0]
+
+    try:
+        _write_baseline(ctx.obj.loader(app_name), migrations)
+    except Exception as e:
+        raise click.ClickException('squashing failed\n{0}'.format(e))
+
+    click.echo('{0}: {1} migration(s) squashed'.format(click.style(app_name, bold=True), len(migrations)))
+
+
+@click.command()
+@click.option('--check', is_flag=True, default=False, help='Only report migrations changed since indexing')
+@click.pass_context
+def index(ctx, check):
+    """
+    Write migrations manifests, sparing directories scan on startup
+    """
+
+    drifted = False
+
+    for app_name in _apps_order(ctx.obj.config['apps']):
+        path = ctx.obj.config['apps'][app_name]['path']
+
+        if not check:
+            migrations = _write_manifest(path)
+            click.echo('{0}: {1} migration(s) indexed'.format(click.style(app_name, bold=True), len(migrations)))
+            continue
+
+        manifest = _read_manifest(path, check_fresh=False)
+        if manifest is None:
+            click.echo(click.style('{0}: not indexed'.format(app_name), fg='yellow'))
+            drifted = True
+            continue
+
+        indexed = dict((entry['name'], entry) for entry in manifest['migrations'])
+        migrations = _collect_migrations(path)
+
+        for migration in migrations:
+            if migration not in indexed:
+                click.echo(click.style('{0}/{1}: not indexed'.format(app_name, migration), fg='yellow'))
+                drifted = True
+                continue
+
+            for direction in ('apply', 'revert'):
+                if _file_digest(os.path.join(path, '{0}.{1}.sql'.format(migration, direction))) \
+                        != indexed[migration][direction]:
+                    click.echo(click.style('{0}/{1}.{2}.sql: drift'.format(app_name, migration, direction), fg='red'))
+                    drifted = True
+
+        for migration in sorted(set(indexed) - set(migrations)):
+            click.echo(click.style('{0}/{1}: removed'.format(app_name, migration), fg='yellow'))
+            drifted = True
+
+    if drifted:
+        raise click.ClickException('manifests are out of date, run "index" to update them')
+
+
+@click.command()
+@click.option('--jobs', '-j', default=None, type=click.IntRange(1),
+              help='Number of processes rendering migrations (default is the number of CPUs)')
+@click.option('--parse', is_flag=True, default=False,
+              help='Also parse rendered statements with sqlglot (in the dialect of db_uri, if set)')
+@click.pass_context
+def check(ctx, jobs, parse):
+    """
+    Validate all migration files without connecting to the database
+    """
+
+    # migrations lacking .apply.sql or .revert.sql file are reported on startup
+
+    apps = ctx.obj.config['apps']
+    dialect = _check_dialect(ctx.obj.config.get('db_uri'), parse)
+    cache_file = os.path.join(ctx.obj.cache.cache_dir, CHECK_CACHE_FILE) if ctx.obj.cache else None
+
+    cached = _read_check_cache(cache_file)
+    files, results, tasks, errors = [], {}, [], []
+
+    for app_name in _apps_order(apps):
+        path = apps[app_name]['path']
+
+        for migration in apps[app_name]['migrations']:
+            for direction in ('apply', 'revert'):
+                file_name = '{0}.{1}.sql'.format(migration, direction)
+                with open(os.path.join(path, file_name), 'rb') as f:
+                    contents = f.read()
+
+                key = '{0}:{1}'.format(hashlib.sha1(contents).hexdigest(), dialect or '')
+                files.append((app_name, path, file_name, key, _parse_directives(contents.decode('utf-8'))[1]))
+
+                if key in cached:
+                    results[key] = cached[key]
+                elif key not in results:
+                    results[key] = None  # rendered once, even if the same contents are in several files
+                    tasks.append((path, file_name, dialect, key))
+
+    jobs = min(jobs or multiprocessing.cpu_count(), len(tasks))
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results.update(pool.imap_unordered(_check_file, tasks, chunksize=max(1, len(tasks) // (jobs * 4))))
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results.update(_check_file(task) for task in tasks)
+
+    for app_name, path, file_name, key, block_options in files:
+        problems = results[key]['errors'] or _check_directives(path, block_options, results[key]['blocks'])
+        errors.extend('{0}/{1}: {2}'.format(app_name, file_name, problem) for problem in problems)
+
+    if cache_file is not None:
+        _write_check_cache(cache_file, results)
+
+    for error in errors:
+        click.echo(click.style(error, fg='red'))
+
+    click.echo('{0} file(s) checked, {1} rendered'.format(len(files), len(tasks)))
+
+    if errors:
+        raise click.ClickException('{0} error(s) found'.format(len(errors)))
+
+    click.echo(click.style('OK.', fg='green'))
+
+
+def _check_dialect(db_uri, parse):
+    """
+    Returns sqlglot dialect statements are parsed with by check --parse ('' is the generic one), None if not parsing
+    """
+    if not parse:
+        return None
+
+    try:
+        import sqlglot  # noqa: F401
+    except ImportError:
+        raise click.ClickException('Package sqlglot must be installed for --parse use')
+
+    return {'postgres': 'postgres', 'mysql': 'mysql', 'sqlite': 'sqlite'}.get(urlparse(db_uri or '').scheme, '')
+
+
+def _check_file(task):
+    """
+    Renders the migration file in a worker process, returns (cache key, {blocks: [block_name, ...], errors: [...]}).
+    Loaders are kept for the process lifetime, so every directory has a single Snaql factory per process
+    """
+    path, file_name, dialect, key = task
+    migration, direction = file_name.rsplit('.', 2)[:2]
+
+    if path not in _check_loaders:
+        _check_loaders[path] = MigrationLoader(path)
+
+    try:
+        blocks = _check_loaders[path].load(migration, direction)
+    except RuntimeError as e:  # RecursionError of python 3
+        return key, {'blocks': [], 'errors': ['circular depends_on between blocks ({0})'.format(e)]}
+    except Exception as e:
+        line = ' (line {0})'.format(e.lineno) if getattr(e, 'lineno', None) else ''
+        return key, {'blocks': [], 'errors': ['{0}: {1}{2}'.format(type(e).__name__, e, line)]}
+
+    errors = []
+    if dialect is not None:
+        import sqlglot
+
+        for block_name, sql in blocks:
+            # parameters of chunked blocks are replaced with literals, data blocks are not parsed
+            try:
+                sqlglot.parse(re.sub(r'%\((\w+)\)s|%s', "'0'", sql).replace('%%', '%'), read=dialect or None)
+            except sqlglot.errors.ParseError as e:
+                error = e.errors[0] if e.errors else {}
+                errors.append('block "{0}": {1} (line {2}, col {3})'.format(
+                    block_name, error.get('description', e), error.get('line'), error.get('col')))
+
+    return key, {'blocks': [block_name for block_name, sql in blocks], 'errors': errors}
+
+
+_check_loaders = {}  # {path: MigrationLoader} of the check worker process
+
+
+def _check_directives(migrations_dir, block_options, block_names):
+    """
+    Returns problems of {# snaql block_name: ... #} directives of the rendered file: unknown blocks,
+    chunked blocks lacking settings, absent data files
+    """
+    problems = []
+
+    for block_name, options in sorted(block_options.items()):
+        if block_name not in block_names:
+            problems.append('directive for unknown block "{0}"'.format(block_name))
+        if 'chunk_key' in options and not options.get('chunk_table'):
+            problems.append('chunked block "{0}" lacks chunk_table'.format(block_name))
+        if 'data' in options and not os.path.isfile(os.path.join(migrations_dir, options['data'])):
+            problems.append('data file {0} of block "{1}" is absent'.format(options['data'], block_name))
+
+    return problems
+
+
+def _read_check_cache(cache_file):
+    try:
+        with open(cache_file, 'r') as f:
+            cache = json.load(f)
+    except (TypeError, IOError, OSError, ValueError):  # no cache file or cache is disabled
+        return {}
+
+    return cache.get('results', {}) if cache.get('version') == __version__ else {}
+
+
+def _write_check_cache(cache_file, results):
+    """
+    Stores check results (of the current files only, so the cache doesn't grow), rendering depends on
+    files contents only, so they are keyed by content digest
+    """
+    tmp_path = '{0}.{1}.tmp'.format(cache_file, os.getpid())
+
+    with open(tmp_path, 'w') as f:
+        json.dump({'version': __version__, 'results': results}, f)
+    os.rename(tmp_path, cache_file)
+
+
+@click.command()
+@click.argument('name')
+@click.option('--revert', is_flag=True, default=False, help='Plan reverting instead of applying')
+@click.option('--state', default=None, type=click.File('rb'),
+              help='YAML/JSON file with applied migrations ({app: [migration, ...]}), '
+                   'database is used if not set')
+@click.option('--emit-sql', default=None, type=click.File('w'),
+              help='Write SQL script of the plan (including bookkeeping) to the file ("-" is stdout) instead')
+@click.pass_context
+def plan(ctx, name, revert, state, emit_sql):
+    """
+    Show migrations to be applied or reverted
+    """
+
+    direction = 'revert' if revert else 'apply'
+    state = _read_state(state) if state is not None else None
+
+    if emit_sql is not None:
+        ctx.obj.emit_sql(emit_sql, name, direction, state)
+        return
+
+    for app_name, migration in ctx.obj.plan(name, direction, state):
+        click.echo('{0} {1}/{2}'.format(direction, app_name, migration))
+
+
+@click.command()
+@click.argument('name', default='all')
+@click.option('--max-cost', default=None, type=float,
+              help='Fail if estimated cost of any block is above it (default is preflight_max_cost from config)')
+@click.pass_context
+def preflight(ctx, name, max_cost):
+    """
+    Estimate costs of blocks to be applied
+    """
+
+    max_cost = max_cost if max_cost is not None else ctx.obj.config.get('preflight_max_cost')
+    blocks = ctx.obj.preflight(name)
+
+    if not blocks:
+        click.echo(click.style('Nothing to apply.', fg='green'))
+        return
+
+    expensive = [block for block in blocks if max_cost is not None and block['cost'] > max_cost]
+
+    _echo_table(('Migration', 'Block', 'Kind', 'Table', 'Rows', 'Size', 'Cost', 'Note'), [
+        ('{0}/{1}'.format(block['app'], block['migration']), block['block'],
+         click.style(block['kind'], fg='red' if block in expensive else None,
+                     bold=block['kind'] in ('rewrite', 'full scan')),
+         block['table'] or '', '' if block['rows'] is None else block['rows'], _format_size(block['size']),
+         '{0:.0f}'.format(block['cost']), block['note']) for block in blocks])
+
+    click.echo('Total estimated cost: {0:.0f}'.format(sum(block['cost'] for block in blocks)))
+
+    if expensive:
+        raise click.ClickException('{0} block(s) above the cost of {1:g}'.format(len(expensive), max_cost))
+
+
+def _preflight_statement(db, statement, stats, args=None, added_columns=None):
+    """
+    Returns (kind, table, cost, note) of the statement, see PREFLIGHT_RULES. stats is {table: (rows, size, indexes)}
+    of the existing tables, added_columns is whether the server rewrites tables for them ('default', 'any' or None,
+    see ADDED_COLUMN_RULES), cost is in PostgreSQL planner units (about a page read)
+    """
+    normalized = ' '.join(re.sub(r'--[^\n]*', '', statement).split()).upper()
+    match = TABLE_RE.match(normalized)
+    table = match.group(1).strip('"`').split('.')[-1].lower() if match else None
+
+    rows, size, indexes = stats.get(table, (0, 0, 0))
+    scan_cost = (size or 0) / 8192.0 + 0.01 * (rows or 0)
+
+    if re.match(r'^(WITH|UPDATE|DELETE|INSERT|REPLACE|MERGE)\b', normalized) and \
+            not re.match(r'^INSERT INTO \S+( \(.*?\))? VALUES\b', normalized):
+        try:
+            full_scan, cost = db.explain(statement, args)
+        except Exception as e:
+            note = 'EXPLAIN failed: {0}'.format(str(e).strip().split('\n')[0])
+        else:
+            if cost is None:
+                cost = scan_cost if full_scan else 0.0
+            return ('full scan' if full_scan else 'index scan'), table, cost, ''
+    else:
+        note = ''
+
+    rules = ([ADDED_COLUMN_RULES[added_columns]] if added_columns else []) + PREFLIGHT_RULES
+    for pattern, kind, rule_note in rules:
+        if re.match(pattern, normalized):
+            cost = {'rewrite': scan_cost * (1 + (indexes or 0)), 'full scan': scan_cost}.get(kind, 0.0)
+            return kind, table, cost, note or rule_note
+
+    return 'unknown', table, 0.0, note
+
+
+def _rewrites_added_columns(scheme, version):
+    """
+    Returns whether added columns rewrite tables on the server of the version (server_version_num of PostgreSQL,
+    VERSION() of MySQL): 'default' (columns with non-NULL defaults), 'any' or None, see ADDED_COLUMN_RULES
+    """
+    if scheme == 'postgres':
+        return 'default' if int(version) < 110000 else None
+
+    if scheme == 'mysql':
+        mariadb = re.search(r'(\d+)\.(\d+)\.(\d+)-mariadb', version.lower())
+        numbers = tuple(int(number) for number in (mariadb or re.search(r'(\d+)\.(\d+)\.(\d+)', version)).groups())
+        return 'any' if numbers < ((10, 3, 2) if mariadb else (8, 0, 12)) else None
+
+    return None  # SQLite never rewrites tables for added columns
+
+
+def _format_size(size):
+    if size is None:
+        return ''
+
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return '{0:.0f} {1}'.format(size, unit) if unit == 'B' else '{0:.1f} {1}'.format(size, unit)
+        size /= 1024.0
+
+    return '{0:.1f} TB'.format(size)
+
+
+@click.command()
+@click.argument('name')
+@click.option('--verbose', is_flag=True, default=False, help='Dump SQL queries')
+@click.option('--jobs', '-j', default=1, type=click.IntRange(1),
+              help='Number of apps migrated in parallel by "apply all"')
+@click.option('--atomic', is_flag=True, default=False, help='Apply all migrations in a single transaction')
+@click.option('--batch-size', default=None, type=click.IntRange(1),
+              help='Number of migration blocks sent to the database at once (default is 1 or batch_size from config)')
+@click.option('--shard-jobs', default=None, type=click.IntRange(1),
+              help='Number of shards migrated in parallel (default is 4 or shard_jobs from config)')
+@click.option('--keep-going', is_flag=True, default=False, help='Keep migrating other shards after a shard failure')
+@click.pass_context
+def apply(ctx, name, verbose, jobs, atomic, batch_size, shard_jobs, keep_going):
+    """
+    Apply migration
+    """
+
+    if ctx.obj.config.get('shards'):
+        results = _run_shards(ctx.obj, lambda migrator: migrator.apply(name, verbose, jobs=jobs, atomic=atomic,
+                                                                       batch_size=batch_size),
+                              shard_jobs, keep_going)
+        _echo_shards(results, ('Applied',), lambda applied: (len(applied),))
+        return
+
+    ctx.obj.apply(name, verbose, jobs=jobs, atomic=atomic, batch_size=batch_size)
+
+
+def _run_migrations(db, loader, app_name, migrations, direction, verbose, indent='', stop=None, atomic=False,
+                    batch_size=1):
+    """
+    Applies (direction is 'apply') or reverts (direction is 'revert') given migrations of the app in order,
+    skipping already applied/not applied ones. db.state must be loaded. If stop event is set,
+    remaining migrations are not started. Up to batch_size blocks are sent to the database at once.
+
+    Every migration is committed and recorded separately, unless atomic is set: then nothing is committed
+    and caller is responsible for recording of returned migrations in the same transaction.
+    Migrations failed on lock timeout are rolled back and retried (if retries setting is set and not atomic).
+
+    If none of the app migrations are applied yet, squashed ones are applied at once with the app baseline.
+    Returns [(migration, duration), ...] of executed migrations, duration is None for squashed ones
+    """
+
+    done = []
+
+    if direction == 'apply' and loader.baseline in migrations and not db.state.applied(app_name):
+        # fresh database, squashed migrations are replaced with their baseline
+        squashed = migrations[:migrations.index(loader.baseline) + 1]
+        migrations = migrations[len(squashed):]
+
+        click.echo(indent + click.style('Applying baseline of {0} migration(s) up to {1}...'.format(
+            len(squashed), click.style(loader.baseline, bold=True)), fg='blue'))
+
+        try:
+            with db.events.bind(app=app_name, migration=loader.baseline, direction='baseline'):
+                blocks = loader.load(loader.baseline, 'baseline')
+
+                if verbose:
+                    for block_name, sql in blocks:
+                        click.echo(indent + '    ' + sql)
+
+                _execute_at_once(db, blocks, loader.directives(loader.baseline, 'baseline')[1], batch_size)
+
+                if not atomic:
+                    db.fix_migrations([(app_name, migration, None, loader.checksum(migration))
+                                       for migration in squashed], commit=False)
+                    db.commit()
+
+        except Exception as e:
+            click.echo(indent + click.style('  FAILED.', fg='red'))
+            db.rollback()
+            raise click.ClickException('baseline execution failed\n{0}'.format(e))
+
+        click.echo(indent + click.style('  OK.', fg='green'))
+        done.extend((migration, None) for migration in squashed)
+
+    for migration in migrations:
+        if stop is not None and stop.is_set():
+            raise click.ClickException('migrating of "{0}" is interrupted'.format(app_name))
+
+        if direction == 'apply':
+            click.echo(indent + click.style('Applying {0}...'.format(click.style(migration, bold=True)), fg='blue'))
+        else:
+            click.echo(indent + click.style('Reverting {0}...'.format(click.style(app_name + '/' + migration,
+                                                                                  bold=True)), fg='blue'))
+
+        if db.state.is_applied(app_name, migration) == (direction == 'apply'):
+            click.echo(indent + click.style('  SKIPPED.', fg='green'))
+            continue
+
+        with db.events.bind(app=app_name, migration=migration, direction=direction):
+            attempt = 1
+
+            while True:
+                started = default_timer()
+                settings = loader.settings
+
+                try:
+                    blocks = loader.load(migration, direction)
+
+                    migration_options, block_options = loader.directives(migration, direction)
+                    settings = dict(loader.settings, **migration_options)
+
+                    if migration_options.get('autocommit'):
+                        block_options = dict((block_name, dict(block_options.get(block_name, {}), autocommit=True))
+                                             for block_name, sql in blocks)
+
+                    if not atomic and any('chunk_key' in options or options.get('autocommit')
+                                          for options in block_options.values()):
+                        _run_steps(db, app_name, migration, direction, blocks, settings, block_options, verbose,
+                                   indent, stop)
+                    else:
+                        blocks = _with_timeouts(db.timeout_blocks, blocks, settings, block_options)
+
+                        if verbose:
+                            for block_name, sql in blocks:
+                                click.echo(indent + '    ' + sql)
+
+                        _execute_at_once(db, blocks, block_options, batch_size, atomic=atomic)
+
+                        if not atomic:
+                            db.commit()
+
+                except Exception as e:
+                    db.rollback()
+
+                    retries = int(settings.get('retries', 0))
+                    if not atomic and attempt <= retries and db.is_lock_timeout(e):
+                        # someone holds the lock, waiting for it would block all the following queries
+                        delay = _backoff_delay(settings, attempt)
+                        click.echo(indent + click.style('  LOCK TIMEOUT, retrying in {0:.1f}s '
+                                                        '(attempt {1} of {2})...'.format(delay, attempt + 1,
+                                                                                         retries + 1), fg='yellow'))
+                        db.events.emit('retry', duration=default_timer() - started, status='failed',
+                                       attempt=attempt, delay=delay)
+
+                        time.sleep(delay)
+                        attempt += 1
+                        continue
+
+                    click.echo(indent + click.style('  FAILED.', fg='red'))
+                    db.events.emit('migration', duration=default_timer() - started, status='failed')
+                    raise click.ClickException('migration execution failed\n{0}'.format(e))
+
+                break
+
+            duration = default_timer() - started
+            db.events.emit('migration', duration=duration, status='ok')
+
+            click.echo(indent + click.style('  OK.', fg='green'))
+            done.append((migration, duration))
+
+            if atomic:
+                continue
+
+            if direction == 'apply':
+                db.fix_migration(app_name, migration, duration, loader.checksum(migration))
+            else:
+                db.revert_migration(app_name, migration)
+
+    return done
+
+
+def _run_steps(db, app_name, migration, direction, blocks, settings, block_options, verbose, indent='',
+               stop=None):
+    """
+    Executes blocks of a migration with chunked (data migration) or autocommit blocks one by one.
+
+    Autocommit blocks, marked by {# snaql block_name: autocommit #} (or {# snaql: autocommit #} for all blocks),
+    are executed outside of transaction, for CREATE INDEX CONCURRENTLY and other statements not allowed in it.
+
+    Chunked blocks are marked by
+    {# snaql block_name: chunk_key=id chunk_table=users [chunk_size=1000] [sleep=0.5] [rows_per_sec=5000] #}.
+    Chunked block is executed once per chunk_size range of integer chunk_key values, passed to it
+    as %(chunk_start)s and %(chunk_end)s (excluded) parameters, and throttled by sleep (seconds between chunks)
+    and rows_per_sec. Every block and every chunk is committed along with its checkpoint,
+    so execution interrupted by a failure is resumed from the last committed chunk
+    """
+
+    progress = db.load_progress(app_name, migration, direction)
+
+    for block_name, sql in blocks:
+        if block_name in progress and progress[block_name] is None:
+            click.echo(indent + '    {0}: done by the previous run'.format(block_name))
+            continue
+
+        options = block_options.get(block_name, {})
+        set_blocks, reset_blocks = db.timeout_blocks(dict(settings, **options))
+
+        if verbose:
+            click.echo(indent + '    ' + sql)
+
+        if options.get('autocommit'):
+            db.commit()
+            _execute_autocommit(db, block_name, sql, dict(settings, **options), indent)
+            db.save_progress(app_name, migration, direction, block_name, None)
+            db.commit()
+            continue
+
+        if 'data' in options:
+            db.execute_blocks(set_blocks)
+            rows = db.load_data(block_name, sql, options)
+            db.execute_blocks(reset_blocks)
+            db.save_progress(app_name, migration, direction, block_name, None)
+            db.commit()
+
+            click.echo(indent + '    {0}: {1} row(s) loaded from {2}'.format(
+                block_name, rows, os.path.basename(options['data'])))
+            continue
+
+        if 'chunk_key' not in options:
+            db.execute_blocks(set_blocks + [(block_name, sql)] + reset_blocks)
+            db.save_progress(app_name, migration, direction, block_name, None)
+            db.commit()
+            continue
+
+        chunk_size = int(options.get('chunk_size', 1000))
+        pause = float(options.get('sleep', 0))
+        rows_per_sec = float(options.get('rows_per_sec', 0))
+
+        bounds = db.chunk_bounds(options.get('chunk_table'), options['chunk_key'])
+        start, chunks, total = None, 0, 0
+
+        if bounds is not None:
+            start = progress.get(block_name, bounds[0])
+            if block_name in progress:
+                click.echo(indent + '    {0}: resuming from {1}={2}'.format(block_name, options['chunk_key'], start))
+
+        while bounds is not None and start <= bounds[1]:
+            if stop is not None and stop.is_set():
+                raise click.ClickException('migrating of "{0}" is interrupted'.format(app_name))
+
+            end = start + chunk_size
+            started = default_timer()
+
+            with db.events.timed('chunk', block=block_name, start=start, end=end) as event:
+                db.execute_blocks(set_blocks)
+                rows = db.execute_chunk(block_name, sql, start, end)
+                db.execute_blocks(reset_blocks)
+                db.save_progress(app_name, migration, direction, block_name, end if end <= bounds[1] else None)
+                db.commit()
+                event['rows'] = rows
+
+            chunks += 1
+            total += rows
+            start = end
+
+            if verbose:
+                click.echo(indent + '    {0}: chunk {1} .. {2}, {3} row(s)'.format(block_name, end - chunk_size,
+                                                                                   end, rows))
+
+            if start <= bounds[1]:
+                delay = max(pause, rows / rows_per_sec - (default_timer() - started) if rows_per_sec else 0)
+                if delay > 0:
+                    time.sleep(delay)
+
+        if bounds is None:
+            db.save_progress(app_name, migration, direction, block_name, None)
+            db.commit()
+
+        click.echo(indent + '    {0}: {1} row(s) in {2} chunk(s)'.format(block_name, total, chunks))
+
+    db.clear_progress(app_name, migration)  # committed along with the migration record
+
+
+def _execute_autocommit(db, block_name, sql, settings, indent=''):
+    """
+    Executes block in autocommit mode, dropping invalid indexes left by failed concurrent builds of the block
+    before and after execution (so it could be safely retried)
+    """
+    set_blocks, reset_blocks = db.timeout_blocks(settings, session=True)
+    db.set_autocommit(True)
+
+    try:
+        for index_name in db.drop_invalid_indexes(sql):
+            click.echo(indent + click.style('    Warning: dropped invalid index {0} left by a failed '
+                                            'concurrent build'.format(index_name), fg='yellow'))
+
+        db.execute_blocks(set_blocks + [(block_name, sql)])
+    except Exception:
+        for index_name in db.drop_invalid_indexes(sql):
+            click.echo(indent + click.style('    Dropped invalid index {0} of the failed block'.format(index_name),
+                                            fg='yellow'))
+        raise
+    finally:
+        db.execute_blocks(reset_blocks)
+        db.set_autocommit(False)
+
+
+def _execute_at_once(db, blocks, block_options, batch_size=1, atomic=False):
+    """
+    Executes blocks in the current transaction, chunked ones (see _run_steps) over the whole key range at once
+    and data ones (see DBWrapper.load_data) with their data files streamed.
+    Autocommit blocks are executed outside of it, so the preceding blocks are committed (not allowed if atomic)
+    """
+    pending = []
+
+    for block_name, sql in blocks:
+        options = block_options.get(block_name, {})
+
+        if options.get('autocommit'):
+            if atomic:
+                raise click.ClickException('autocommit block "{0}" could not be executed in a single '
+                                           'transaction'.format(block_name))
+
+            db.execute_blocks(pending, batch_size)
+            pending = []
+
+            db.commit()
+            _execute_autocommit(db, block_name, sql, options)
+
+        elif 'chunk_key' in options:
+            db.execute_blocks(pending, batch_size)
+            pending = []
+
+            bounds = db.chunk_bounds(options.get('chunk_table'), options['chunk_key'])
+            if bounds is not None:
+                db.execute_chunk(block_name, sql, bounds[0], bounds[1] + 1)
+
+        elif 'data' in options:
+            db.execute_blocks(pending, batch_size)
+            pending = []
+
+            db.load_data(block_name, sql, options)
+        else:
+            pending.append((block_name, sql))
+
+    db.execute_blocks(pending, batch_size)
+
+
+def _with_timeouts(timeout_blocks, blocks, settings, block_options):
+    """
+    Surrounds blocks with statements setting (and resetting) lock and statement timeouts of the migration
+    and its blocks, see SETTINGS. timeout_blocks(settings) is DBWrapper.timeout_blocks or alike
+    """
+    set_blocks, reset_blocks = timeout_blocks(settings)
+    result = list(set_blocks)
+
+    for block in blocks:
+        block_set, block_reset = timeout_blocks(block_options.get(block[0], {}))
+        result.extend(block_set)
+        result.append(block)
+
+        if block_reset:
+            result.extend(block_reset)
+            result.extend(set_blocks)  # back to the migration settings
+
+    return result + reset_blocks
+
+
+def _timeout_blocks(scheme, settings, session=False):
+    """
+    Returns ([(name, sql), ...] setting timeouts of the settings supported by the database of the scheme,
+    [(name, sql), ...] resetting them to defaults). Timeouts are either in milliseconds or with units ('5s').
+    PostgreSQL timeouts are set for the current transaction, unless session is set (for autocommit mode)
+    """
+    set_blocks, reset_blocks = [], []
+
+    if scheme == 'postgres':
+        for name in ('lock_timeout', 'statement_timeout'):
+            if settings.get(name) is not None:
+                value = str(settings[name]).strip()
+                if not re.match(r'^\d+(\.\d+)?\s*(us|ms|s|min|h|d)?$', value):
+                    raise click.ClickException('invalid {0} value "{1}"'.format(name, value))
+
+                set_blocks.append(('set ' + name, "SET {0} {1} = '{2}'".format(
+                    'SESSION' if session else 'LOCAL', name, value)))
+                reset_blocks.append(('reset ' + name, 'SET {0} {1} TO DEFAULT'.format(
+                    'SESSION' if session else 'LOCAL', name)))
+
+    elif scheme == 'mysql':
+        if settings.get('lock_wait_timeout') is not None:
+            value = str(settings['lock_wait_timeout']).strip()
+            if not re.match(r'^\d+s?$', value):
+                raise click.ClickException('invalid lock_wait_timeout value "{0}" (seconds)'.format(value))
+
+            set_blocks.append(('set lock_wait_timeout',
+                               'SET SESSION lock_wait_timeout = {0}'.format(value.rstrip('s'))))
+            reset_blocks.append(('reset lock_wait_timeout', 'SET SESSION lock_wait_timeout = DEFAULT'))
+
+    return set_blocks, reset_blocks
+
+
+def _backoff_delay(settings, attempt):
+    """
+    Returns jittered exponential delay (in seconds) before the next attempt
+    """
+    delay = min(float(settings.get('retry_max_delay', 30)), float(settings.get('retry_delay', 1)) * 2 ** (attempt - 1))
+    return delay * random.uniform(0.5, 1)
+
+
+def _commit_atomic(db, migrations, direction, indent=''):
+    """
+    Records [(app, migration[, duration, checksum]), ...] executed by atomic run and commits the whole transaction
+    """
+
+    click.echo(indent + click.style('Committing {0} migration(s)...'.format(len(migrations)), fg='blue'))
+
+    try:
+        if direction == 'apply':
+            db.fix_migrations(migrations, commit=False)
+        else:
+            db.revert_migrations(migrations, commit=False)
+
+        db.commit()
+    except Exception as e:
+        click.echo(indent + click.style('  FAILED.', fg='red'))
+        db.rollback()
+        raise click.ClickException('migrations recording failed\n{0}'.format(e))
+
+    click.echo(indent + click.style('  OK.', fg='green'))
+
+
+def _check_atomic(db, indent=''):
+    if db.scheme == 'mysql':
+        click.echo(indent + click.style('Warning: MySQL implicitly commits DDL statements, '
+                                        '--atomic only guarantees all-or-nothing for data changes', fg='yellow'))
+
+
+@click.command()
+@click.argument('name')
+@click.option('--verbose', is_flag=True, default=False, help='Dump SQL queries')
+@click.option('--atomic', is_flag=True, default=False, help='Revert all migrations in a single transaction')
+@click.option('--batch-size', default=None, type=click.IntRange(1),
+              help='Number of migration blocks sent to the database at once (default is 1 or batch_size from config)')
+@click.option('--shard-jobs', default=None, type=click.IntRange(1),
+              help='Number of shards reverted in parallel (default is 4 or shard_jobs from config)')
+@click.option('--keep-going', is_flag=True, default=False, help='Keep reverting other shards after a shard failure')
+@click.pass_context
+def revert(ctx, name, verbose, atomic, batch_size, shard_jobs, keep_going):
+    """
+    Revert migration
+    """
+
+    if ctx.obj.config.get('shards'):
+        results = _run_shards(ctx.obj, lambda migrator: migrator.revert(name, verbose, atomic=atomic,
+                                                                        batch_size=batch_size),
+                              shard_jobs, keep_going)
+        _echo_shards(results, ('Reverted',), lambda reverted: (len(reverted),))
+        return
+
+    ctx.obj.revert(name, verbose, atomic=atomic, batch_size=batch_size)
+
+
+@click.command()
+@click.argument('app', required=False)
+@click.option('--verbose', is_flag=True, default=False, help='Dump SQL queries')
+@click.option('--watch', is_flag=True, default=False, help='Keep redoing migrations as their files are changed')
+@click.option('--interval', default=1.0, type=click.FloatRange(0.1), help='Seconds between checks for --watch')
+@click.pass_context
+def redo(ctx, app, verbose, watch, interval):
+    """
+    Revert and apply again migrations changed since applying
+    """
+
+    if not watch:
+        ctx.obj.redo(app, verbose)
+        return
+
+    try:
+        ctx.obj.watch(app, verbose, interval)
+    except KeyboardInterrupt:
+        pass
+
+
+def _run_shards(migrator, action, jobs=None, keep_going=False):
+    """
+    Calls action(shard_migrator) for every shard of the config with a pool of jobs threads, every shard has its own
+    Migrator (so its own connection, lock and state). Unless keep_going, no shards are started after the first
+    failure and running ones stop after their current migration.
+    Returns [(shard, status, result or exception, duration), ...] in shards order, status is ok, failed or skipped
+    """
+
+    shards = migrator.config['shards']
+    jobs = jobs or migrator.config.get('shard_jobs', 4)
+
+    pending = queue.Queue()
+    for index in range(len(shards)):
+        pending.put(index)
+
+    results = [None] * len(shards)
+    stop = threading.Event()
+
+    def worker():
+        while True:
+            try:
+                index = pending.get_nowait()
+            except queue.Empty:
+                break
+
+            shard, db_uri = shards[index]
+            if stop.is_set():
+                results[index] = (shard, 'skipped', None, None)
+                continue
+
+            shard_migrator = Migrator(dict(migrator.config, db_uri=db_uri, shards=None),
+                                      cache_dir=migrator.cache.cache_dir if migrator.cache else None,
+                                      events=migrator.events, prefix='[{0}] '.format(shard),
+                                      stop=None if keep_going else stop)
+            started = default_timer()
+
+            try:
+                with migrator.events.bind(shard=shard):
+                    result = action(shard_migrator)
+            except Exception as e:
+                if not keep_going:
+                    stop.set()
+                results[index] = (shard, 'failed', e, default_timer() - started)
+            else:
+                results[index] = (shard, 'ok', result, default_timer() - started)
+            finally:
+                shard_migrator.close()
+
+    workers = [threading.Thread(target=worker) for _ in range(min(jobs, len(shards)))]
+    for thread in workers:
+        thread.daemon = True
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+    return results
+
+
+def _echo_shards(results, headers, cells):
+    """
+    Prints summary table of _run_shards() results, cells(result) returns headers values of a succeeded shard.
+    Raises click.ClickException if any shard failed or was skipped
+    """
+
+    rows = []
+    for shard, status, result, duration in results:
+        values = cells(result) if status == 'ok' else ('',) * len(headers)
+        error = ': '.join(str(getattr(result, 'message', result)).strip().split('\n')[:2]) if status == 'failed' else ''
+        rows.append((shard, status.upper()) + tuple(values) +
+                    ('' if duration is None else '{0:.3f}s'.format(duration), error))
+
+    click.echo()
+    _echo_table(('Shard', 'Status') + tuple(headers) + ('Time', 'Error'), rows)
+
+    failed = sum(status != 'ok' for shard, status, result, duration in results)
+    if failed:
+        raise click.ClickException('{0} of {1} shard(s) failed or skipped'.format(failed, len(results)))
+
+
+def _echo_table(headers, rows):
+    rows = [[str(cell) for cell in row] for row in rows]
+    widths = [max(len(click.unstyle(row[column])) for row in [headers] + rows) for column in range(len(headers))]
+
+    click.echo(click.style('  '.join(header.ljust(width) for header, width in zip(headers, widths)).rstrip(),
+                           bold=True))
+    for row in rows:  # cells could be styled
+        click.echo('  '.join(cell + ' ' * (width - len(click.unstyle(cell)))
+                             for cell, width in zip(row, widths)).rstrip())
+
+
+def _write_blocks(out, scheme, blocks, block_options):
+    """
+    Writes blocks to the SQL script. Chunked blocks are executed over the whole key range at once, data ones
+    (see DBWrapper.load_data) are followed by their data (COPY), get the data file path (LOAD DATA)
+    or are written for every row of the file (INSERT). Autocommit blocks are refused
+    """
+    for block_name, sql in blocks:
+        options = block_options.get(block_name, {})
+        sql = sql.strip().rstrip(';')
+
+        if options.get('autocommit'):
+            raise click.ClickException('autocommit block "{0}" could not be executed by a SQL script, '
+                                       'use apply'.format(block_name))
+
+        elif 'chunk_key' in options:
+            out.write(sql % {'chunk_start': -2 ** 63, 'chunk_end': 2 ** 63 - 1} + ';\n')
+
+        elif 'data' in options:
+            statement = ' '.join(sql.split()[:2]).upper()
+
+            if statement.startswith('COPY '):
+                out.write(sql + ';\n')
+                with io.open(options['data'], 'r', newline='', encoding='utf-8') as f:
+                    tail = '\n'
+                    for chunk in iter(lambda: f.read(int(options.get('buffer_size', 65536))), ''):
+                        out.write(chunk)
+                        tail = chunk[-1:]
+                out.write(('' if tail == '\n' else '\n') + '\\.\n')
+
+            elif statement == 'LOAD DATA':
+                out.write(sql % {'data_file': _sql_literal(scheme, os.path.abspath(options['data']))} + ';\n')
+
+            else:
+                with io.open(options['data'], 'r', newline='', encoding='utf-8') as f:
+                    reader = csv.reader(f, delimiter='\t' if options['data'].endswith('.tsv') else ',')
+                    if options.get('header'):
+                        next(reader, None)
+
+                    for row in reader:
+                        out.write(sql % tuple(_sql_literal(scheme, value if value != '' else None)
+                                              for value in row) + ';\n')
+        else:
+            out.write(sql + ';\n')
+
+
+def _bookkeeping_sql(scheme, loader, app_name, migrations, direction):
+    """
+    Returns statements recording migrations of the app as applied (or deleting them, when reverting).
+    Checksums are recorded like apply does (so redo finds migrations changed since), durations are unknown
+    """
+    if direction == 'apply':
+        return ''.join('INSERT INTO snaql_migrations (app, migration, applied, duration, checksum) VALUES ({0}, {1}, '
+                       'CURRENT_TIMESTAMP, NULL, {2});\n'.format(_sql_literal(scheme, app_name),
+                                                                 _sql_literal(scheme, migration),
+                                                                 _sql_literal(scheme, loader.checksum(migration)))
+                       for migration in migrations)
+
+    return ''.join('DELETE FROM snaql_migrations WHERE app = {0} AND migration = {1};\n'.format(
+        _sql_literal(scheme, app_name), _sql_literal(scheme, migration)) for migration in migrations)
+
+
+def _sql_literal(scheme, value):
+    """
+    Returns SQL string literal of the value (NULL for None), MySQL also needs backslashes escaped
+    """
+    if value is None:
+        return 'NULL'
+
+    value = value.replace("'", "''")
+    if scheme == 'mysql':
+        value = value.replace('\\', '\\\\')
+
+    return "'" + value + "'"
+
+
+def _select_migrations(apps, name, direction):
+    """
+    Resolves NAME argument to [(app_name, [migration, ...]), ...] in execution order.
+    'all' (applying only) is every migration of every app, <app>/<migration> is
+    all migrations of the app up to (or, when reverting, down to) the given one
+    """
+
+    if name == 'all' and direction == 'apply':
+        return [(app_name, apps[app_name]['migrations']) for app_name in _apps_order(apps)]
+
+    try:
+        app_name, target_migration = name.split('/', 2)
+    except ValueError:
+        if direction == 'apply':
+            raise click.ClickException("NAME format is <app>/<migration> or 'all'")
+        raise click.ClickException('NAME format is <app>/<migration>')
+
+    if app_name not in apps.keys():
+        raise click.ClickException('unknown app "{0}"'.format(app_name))
+
+    migrations = apps[app_name]['migrations']
+    if target_migration not in migrations:
+        raise click.ClickException('unknown migration "{0}"'.format(name))
+
+    mig_idx = migrations.index(target_migration)
+    if direction == 'apply':
+        migrations = migrations[:mig_idx + 1]  # including all prevoius migrations
+    else:
+        migrations = migrations[mig_idx:][::-1]  # all migrations after target_migration in reversed order
+
+    return [(app_name, migrations)]
+
+
+def _read_state(state_file):
+    """
+    Reads MigrationsState from {app: [migration, ...]} YAML/JSON file
+    """
+    import yaml
+
+    try:
+        applied = yaml.safe_load(state_file) or {}
+    except yaml.YAMLError:
+        raise click.ClickException('Incorrect YAML/JSON state file format')
+
+    return MigrationsState((app, migration) for app, migrations in applied.items() for migration in migrations or ())
+
+
+def _replace_database(db_uri, database):
+    return urlparse(db_uri)._replace(path='/' + database).geturl()
+
+
+def _quote_identifier(name):
+    return '"{0}"'.format(name.replace('"', '""'))
+
+
+def _head_digest(apps):
+    """
+    Returns hex digest of names of all apps migrations, stored as schema head once all of them are applied
+    """
+    digest = hashlib.sha1()
+
+    for app_name in sorted(apps):
+        digest.update(json.dumps([app_name, apps[app_name]['migrations']]).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def _migrations_tables():
+    """
+    Returns CREATE TABLE IF NOT EXISTS statements of the bookkeeping tables
+    """
+    return [
+        'CREATE TABLE IF NOT EXISTS snaql_migrations ('
+        'app VARCHAR(50) NOT NULL,'
+        'migration VARCHAR(50) NOT NULL,'
+        'applied TIMESTAMP NOT NULL,' +
+        ''.join('{0} {1},'.format(name, definition) for name, definition in MIGRATIONS_COLUMNS) +
+        'PRIMARY KEY (app, migration))',
+
+        # checkpoints of chunked blocks (see _run_steps), next_key is NULL once the block is done
+        'CREATE TABLE IF NOT EXISTS snaql_migration_progress ('
+        'app VARCHAR(50) NOT NULL,'
+        'migration VARCHAR(50) NOT NULL,'
+        'direction VARCHAR(10) NOT NULL,'
+        'block VARCHAR(100) NOT NULL,'
+        'next_key BIGINT,'
+        'PRIMARY KEY (app, migration, direction, block))',
+
+        # digest of configured migrations (see _head_digest()) once all of them are applied
+        'CREATE TABLE IF NOT EXISTS snaql_migration_head ('
+        'digest VARCHAR(40) NOT NULL)'
+    ]
+
+
+def _migrations_digest(apps):
+    """
+    Returns hex digest of the contents of all apps migrations (and baselines), which fresh databases are built from
+    """
+    digest = hashlib.sha1()
+
+    for app_name in sorted(apps):
+        app = apps[app_name]
+        files = [migration + '.apply.sql' for migration in app['migrations']]
+        if app.get('baseline'):
+            files.append(app['baseline'] + '.baseline.sql')
+
+        digest.update(app_name.encode('utf-8'))
+        for file in files:
+            with open(os.path.join(app['path'], file), 'rb') as f:
+                contents = f.read()
+
+            digest.update(file.encode('utf-8'))
+            digest.update(hashlib.sha1(contents).hexdigest().encode('utf-8'))
+
+            for options in _parse_directives(contents.decode('utf-8'))[1].values():
+                if 'data' in options:  # data files of data blocks, see DBWrapper.load_data()
+                    digest.update(_file_digest(os.path.join(app['path'], options['data'])).encode('utf-8'))
+
+    return digest.hexdigest()
+
+
+def _connect(db_uri, prepare=True, events=None):
+    if not db_uri:
+        raise click.ClickException('--db-uri must be provided for commands using the database')
+
+    try:
+        return DBWrapper(db_uri, prepare, events)
+    except Exception as e:
+        raise click.ClickException('Unable to connect to database, exception is "{0}"'.format(str(e)))
+
+
+def _collect_migrations(migrations_dir):
+    files = set()
+
+    for root, dir, file_names in os.walk(migrations_dir):
+        for file in [f for f in file_names if f.endswith('.apply.sql') or f.endswith('.revert.sql')]:
+            files.add(os.path.relpath(os.path.join(root, file), migrations_dir).replace(os.sep, '/'))
+
+    migrations = sorted(set(file.rsplit('.', 2)[0] for file in files))
+
+    for migration in migrations:
+        if migration + '.apply.sql' not in files or migration + '.revert.sql' not in files:
+            raise click.ClickException('One of the .apply.sql or .revert.sql files '
+                                       'is absent for migration \'{0}\''.format(migration))
+
+    return migrations
+
+
+def _load_app(migrations_dir):
+    """
+    Returns {path: migrations_dir, migrations: [...]} of the app, taking migrations from the manifest
+    if it's up to date (checksums of the manifest are included then), or collecting them otherwise
+    """
+    manifest = _read_manifest(migrations_dir)
+    if manifest is None:
+        app = {'path': migrations_dir, 'migrations': _collect_migrations(migrations_dir)}
+        baseline = _find_baseline(migrations_dir)
+    else:
+        app = {
+            'path': migrations_dir,
+            'migrations': [entry['name'] for entry in manifest['migrations']],
+            'checksums': dict((entry['name'], {'apply': entry['apply'], 'revert': entry['revert']})
+                              for entry in manifest['migrations'])
+        }
+        baseline = manifest.get('baseline')
+
+    if baseline in app['migrations']:
+        app['baseline'] = baseline
+
+    return app
+
+
+def _find_baseline(migrations_dir):
+    """
+    Returns name of the last migration squashed into baseline, if there is any
+    """
+    baselines = [f[:-len('.baseline.sql')] for f in os.listdir(migrations_dir) if f.endswith('.baseline.sql')]
+
+    return max(baselines) if baselines else None
+
+
+def _write_baseline(loader, migrations):
+    """
+    Writes rendered blocks of the given migrations to <last migration>.baseline.sql,
+    replacing the previous baseline. Blocks are separated by BASELINE_MARKER comments
+    """
+    previous = _find_baseline(loader.path)
+    file_path = os.path.join(loader.path, migrations[-1] + '.baseline.sql')
+
+    with open(file_path, 'w') as f:
+        f.write('-- baseline of {0} .. {1}, generated by snaql-migration squash\n'.format(migrations[0],
+                                                                                          migrations[-1]))
+        blocks = [(migration, block) for migration in migrations for block in loader.load(migration, 'apply')]
+
+        # chunked, data and autocommit blocks are executed specially, see _execute_at_once()
+        for migration, (block_name, sql) in blocks:
+            migration_options, block_options = loader.directives(migration, 'apply')
+            options = dict(block_options.get(block_name, {}))
+            if migration_options.get('autocommit'):
+                options['autocommit'] = True
+            if 'data' in options:
+                options['data'] = os.path.relpath(options['data'], loader.path)
+
+            if 'chunk_key' in options or 'data' in options or options.get('autocommit'):
+                f.write('{{# snaql {0}/{1}: {2} #}}\n'.format(migration, block_name, ' '.join(
+                    name if value is True else '{0}={1}'.format(name, value)
+                    for name, value in sorted(options.items()))))
+
+        for migration, (block_name, sql) in blocks:
+            f.write('\n{0}{1}/{2}\n{3}\n'.format(BASELINE_MARKER, migration, block_name, sql))
+
+    if previous is not None and previous != migrations[-1]:
+        os.remove(os.path.join(loader.path, previous + '.baseline.sql'))
+
+
+def _parse_directives(contents):
+    """
+    Returns ({option: value}, {block_name: {option: value}}) from {# snaql: option=value ... #}
+    and {# snaql block_name: option=value ... #} comments, options without value are set to True
+    """
+    migration_options, block_options = {}, {}
+
+    for block_name, options in DIRECTIVE_RE.findall(contents):
+        target = block_options.setdefault(block_name, {}) if block_name else migration_options
+
+        for option in re.split(r'[\s,]+', options.strip()):
+            if option:
+                name, separator, value = option.partition('=')
+                target[name] = value if separator else True
+
+    return migration_options, block_options
+
+
+def _parse_baseline(file_path):
+    blocks = []
+
+    with open(file_path, 'r') as f:
+        for line in f:
+            if line.startswith(BASELINE_MARKER):
+                blocks.append((line[len(BASELINE_MARKER):].strip(), []))
+            elif blocks:
+                blocks[-1][1].append(line)
+
+    return [(block_name, ''.join(lines).strip()) for block_name, lines in blocks]
+
+
+def _read_manifest(migrations_dir, check_fresh=True):
+    """
+    Returns manifest of the migrations directory, None if there is no manifest or (with check_fresh)
+    if files were added, removed or renamed since it was written
+    """
+    try:
+        with open(os.path.join(migrations_dir, MANIFEST_FILE), 'r') as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+
+    if check_fresh:
+        for directory, mtime in manifest['dirs'].items():
+            try:
+                if os.stat(os.path.join(migrations_dir, directory)).st_mtime != mtime:
+                    return None
+            except OSError:
+                return None
+
+    return manifest
+
+
+def _write_manifest(migrations_dir):
+    """
+    Writes manifest with ordered names and content hashes of the migrations directory
+    """
+    migrations = _collect_migrations(migrations_dir)
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'migrations': [{
+            'name': migration,
+            'apply': _file_digest(os.path.join(migrations_dir, migration + '.apply.sql')),
+            'revert': _file_digest(os.path.join(migrations_dir, migration + '.revert.sql'))
+        } for migration in migrations],
+        'baseline': _find_baseline(migrations_dir),
+        'dirs': {}
+    }
+    directories = [root for root, dirs, files in os.walk(migrations_dir)]
+    manifest_path = os.path.join(migrations_dir, MANIFEST_FILE)
+
+    # creating of the manifest changes mtime of the directory, so it's taken after the first write;
+    # the second write is in place and keeps it
+    for i in range(2):
+        with open(manifest_path, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+
+        manifest['dirs'] = dict((os.path.relpath(directory, migrations_dir), os.stat(directory).st_mtime)
+                                for directory in directories)
+
+    return migrations
+
+
+def _file_digest(file_path):
+    digest = hashlib.sha1()
+
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):  # data files could be big
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def _parse_config(config_file):
+    import yaml
+
+    try:
+        config = yaml.safe_load(config_file)
+    except yaml.YAMLError:
+        raise click.ClickException('Incorrect YAML config file format')
+
+    if 'db_uri' not in config:
+        raise click.ClickException('db_uri must be specified in config file')
+    if 'migrations' not in config or not config['migrations']:
+        raise click.ClickException('at least one migration must be specified in config file')
 
-from datetime import datetime
+    if isinstance(config['db_uri'], list) or config.get('shards') is not None:
+        config['shards'] = _expand_shards(config['db_uri'], config.get('shards'))
+        config['db_uri'] = None  # every command runs against each shard, see _run_shards()
 
-try:
-    from urllib.parse import urlparse, unquote
-except ImportError:
-    from urlparse import urlparse
-    from urllib2 import unquote as unquote
+    # reformatting to the {apps: {app1: {path: /some_path, migrations: [...], depends_on: [...]}}} format,
+    # app is either a path or a {path: /some_path, depends_on: [...]} mapping
+    apps = {}
+    for app, options in config['migrations'].items():
+        if isinstance(options, dict):
+            if 'path' not in options:
+                raise click.ClickException('path must be specified for app "{0}"'.format(app))
+
+            apps[app] = _load_app(options['path'])
+            if options.get('depends_on'):
+                apps[app]['depends_on'] = list(options['depends_on'])
+
+            settings = dict((name, options[name]) for name in SETTINGS if name in options)
+            if settings:
+                apps[app]['settings'] = settings
+        else:
+            apps[app] = _load_app(options)
 
-import click
-import yaml
-from snaql.factory import Snaql
+    del config['migrations']
+    config['apps'] = apps
 
-__version__ = '0.1.2'
+    _apps_order(apps)  # dependencies validation
 
+    return config
 
-@click.group()
-@click.option('--db-uri', default=None, help='Database URI, ignored if --config is set')
-@click.option('--migrations', default=None, help='Migrations location, ignored if --config is set',
-              type=click.Path(exists=True))
-@click.option('--app', default=None, help='App name, ignored if --config is set')
-@click.option('--config', default='migrations.yml',
-              help='Configuration file, overlaps usage of the --db-uri/--migrations/--app group', type=click.File('rb'))
-@click.pass_context
-def snaql_migration(ctx, db_uri, migrations, app, config):
+
+def _expand_shards(db_uri, shards):
     """
-    Lightweight SQL Schema migration tool based on Snaql queries
+    Returns [(shard, db_uri), ...] of a list of URIs (db_uri: [...]), or of URI template with {shard} placeholder
+    and either number of shards (shards: 4, named 0..3) or shard names (shards: [eu, us])
     """
 
-    if config:
-        migrations_config = _parse_config(config)
+    if isinstance(db_uri, list):
+        if shards is not None:
+            raise click.ClickException('shards could not be set along with the list of db_uri')
+        if not db_uri:
+            raise click.ClickException('db_uri list must not be empty')
+
+        names = [_shard_name(uri) for uri in db_uri]
+        if len(set(names)) != len(names):  # same host and database on different ports, for example
+            names = [str(index) for index in range(len(db_uri))]
+
+        return list(zip(names, db_uri))
+
+    if not db_uri or '{shard}' not in db_uri:
+        raise click.ClickException('db_uri must contain {shard} placeholder if shards are set')
+
+    if isinstance(shards, int) and not isinstance(shards, bool) and shards > 0:
+        names = [str(index) for index in range(shards)]
+    elif isinstance(shards, list) and shards:
+        names = [str(name) for name in shards]
     else:
-        if db_uri and migrations and app:
-            migrations_config = _generate_config(db_uri, migrations, app)
-        else:
-            raise click.ClickException('If --config is not set, then --db-uri, --migrations and --app must be provided')
+        raise click.ClickException('shards must be either a positive number or a list of shard names')
 
-    ctx.obj = {
-        'config': migrations_config
-    }
+    if len(set(names)) != len(names):
+        raise click.ClickException('shard names must be unique')
 
-    try:
-        ctx.obj['db'] = DBWrapper(ctx.obj['config']['db_uri'])
-    except Exception as e:
-        raise click.ClickException('Unable to connect to database, exception is "{0}"'.format(str(e)))
+    return [(name, db_uri.replace('{shard}', name)) for name in names]
 
 
-@click.command()
-@click.pass_context
-def show(ctx):
+def _shard_name(db_uri):
     """
-    Show migrations list
+    Returns host and database of the URI, without credentials
     """
+    parsed = urlparse(db_uri)
+    return (parsed.hostname or '') + parsed.path if parsed.scheme != 'sqlite' else os.path.basename(parsed.path)
 
-    for app_name, app in ctx.obj['config']['apps'].items():
-        click.echo(click.style(app_name, fg='green', bold=True))
-        for migration in app['migrations']:
-            applied = ctx.obj['db'].is_migration_applied(app_name, migration)
-            click.echo('  {0} {1}'.format(migration, click.style('(applied)', bold=True) if applied else ''))
 
+def _files_snapshot(paths):
+    """
+    Returns {file_path: (mtime, size)} of all files under the paths
+    """
+    snapshot = {}
+
+    for path in paths:
+        for root, dirs, file_names in os.walk(path):
+            for file_name in file_names:
+                file_path = os.path.join(root, file_name)
+                try:
+                    stat = os.stat(file_path)
+                except OSError:  # removed while walking
+                    continue
+                snapshot[file_path] = (stat.st_mtime, stat.st_size)
 
-@click.command()
-@click.argument('name')
-@click.option('--verbose', is_flag=True, default=False, help='Dump SQL queries')
-@click.pass_context
-def apply(ctx, name, verbose):
+    return snapshot
+
+
+def _apps_order(apps):
     """
-    Apply migration
+    Returns app names ordered so that every app goes after the apps it depends on
+    """
+    order = []
+    waiting = dict((app_name, set(app.get('depends_on', ()))) for app_name, app in apps.items())
+
+    for app_name, dependencies in waiting.items():
+        unknown = dependencies - set(apps)
+        if unknown:
+            raise click.ClickException('app "{0}" depends on unknown app "{1}"'.format(app_name, sorted(unknown)[0]))
+
+    while waiting:
+        ready = sorted(app_name for app_name, dependencies in waiting.items() if not dependencies)
+        if not ready:
+            raise click.ClickException('circular dependency between apps {0}'.format(', '.join(sorted(waiting))))
+
+        for app_name in ready:
+            del waiting[app_name]
+            order.append(app_name)
+
+        for dependencies in waiting.values():
+            dependencies.difference_update(ready)
+
+    return order
+
+
+def _generate_config(db_uri, migrations, app):
+    return {
+        'db_uri': db_uri,
+        'apps': {
+            app: _load_app(migrations)
+        }
+    }
+
+
+class Migrator(object):
+    """
+    Plans and executes migrations of the configured apps, the command line interface is a thin layer over it.
+    Could be used in-process, progress is reported with click.echo and events (see EventLog)::
+
+        migrator = Migrator.from_file('migrations.yml')
+        migrator.apply('all')
+        migrator.close()
+
+    Failures are raised as click.ClickException. Output lines are prefixed with prefix, if set,
+    and no more migrations are started once stop (threading.Event) is set
     """
 
-    if name != 'all':  # specific migration
+    def __init__(self, config, db=None, cache_dir=None, events=None, prefix='', stop=None):
+        self.config = config  # see _parse_config()
+        self.events = events or EventLog()
+        self.prefix = prefix
+        self.stop = stop
+
+        cache_dir = cache_dir or config.get('cache_dir')
+        self.cache = TemplateCache(cache_dir, config.get('cache_size', TemplateCache.DEFAULT_SIZE)) \
+            if cache_dir else None
+
+        self._db = db  # connected on demand
+        self._loaders = {}
+
+    @classmethod
+    def from_file(cls, config_file, **kwargs):
+        with open(config_file, 'rb') as f:
+            return cls(_parse_config(f), **kwargs)
+
+    @classmethod
+    def from_path(cls, db_uri, migrations, app, **kwargs):
+        return cls(_generate_config(db_uri, migrations, app), **kwargs)
+
+    @property
+    def db(self):
+        """
+        DBWrapper of the migrator, connecting on the first use
+        """
+        if self._db is None:
+            if self.config.get('shards'):
+                raise click.ClickException('db_uri is a list of {0} shards, the command needs a single database'
+                                           .format(len(self.config['shards'])))
+
+            self._db = _connect(self.config.get('db_uri'), events=self.events)
+
+        return self._db
+
+    def loader(self, app_name):
+        """
+        Returns MigrationLoader of the app, one per app for the migrator lifetime
+        """
+        if app_name not in self._loaders:
+            app = self.config['apps'][app_name]
+            settings = dict((name, self.config[name]) for name in SETTINGS if name in self.config)
+            settings.update(app.get('settings', {}))
+
+            self._loaders[app_name] = MigrationLoader(app['path'], self.cache, app.get('checksums'),
+                                                      app.get('baseline'), self.events, settings)
+
+        return self._loaders[app_name]
+
+    def plan(self, name='all', direction='apply', state=None):
+        """
+        Returns [(app_name, migration), ...] to be applied (or reverted) in order, see _select_migrations()
+        for the name format. MigrationsState is loaded from the database if not given
+        """
+        selected = _select_migrations(self.config['apps'], name, direction)
+
+        if state is None:
+            state = self.db.load_state(None if name == 'all' else selected[0][0])
+
+        return [(app_name, migration) for app_name, migrations in selected for migration in migrations
+                if state.is_applied(app_name, migration) != (direction == 'apply')]
+
+    def preflight(self, name='all'):
+        """
+        Estimates costs of blocks of the migrations to be applied, without executing them: statistics of tables
+        touched by the blocks are read with a single catalog query per app, DML statements are explained.
+        Returns [{app, migration, block, kind, table, rows, size, cost, note}, ...] in execution order, kind of a block
+        is the most expensive one of its statements (see PREFLIGHT_KINDS), cost is their sum
+        """
+        db = self.db
+        state = db.load_state()
+        planned = self.plan(name, 'apply', state)
+        added_columns = db.rewrites_added_columns()
+        result = []
+
         try:
-            app_name, target_migration = name.split('/', 2)
-        except ValueError:
-            raise click.ClickException("NAME format is <app>/<migration> or 'all'")
+            for app_name in [app_name for app_name, migrations in _select_migrations(self.config['apps'], name,
+                                                                                     'apply')]:
+                loader = self.loader(app_name)
+                migrations = [migration for planned_app, migration in planned if planned_app == app_name]
+
+                if loader.baseline in migrations and not state.applied(app_name):
+                    squashed = migrations[:migrations.index(loader.baseline) + 1]
+                    migrations = [(loader.baseline, 'baseline')] + [(migration, 'apply')
+                                                                    for migration in migrations[len(squashed):]]
+                else:
+                    migrations = [(migration, 'apply') for migration in migrations]
+
+                blocks = []
+                for migration, direction in migrations:
+                    block_options = loader.directives(migration, direction)[1]
+                    for block_name, sql in loader.load(migration, direction):
+                        options = block_options.get(block_name, {})
+                        args = {'chunk_start': -2 ** 63, 'chunk_end': 2 ** 63 - 1} if 'chunk_key' in options else None
+                        statements = _split_statements(sql) if 'data' not in options else [sql]
+                        blocks.append((migration, block_name, args, statements))
+
+                tables = set()
+                for migration, block_name, args, statements in blocks:
+                    for statement in statements:
+                        match = TABLE_RE.match(' '.join(re.sub(r'--[^\n]*', '', statement).split()).upper())
+                        if match:
+                            tables.add(match.group(1).strip('"`').split('.')[-1].lower())
+
+                stats = db.table_stats(sorted(tables))
+
+                for migration, block_name, args, statements in blocks:
+                    estimates = [_preflight_statement(db, statement, stats, args, added_columns)
+                                 for statement in statements]
+                    if not estimates:
+                        continue
+
+                    kind = min((kind for kind, table, cost, note in estimates), key=PREFLIGHT_KINDS.index)
+                    table = next((table for table in (estimate[1] for estimate in estimates) if table), None)
+                    rows, size, indexes = stats.get(table, (None, None, None))
+
+                    result.append({
+                        'app': app_name, 'migration': migration, 'block': block_name, 'kind': kind,
+                        'table': table, 'rows': rows, 'size': size,
+                        'cost': sum(cost for kind, table, cost, note in estimates),
+                        'note': '; '.join(note for kind, table, cost, note in estimates if note)
+                    })
+        finally:
+            db.rollback()  # nothing is changed, but EXPLAIN statements could have failed
+
+        return result
+
+    def emit_sql(self, out, name='all', direction='apply', state=None):
+        """
+        Writes the plan (see plan()) to the out file as a single SQL script, to be reviewed and executed
+        by the database client (psql -1 -f, mysql <). Script is written migration by migration, every migration
+        is rendered once and the script is never kept in memory as a whole. Statements are in the dialect
+        of db_uri scheme (when known), bookkeeping statements are included
+        """
+        scheme = urlparse(self.config.get('db_uri') or '').scheme
+        if state is None:
+            state = self.db.load_state()
+
+        apps = self.config['apps']
+        planned = self.plan(name, direction, state)
+
+        out.write('-- {0} {1}, generated by snaql-migration plan --emit-sql\n'.format(direction, name))
+        for sql in _migrations_tables():
+            out.write('\n{0};\n'.format(sql))
+
+        for app_name in [app_name for app_name, migrations in _select_migrations(apps, name, direction)]:
+            loader = self.loader(app_name)
+            migrations = [migration for planned_app, migration in planned if planned_app == app_name]
+
+            if direction == 'apply' and loader.baseline in migrations and not state.applied(app_name):
+                squashed = migrations[:migrations.index(loader.baseline) + 1]
+                migrations = migrations[len(squashed):]
+
+                out.write('\n-- baseline {0}/{1}\n'.format(app_name, loader.baseline))
+                _write_blocks(out, scheme, loader.load(loader.baseline, 'baseline'),
+                              loader.directives(loader.baseline, 'baseline')[1])
+                out.write(_bookkeeping_sql(scheme, loader, app_name, squashed, direction))
+
+            for migration in migrations:
+                migration_options, block_options = loader.directives(migration, direction)
+                settings = dict(loader.settings, **migration_options)
+                blocks = loader.load(migration, direction)
+
+                if migration_options.get('autocommit'):
+                    block_options = dict((block_name, dict(block_options.get(block_name, {}), autocommit=True))
+                                         for block_name, sql in blocks)
+
+                out.write('\n-- {0} {1}/{2}\n'.format(direction, app_name, migration))
+                _write_blocks(out, scheme, _with_timeouts(partial(_timeout_blocks, scheme), blocks, settings,
+                                                          block_options), block_options)
+                out.write(_bookkeeping_sql(scheme, loader, app_name, [migration], direction))
+
+        if planned:
+            out.write('\nDELETE FROM snaql_migration_head;\n')
+            if name == 'all' and direction == 'apply':
+                out.write('INSERT INTO snaql_migration_head (digest) VALUES ({0});\n'.format(
+                    _sql_literal(scheme, _head_digest(apps))))
+
+        out.flush()
+
+    def apply(self, name='all', verbose=False, jobs=1, atomic=False, batch_size=None):
+        """
+        Applies all migrations (name is 'all') or migrations of the app up to the given one (<app>/<migration>).
+        With jobs > 1 independent apps are migrated in parallel over separate connections.
+        Returns [(app_name, migration), ...] applied
+        """
+        batch_size = batch_size or self.config.get('batch_size', 1)
+        selected = _select_migrations(self.config['apps'], name, 'apply')
+
+        if name == 'all':
+            head = _head_digest(self.config['apps'])
+            if self.db.load_head() == head:  # single query for an up to date database
+                click.echo(self.prefix + click.style('Database is up to date.', fg='green'))
+                return []
+
+        with self._locked():
+            if name == 'all' and self.db.load_head() == head:  # migrated by other process while waiting
+                click.echo(self.prefix + click.style('Database is up to date.', fg='green'))
+                return []
+
+            applied = self._apply(name, selected, verbose, jobs, atomic, batch_size)
+
+            if name == 'all':
+                self.db.save_head(head)
+
+        return applied
+
+    def _apply(self, name, selected, verbose, jobs, atomic, batch_size):
+        if name != 'all':  # specific migration
+            app_name, migrations = selected[0]
+            db = self.db
+            db.load_state(app_name)
+
+            if atomic:
+                _check_atomic(db, self.prefix)
+
+            applied = _run_migrations(db, self.loader(app_name), app_name, migrations, 'apply', verbose,
+                                      indent=self.prefix, stop=self.stop, atomic=atomic, batch_size=batch_size)
+
+            if atomic:
+                loader = self.loader(app_name)
+                _commit_atomic(db, [(app_name, migration, duration, loader.checksum(migration))
+                                    for migration, duration in applied], 'apply', self.prefix)
+
+            return [(app_name, migration) for migration, duration in applied]
+
+        elif jobs > 1:  # migrate everything, independent apps in parallel
+            if atomic:
+                raise click.ClickException('--atomic and --jobs could not be used together')
+
+            return self._apply_parallel(jobs, verbose, batch_size)
+
+        else:  # migrate everything
+            return self._apply_all(self.db, verbose, atomic=atomic, batch_size=batch_size)
+
+    def revert(self, name, verbose=False, atomic=False, batch_size=None):
+        """
+        Reverts migrations of the app down to the given one (<app>/<migration>),
+        returns [(app_name, migration), ...] reverted
+        """
+        batch_size = batch_size or self.config.get('batch_size', 1)
+        app_name, migrations = _select_migrations(self.config['apps'], name, 'revert')[0]
+
+        db = self.db
+        with self._locked():
+            db.load_state(app_name)
+
+            if atomic:
+                _check_atomic(db, self.prefix)
+
+            reverted = _run_migrations(db, self.loader(app_name), app_name, migrations, 'revert', verbose,
+                                       indent=self.prefix, stop=self.stop, atomic=atomic, batch_size=batch_size)
+
+            if atomic:
+                _commit_atomic(db, [(app_name, migration) for migration, duration in reverted], 'revert',
+                               self.prefix)
+
+        return [(app_name, migration) for migration, duration in reverted]
+
+    def changed(self, app=None):
+        """
+        Returns [(app_name, [migration, ...]), ...] of applied migrations (of all apps or of the given one),
+        which .apply.sql files were changed since applying, along with the following applied migrations of the app
+        """
+        apps = self.config['apps']
+        if app is not None and app not in apps:
+            raise click.ClickException('unknown app "{0}"'.format(app))
+
+        checksums = self.db.load_checksums(app)
+        changed = []
+
+        for app_name in _apps_order(apps) if app is None else [app]:
+            applied = [migration for migration in apps[app_name]['migrations'] if (app_name, migration) in checksums]
+
+            for index, migration in enumerate(applied):
+                checksum = checksums[(app_name, migration)]
+                if checksum is not None and checksum != self.loader(app_name).checksum(migration):
+                    changed.append((app_name, applied[index:]))
+                    break
+
+        return changed
+
+    def redo(self, app=None, verbose=False, batch_size=None):
+        """
+        Reverts and applies again applied migrations changed since applying (see changed()), app by app.
+        Returns [(app_name, migration), ...] redone
+        """
+        batch_size = batch_size or self.config.get('batch_size', 1)
+        redone = []
+
+        with self._locked():
+            changed = self.changed(app)
+            if not changed:
+                click.echo(self.prefix + click.style('No applied migrations were changed.', fg='green'))
 
-        apps = ctx.obj['config']['apps']
-        if app_name not in apps.keys():
-            raise click.ClickException('unknown app "{0}"'.format(app_name))
+            for app_name, migrations in changed:
+                click.echo(self.prefix + click.style('Redoing {0}...'.format(click.style(app_name, bold=True)),
+                                                     fg='blue'))
 
-        app = apps[app_name]
-        migrations = app['migrations']
-        if target_migration not in migrations:
-            raise click.ClickException('unknown migration "{0}"'.format(name))
+                loader = self.loader(app_name)
+                self.db.load_state(app_name)
 
-        migrations = migrations[:migrations.index(target_migration) + 1]  # including all prevoius migrations
-        for migration in migrations:
-            click.echo(click.style('Applying {0}...'.format(click.style(migration, bold=True)), fg='blue'))
+                _run_migrations(self.db, loader, app_name, migrations[::-1], 'revert', verbose,
+                                indent=self.prefix + '  ', stop=self.stop, batch_size=batch_size)
+                applied = _run_migrations(self.db, loader, app_name, migrations, 'apply', verbose,
+                                          indent=self.prefix + '  ', stop=self.stop, batch_size=batch_size)
+
+                redone.extend((app_name, migration) for migration, duration in applied)
+
+        return redone
+
+    def watch(self, app=None, verbose=False, interval=1.0, stop=None):
+        """
+        Redoes changed migrations (see redo()) every time files under migrations paths are changed,
+        until stop (threading.Event) is set. Failures are reported and watching goes on
+        """
+        stop = stop or threading.Event()
+        apps = self.config['apps']
+        paths = [apps[app_name]['path'] for app_name in (sorted(apps) if app is None else [app])]
+        snapshot = None
+
+        while not stop.is_set():
+            current = _files_snapshot(paths)
 
-            if ctx.obj['db'].is_migration_applied(app_name, migration):
-                click.echo(click.style('  SKIPPED.', fg='green'))
-                continue
+            if current != snapshot:
+                snapshot = current
+                try:
+                    self.redo(app, verbose)
+                except click.ClickException as e:
+                    self.db.rollback()
+                    click.echo(self.prefix + click.style('Error: {0}'.format(e.format_message()), fg='red'))
+
+                click.echo(self.prefix + 'Watching for changes...')
 
+            stop.wait(interval)
+
+    @contextmanager
+    def _locked(self):
+        """
+        Holds the database advisory lock, so concurrently started processes (like replicas of a deployment)
+        wait for the one migrating and never race on the same migrations
+        """
+        db = self.db
+
+        with self.events.timed('lock'):
+            if not db.try_lock():
+                click.echo(self.prefix + click.style('Waiting for other migrating process...', fg='yellow'))
+                db.lock()
+
+        try:
+            yield
+        finally:
             try:
-                snaql_factory = Snaql(app['path'], '')
-                queries = snaql_factory.load_queries(migration + '.apply.sql').ordered_blocks
+                db.unlock()
+            except Exception:
+                pass  # broken connection, the lock is released along with the session
+
+    def close(self):
+        if self._db is not None:
+            self._db.close()
+            self._db = None
+
+    def _apply_all(self, db, verbose, atomic=False, batch_size=1):
+        """
+        Applies all migrations of all apps over the given connection, returns [(app_name, migration), ...] applied
+        """
+
+        db.load_state()
+
+        if atomic:
+            _check_atomic(db, self.prefix)
+
+        applied = []
+        for app_name, migrations in _select_migrations(self.config['apps'], 'all', 'apply'):
+            click.echo(self.prefix + click.style('Migrating {0}...'.format(click.style(app_name, bold=True)),
+                                                 fg='blue'))
+
+            migrations = _run_migrations(db, self.loader(app_name), app_name, migrations, 'apply', verbose,
+                                         indent=self.prefix + '  ', stop=self.stop, atomic=atomic,
+                                         batch_size=batch_size)
+            applied.extend((app_name, migration, duration, self.loader(app_name).checksum(migration))
+                           for migration, duration in migrations)
+
+        if atomic:
+            _commit_atomic(db, applied, 'apply', self.prefix)
+
+        return [(app_name, migration) for app_name, migration, duration, checksum in applied]
+
+    def _apply_parallel(self, jobs, verbose, batch_size=1):
+        """
+        Migrates all apps with a pool of connections, an app is started as soon as all apps it depends on are migrated.
+        On the first failure no new apps are started and running ones stop after their current migration.
+        Returns [(app_name, migration), ...] applied
+        """
+
+        if self.db.scheme == 'sqlite':
+            raise click.ClickException('SQLite serializes writing transactions, --jobs could not be used with it')
+
+        apps = self.config['apps']
+        waiting = dict((app_name, set(app.get('depends_on', ()))) for app_name, app in apps.items())
+        loaders = dict((app_name, self.loader(app_name)) for app_name in apps)  # created before threads start
+
+        ready = queue.Queue()
+        results = queue.Queue()
+        stop = threading.Event()
+        fields = self.events.bound()  # shard of the calling thread
+
+        def worker():
+            db = None
+            try:
+                while True:
+                    app_name = ready.get()
+                    if app_name is None:
+                        break
+
+                    try:
+                        with self.events.bind(**fields):
+                            if db is None:
+                                db = _connect(self.config.get('db_uri'), events=self.events)
+                            db.load_state(app_name)
+
+                            applied = _run_migrations(db, loaders[app_name], app_name,
+                                                      apps[app_name]['migrations'], 'apply', verbose,
+                                                      indent='{0}[{1}] '.format(self.prefix, app_name),
+                                                      stop=stop, batch_size=batch_size)
+                    except Exception as e:
+                        stop.set()
+                        results.put((app_name, e))
+                    else:
+                        results.put((app_name, applied))
+            finally:
+                if db is not None:  # never left to the garbage collector, holding a server connection
+                    db.close()
+
+        workers = [threading.Thread(target=worker) for _ in range(min(jobs, len(apps)))]
+        for thread in workers:
+            thread.daemon = True
+            thread.start()
+
+        def schedule():
+            started = []
+            for app_name in sorted(waiting):
+                if not waiting[app_name]:
+                    del waiting[app_name]
+                    ready.put(app_name)
+                    started.append(app_name)
+            return len(started)
+
+        errors, done = [], []
+        running = schedule()
+        while running:
+            app_name, result = results.get()
+            running -= 1
+
+            if isinstance(result, Exception):
+                errors.append((app_name, result))
+                continue
 
-                for query in queries:
-                    if verbose:
-                        click.echo('    ' + query())
+            done.extend((app_name, migration) for migration, duration in result)
 
-                    ctx.obj['db'].query(query())
+            for dependencies in waiting.values():
+                dependencies.discard(app_name)
 
-            except Exception as e:
-                click.echo(click.style('  FAILED.', fg='red'))
-                ctx.obj['db'].rollback()
-                raise click.ClickException('migration execution failed\n{0}'.format(e))
+            if not stop.is_set() and not (self.stop is not None and self.stop.is_set()):
+                running += schedule()
 
-            click.echo(click.style('  OK.', fg='green'))
+        for thread in workers:
+            ready.put(None)
+        for thread in workers:
+            thread.join()
 
-            ctx.obj['db'].commit()
+        if errors:
+            raise click.ClickException('\n'.join('{0}: {1}'.format(app_name, getattr(e, 'message', e))
+                                                 for app_name, e in errors))
 
-            ctx.obj['db'].fix_migration(app_name, migration)
+        return done
 
-    else:  # migrate everything
-        for app_name, app in ctx.obj['config']['apps'].items():
-            click.echo(click.style('Migrating {0}...'.format(click.style(app_name, bold=True)), fg='blue'))
 
-            for migration in app['migrations']:
-                click.echo('  Applying {0}...'.format(click.style(migration, bold=True)))
+class EventLog(object):
+    """
+    Dispatches timing events to subscribed callbacks. Every event is a dict with 'event' (render, block, chunk,
+    commit, bookkeeping, lock, retry or migration), 'time', 'duration' (in seconds) and 'status' (ok or failed) keys,
+    app/migration/direction of the migration being executed (if any) and event specific fields
+    """
 
-                if ctx.obj['db'].is_migration_applied(app_name, migration):
-                    click.echo(click.style('    SKIPPED.', fg='green'))
-                    continue
+    def __init__(self):
+        self.callbacks = []
+        self._local = threading.local()  # fields bound by the current thread
+
+    def subscribe(self, callback):
+        self.callbacks.append(callback)
+
+    def bound(self):
+        """
+        Returns fields bound by the current thread, so they could be bound by threads it starts
+        """
+        return dict(getattr(self._local, 'fields', {}))
+
+    @contextmanager
+    def bind(self, **fields):
+        """
+        Adds fields to all events emitted by the current thread within the block
+        """
+        previous = getattr(self._local, 'fields', {})
+        self._local.fields = dict(previous, **fields)
+        try:
+            yield
+        finally:
+            self._local.fields = previous
+
+    @contextmanager
+    def timed(self, event, **fields):
+        """
+        Emits event with duration of the block, yielded dict could be used to add fields
+        """
+        started = default_timer()
+        status = 'ok'
+        try:
+            yield fields
+        except Exception:
+            status = 'failed'
+            raise
+        finally:
+            if self.callbacks:
+                self.emit(event, duration=default_timer() - started, status=status, **fields)
+
+    def emit(self, event, **fields):
+        if not self.callbacks:
+            return
+
+        record = dict(getattr(self._local, 'fields', {}), event=event, time=datetime.now().isoformat(), **fields)
+        for callback in self.callbacks:
+            callback(record)
+
+
+class JsonLinesWriter(object):
+    """
+    EventLog callback appending events to the file as JSON lines
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'a')
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        with self._lock:
+            self._file.write(json.dumps(event, sort_keys=True) + '\n')
+            self._file.flush()
 
+
+class TemplateCache(object):
+    """
+    On-disk cache of rendered migration blocks, keyed by file path and content hash.
+    Least recently used entries are evicted once there are more than max_entries of them
+    (a tenth more is evicted at once, so the directory is scanned once per that many new entries)
+    """
+
+    DEFAULT_SIZE = 1000
+
+    ENTRY_RE = re.compile(r'^[0-9a-f]{40}\.json$')
+
+    def __init__(self, cache_dir, max_entries=DEFAULT_SIZE):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self._entries = None  # number of entries, counted on the first write
+        self._lock = threading.Lock()
+
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def _entry_path(self, file_path):
+        key = hashlib.sha1(os.path.abspath(file_path).encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key + '.json')
+
+    def get(self, file_path, digest):
+        entry_path = self._entry_path(file_path)
+        try:
+            with open(entry_path, 'r') as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if entry.get('digest') != digest:  # file was changed since caching
+            return None
+
+        try:
+            os.utime(entry_path, None)  # marking as recently used
+        except OSError:
+            pass
+
+        return [tuple(block) for block in entry['blocks']]
+
+    def set(self, file_path, digest, blocks):
+        entry_path = self._entry_path(file_path)
+        tmp_path = '{0}.{1}.{2}.tmp'.format(entry_path, os.getpid(), threading.current_thread().ident)
+        new = not os.path.exists(entry_path)
+
+        with open(tmp_path, 'w') as f:
+            json.dump({'path': file_path, 'digest': digest, 'blocks': blocks}, f)
+        os.rename(tmp_path, entry_path)  # atomic, concurrent readers never see partial entries
+
+        with self._lock:
+            if self._entries is None:
+                self._entries = len(self._list_entries())
+            elif new:
+                self._entries += 1
+
+            if self._entries > self.max_entries:
+                self._evict()
+
+    def _list_entries(self):
+        return [os.path.join(self.cache_dir, f) for f in os.listdir(self.cache_dir) if self.ENTRY_RE.match(f)]
+
+    def _evict(self):
+        entries = self._list_entries()  # other processes could have added (or evicted) entries too
+        keep = self.max_entries - self.max_entries // 10
+
+        if len(entries) > self.max_entries:
+            entries.sort(key=os.path.getmtime)
+            for entry_path in entries[:len(entries) - keep]:
                 try:
-                    snaql_factory = Snaql(app['path'], '')
-                    queries = snaql_factory.load_queries(migration + '.apply.sql').ordered_blocks
+                    os.remove(entry_path)
+                except OSError:
+                    pass
 
-                    for query in queries:
-                        if verbose:
-                            click.echo('    ' + query())
+            entries = entries[len(entries) - keep:]
 
-                        ctx.obj['db'].query(query())
+        self._entries = len(entries)
 
-                except Exception as e:
-                    click.echo(click.style('    FAILED.', fg='red'))
-                    ctx.obj['db'].rollback()
-                    raise click.ClickException('migration execution failed\n{0}'.format(e))
 
-                click.echo(click.style('  OK.', fg='green'))
+class MigrationLoader(object):
+    """
+    Loads rendered blocks of the app migrations through a single shared Snaql factory,
+    consulting TemplateCache (if any) first. Files not matching checksums of the manifest are reported as drifted
+    """
 
-                ctx.obj['db'].commit()
+    def __init__(self, path, cache=None, checksums=None, baseline=None, events=None, settings=None):
+        self.path = path
+        self.cache = cache
+        self.checksums = checksums  # {migration: {apply: digest, revert: digest}} from the manifest
+        self.baseline = baseline  # the last migration squashed into baseline
+        self.events = events or EventLog()
+        self.settings = settings or {}  # app execution settings, see SETTINGS
+        self._factory = None
+        self._directives = {}
+
+    @property
+    def factory(self):
+        if self._factory is None:
+            from snaql.factory import Snaql
+
+            self._factory = Snaql(self.path, '')
+            self._factory.jinja_env.cache = None  # Snaql meta is collected while parsing, so every load must reparse
+
+        return self._factory
+
+    def load(self, migration, direction):
+        """
+        Returns [(block_name, sql), ...] of migration's .apply.sql/.revert.sql
+        (or .baseline.sql, see squash command) in execution order
+        """
+        file_name = '{0}.{1}.sql'.format(migration, direction)
+        file_path = os.path.join(self.path, file_name)
+
+        with open(file_path, 'rb') as f:
+            contents = f.read()
+
+        digest = hashlib.sha1(contents).hexdigest()
+        self._directives[(migration, direction)] = self._parse_directives(contents)
+
+        if self.checksums is not None and self.checksums.get(migration, {}).get(direction, digest) != digest:
+            click.echo(click.style('  Warning: {0} was changed since it was indexed (drift)'.format(file_name),
+                                   fg='yellow'))
+
+        with self.events.timed('render', file=file_name) as event:
+            if self.cache is not None:
+                blocks = self.cache.get(file_path, digest)
+                event['cached'] = blocks is not None
+                if blocks is not None:
+                    return blocks
+
+            if direction == 'baseline':
+                blocks = _parse_baseline(file_path)
+            else:
+                try:
+                    queries = self.factory.load_queries(file_name).ordered_blocks
+                except Exception:
+                    self.factory.jinja_env.sql_params.clear()  # leftovers of the broken template
+                    raise
 
-                ctx.obj['db'].fix_migration(app_name, migration)
+                blocks = [(query.func_name, query()) for query in queries]
 
+            if self.cache is not None:
+                self.cache.set(file_path, digest, blocks)
 
-@click.command()
-@click.argument('name')
-@click.option('--verbose', is_flag=True, default=False, help='Dump SQL queries')
-@click.pass_context
-def revert(ctx, name, verbose):
+            return blocks
+
+    def checksum(self, migration):
+        """
+        Returns digest of the current contents of migration's .apply.sql
+        """
+        return _file_digest(os.path.join(self.path, migration + '.apply.sql'))
+
+    def directives(self, migration, direction):
+        """
+        Returns ({setting: value}, {block_name: {setting: value}}) set by comments of the migration file
+        """
+        if (migration, direction) not in self._directives:
+            with open(os.path.join(self.path, '{0}.{1}.sql'.format(migration, direction)), 'rb') as f:
+                self._directives[(migration, direction)] = self._parse_directives(f.read())
+
+        return self._directives[(migration, direction)]
+
+    def _parse_directives(self, contents):
+        migration_options, block_options = _parse_directives(contents.decode('utf-8'))
+
+        for options in block_options.values():
+            if 'data' in options:  # data files are located next to migration files
+                options['data'] = os.path.join(self.path, options['data'])
+
+        return migration_options, block_options
+
+
+class MigrationsState(object):
     """
-    Revert migration
+    In-memory snapshot of the snaql_migrations table, indexed by app
     """
 
-    try:
-        app_name, target_migration = name.split('/', 2)
-    except ValueError:
-        raise click.ClickException('NAME format is <app>/<migration>')
+    def __init__(self, rows=()):
+        self._applied = {}
 
-    apps = ctx.obj['config']['apps']
-    if app_name not in apps.keys():
-        raise click.ClickException('unknown app "{0}"'.format(app_name))
+        for app, migration in rows:
+            self.add(app, migration)
 
-    app = apps[app_name]
-    migrations = app['migrations']
-    if target_migration not in migrations:
-        raise click.ClickException('unknown migration "{0}"'.format(name))
+    def is_applied(self, app, migration):
+        return migration in self._applied.get(app, ())
 
-    mig_idx = migrations.index(target_migration)
-    migrations = migrations[-len(migrations) + mig_idx:]  # all migrations after target_migration
-    migrations = migrations[::-1]  # in reversed order
+    def applied(self, app):
+        return self._applied.get(app, set())
 
-    for migration in migrations:
-        click.echo(
-            click.style('Reverting {0}...'.format(click.style(app_name + '/' + migration, bold=True)), fg='blue'))
+    def add(self, app, migration):
+        self._applied.setdefault(app, set()).add(migration)
 
-        if not ctx.obj['db'].is_migration_applied(app_name, migration):
-            click.echo(click.style('  SKIPPED.', fg='green'))
-            continue
-        try:
-            snaql_factory = Snaql(app['path'], '')
-            queries = snaql_factory.load_queries(migration + '.revert.sql').ordered_blocks
+    def discard(self, app, migration):
+        self._applied.get(app, set()).discard(migration)
 
-            for query in queries:
-                if verbose:
-                    click.echo('    ' + query())
 
-                ctx.obj['db'].query(query())
+class BlockExecutionError(Exception):
+    def __init__(self, block_name, error):
+        super(BlockExecutionError, self).__init__('block "{0}" failed: {1}'.format(block_name, error))
+        self.block_name = block_name
+        self.error = error
 
-        except Exception as e:
-            click.echo(click.style('  FAILED.', fg='red'))
-            ctx.obj['db'].rollback()
 
-            raise click.ClickException('migration execution failed\n{0}'.format(e))
+class SqliteConnection(object):
+    """
+    DB-API connection over sqlite3 one, behaving like the other drivers: transactions (including DDL ones)
+    are started implicitly unless autocommit is set, queries could consist of several statements
+    and use format (%s) or pyformat (%(name)s) parameters
+    """
 
-        click.echo(click.style('  OK.', fg='green'))
+    def __init__(self, path):
+        import sqlite3
 
-        ctx.obj['db'].commit()
+        self.db = sqlite3.connect(path, isolation_level=None, check_same_thread=False)  # transactions are ours
+        self.autocommit = False
+        self._transaction = False
 
-        ctx.obj['db'].revert_migration(app_name, migration)
+    @property
+    def in_transaction(self):
+        # sqlite3 reports it since Python 3.2, on Python 2 transactions started by begin() are tracked
+        return getattr(self.db, 'in_transaction', self._transaction)
 
+    def begin(self):
+        if not self.autocommit and not self.in_transaction:
+            self.db.execute('BEGIN')
+            self._transaction = True
 
-def _collect_migrations(migrations_dir):
-    migrations = []
+    def cursor(self):
+        return SqliteCursor(self)
 
-    for root, dir, files in os.walk(migrations_dir):
-        for file in [f for f in files if f.endswith('.apply.sql') or f.endswith('.revert.sql')]:
-            migration = os.path.join(root, file).lstrip(migrations_dir + '/').rsplit('.', 2)[0]
-            migrations.append(migration)
+    def commit(self):
+        if self.in_transaction:
+            self._transaction = False
+            self.db.execute('COMMIT')
 
-    migrations = sorted(set(migrations))
+    def rollback(self):
+        if self.in_transaction:
+            self._transaction = False
+            self.db.execute('ROLLBACK')
 
-    for migration in migrations:
-        if not os.path.isfile(os.path.join(migrations_dir, migration + '.apply.sql')) \
-                or not os.path.isfile(os.path.join(migrations_dir, migration + '.revert.sql')):
-            raise click.ClickException('One of the .apply.sql or .revert.sql files '
-                                       'is absent for migration \'{0}\''.format(migration))
+    def close(self):
+        self.db.close()
 
-    return migrations
 
+class SqliteCursor(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.cursor = connection.db.cursor()
 
-def _parse_config(config_file):
-    try:
-        config = yaml.load(config_file)
-    except yaml.YAMLError:
-        raise click.ClickException('Incorrect YAML config file format')
+    @property
+    def description(self):
+        return self.cursor.description
 
-    if 'db_uri' not in config:
-        raise click.ClickException('db_uri must be specified in config file')
-    if 'migrations' not in config or not config['migrations']:
-        raise click.ClickException('at least one migration must be specified in config file')
+    @property
+    def rowcount(self):
+        return self.cursor.rowcount
 
-    # reformatting to the {apps: {app1: {path: /some_path, migrations: [...]}}} format
-    apps = {}
-    for app, path in config['migrations'].items():
-        apps[app] = {'path': path, 'migrations': _collect_migrations(path)}
+    def execute(self, sql, args=None):
+        self.connection.begin()
 
-    del config['migrations']
-    config['apps'] = apps
+        if args is not None:
+            self.cursor.execute(*_sqlite_parameters(sql, args))
+        else:
+            for statement in _split_statements(sql):
+                self.cursor.execute(statement)
 
-    return config
+    def executemany(self, sql, seq_of_args):
+        self.connection.begin()
 
+        statements = [_sqlite_parameters(sql, args) for args in seq_of_args]
+        if statements:
+            self.cursor.executemany(statements[0][0], [args for statement, args in statements])
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def nextset(self):
+        return None
+
+    def close(self):
+        self.cursor.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _local_infile(parsed):
+    """
+    Returns whether LOAD DATA LOCAL INFILE is enabled by the query of db_uri (mysql://...?local_infile=1)
+    """
+    return parse_qs(parsed.query).get('local_infile', ['0'])[-1].lower() in ('1', 'true', 'yes')
+
+
+def _sqlite_path(db_uri):
+    """
+    Returns database file of sqlite:///relative/path, sqlite:////absolute/path or sqlite://:memory: URI
+    """
+    path = unquote(db_uri[len('sqlite://'):])
+    return ':memory:' if path in ('', ':memory:', '/:memory:') else path[1:]
 
-def _generate_config(db_uri, migrations, app):
-    return {
-        'db_uri': db_uri,
-        'apps': {
-            app: {
-                'path': migrations,
-                'migrations': _collect_migrations(migrations)
-            }
-        }
-    }
+
+def _sqlite_parameters(sql, args):
+    """
+    Converts format (%s) and pyformat (%(name)s) parameters of the query to qmark (?) and named (:name) ones
+    """
+    sql = re.sub(r'%\((\w+)\)s|%s|%%', lambda match: '%' if match.group(0) == '%%' else
+                 ':' + match.group(1) if match.group(1) else '?', sql)
+
+    if isinstance(args, dict):
+        return sql, args
+
+    return sql, [arg.isoformat(' ') if isinstance(arg, datetime) else arg for arg in args]
+
+
+def _split_statements(sql):
+    """
+    Splits SQL to statements, sqlite3 executes one at a time
+    """
+    import sqlite3
+
+    statements, statement = [], ''
+    for part in sql.split(';'):
+        statement += part + ';'
+        if sqlite3.complete_statement(statement):
+            statements.append(statement)
+            statement = ''
+
+    statements.append(statement)
+
+    return [statement for statement in statements if statement.strip().rstrip(';').strip()]
 
 
 class DBWrapper:
-    def __init__(self, db_url):
+    def __init__(self, db_url, prepare=True, events=None, connection=None):
+        """
+        Connects to db_url, unless DB-API connection (of db_url scheme) is given
+        """
         parsed = urlparse(db_url)
+        self.scheme = parsed.scheme
+
+        if connection is not None:
+            if self.scheme not in ('postgres', 'mysql', 'sqlite'):
+                raise click.ClickException('Unsupported db connection type "{0}"'.format(self.scheme))
+
+            self.db = connection
+        elif self.scheme == 'sqlite':
+            self.db = SqliteConnection(_sqlite_path(db_url))
+        else:
+            self.db = self._connect_server(parsed)
+
+        # LOAD DATA LOCAL INFILE lets the server read client files, so it's enabled by ?local_infile=1 only
+        self.local_infile = connection is not None or _local_infile(parsed)
+        self.state = None
+        self.events = events or EventLog()
+        self._cursor = None
+        self._session_timeouts = False  # MySQL timeouts are set per session, so they are reset on rollback
+
+        if prepare:
+            self._prepare_migrations_table()
+
+    @staticmethod
+    def _connect_server(parsed):
         url = {
             'scheme': parsed.scheme,
             'host': parsed.hostname,
@@ -293,32 +2673,312 @@ class DBWrapper:
             except ImportError:
                 raise click.ClickException('Package psycopg2 must be installed for PostgreSQL use')
 
-            self.db = psycopg2.connect(host=url['host'], port=url['port'], user=url['username'],
-                                       password=url['password'], database=url['path'])
+            return psycopg2.connect(host=url['host'], port=url['port'], user=url['username'],
+                                    password=url['password'], database=url['path'])
         elif url['scheme'] == 'mysql':
             try:
                 import pymysql
             except ImportError:
                 raise click.ClickException('Package pymysql must be installed for MySQL use')
 
-            self.db = pymysql.connect(host=url['host'], port=url['port'], user=url['username'],
-                                      passwd=url['password'], db=url['path'])
+            from pymysql.constants import CLIENT
+
+            return pymysql.connect(host=url['host'], port=url['port'], user=url['username'],
+                                   passwd=url['password'], db=url['path'],
+                                   client_flag=CLIENT.MULTI_STATEMENTS,  # for batches of blocks
+                                   local_infile=_local_infile(parsed))  # for LOAD DATA LOCAL INFILE of data blocks
         else:
             raise click.ClickException('Unsupported db connection type "{0}"'.format(url['scheme']))
 
-        self._prepare_migrations_table()
-
     def _prepare_migrations_table(self):
-        warnings.simplefilter("ignore")
-        self.query('CREATE TABLE IF NOT EXISTS snaql_migrations ('
-                   'app VARCHAR(50) NOT NULL,'
-                   'migration VARCHAR(50) NOT NULL,'
-                   'applied TIMESTAMP NOT NULL,'
-                   'PRIMARY KEY (app, migration))')
-        self.commit()
+        """
+        Creates bookkeeping tables (or adds columns missing in tables of previous versions). It's done under
+        the advisory lock, so processes started at once on a fresh or upgraded database never race on DDL
+        """
+        if self._missing_columns() == []:
+            return
+
+        if not self.try_lock():
+            self.lock()
+
+        try:
+            missing = self._missing_columns()  # could have been prepared by the process holding the lock
+            if missing == []:
+                return
+
+            warnings.simplefilter("ignore")
+            for sql in _migrations_tables():
+                self.query(sql)
+
+            # tables created by previous versions are lacking some columns
+            for name, definition in MIGRATIONS_COLUMNS:
+                if missing is None or name in missing:
+                    self.query('ALTER TABLE snaql_migrations ADD COLUMN {0} {1}'.format(name, definition))
+
+            self.commit()
+        finally:
+            self.unlock()
+
+    def _missing_columns(self):
+        """
+        Returns names of MIGRATIONS_COLUMNS missing in snaql_migrations, None if any bookkeeping table is missing
+        """
+        try:
+            for table in ('snaql_migration_progress', 'snaql_migration_head', 'snaql_migrations'):
+                self.query('SELECT * FROM {0} WHERE 1=0'.format(table))
+        except Exception:
+            self.rollback()
+            return None
+
+        existing = set(column[0].lower() for column in self.cursor.description)
+        self.commit()  # no locks are held while waiting for the advisory one
+
+        return [name for name, definition in MIGRATIONS_COLUMNS if name not in existing]
+
+    @property
+    def cursor(self):
+        if self._cursor is None:
+            self._cursor = self.db.cursor()
+
+        return self._cursor
 
     def query(self, sql, *args):
-        return self.db.cursor().execute(sql, *args)  # note: there is no autocommit
+        return self.cursor.execute(sql, *args)  # note: there is no autocommit
+
+    def execute_blocks(self, blocks, batch_size=1):
+        """
+        Executes [(block_name, sql), ...] in order, sending up to batch_size consecutive blocks
+        to the server as a single multi-statement query. Raises BlockExecutionError naming the failed block
+        """
+        for i in range(0, len(blocks), batch_size):
+            batch = blocks[i:i + batch_size]
+
+            with self.events.timed('block', block=', '.join(block_name for block_name, sql in batch)):
+                if len(batch) == 1:
+                    block_name, sql = batch[0]
+                    try:
+                        self.query(sql)
+                    except Exception as e:
+                        raise BlockExecutionError(block_name, e)
+                else:
+                    self._execute_batch(batch)
+
+    def _execute_batch(self, batch):
+        sql = ';\n'.join(sql.strip().rstrip(';') for block_name, sql in batch)
+
+        if self.scheme in ('postgres', 'sqlite'):
+            try:
+                # released in the same query, so subtransactions don't pile up for the whole transaction
+                self.query('SAVEPOINT snaql_batch;\n' + sql + ';\nRELEASE SAVEPOINT snaql_batch')
+            except Exception as error:
+                # replaying blocks one by one to find out the failed one
+                self.query('ROLLBACK TO SAVEPOINT snaql_batch')
+                self.execute_blocks(batch)
+
+                raise BlockExecutionError(', '.join(block_name for block_name, sql in batch), error)
+        else:  # MySQL implicitly commits DDL, so the batch could not be replayed
+            try:
+                self.query(sql)
+                while self.cursor.nextset():  # errors of the following statements are raised here
+                    pass
+            except Exception as e:
+                raise BlockExecutionError(' or '.join(block_name for block_name, sql in batch), e)
+
+    def execute_chunk(self, block_name, sql, start, end):
+        """
+        Executes chunked block for chunk_key values from start to end (excluded), returns number of affected rows
+        """
+        try:
+            self.query(sql, {'chunk_start': start, 'chunk_end': end})
+        except Exception as e:
+            raise BlockExecutionError(block_name, e)
+
+        return max(self.cursor.rowcount, 0)
+
+    def load_data(self, block_name, sql, options):
+        """
+        Streams data file of the block (options['data']) to the database in the current transaction, the file is
+        never read into memory as a whole. Block is either PostgreSQL COPY ... FROM STDIN (file is sent by
+        buffer_size bytes), MySQL LOAD DATA LOCAL INFILE %(data_file)s (file is sent by the driver) or any INSERT
+        with parameters, executed for every row of CSV (TSV for .tsv files) file by batch_rows rows at once
+        (the first row is skipped if header is set, empty values are NULLs). Returns number of loaded rows
+        """
+        file_path = options['data']
+        statement = ' '.join(sql.split()[:2]).upper()
+
+        with self.events.timed('block', block=block_name, data=os.path.basename(file_path)) as event:
+            try:
+                if statement.startswith('COPY '):
+                    if not hasattr(self.cursor, 'copy_expert'):
+                        raise click.ClickException('COPY data blocks are not supported by {0} '
+                                                   'connection'.format(type(self.db).__name__))
+
+                    with open(file_path, 'rb') as f:
+                        self.cursor.copy_expert(sql, f, int(options.get('buffer_size', 65536)))
+                    rows = max(self.cursor.rowcount, 0)
+
+                elif statement == 'LOAD DATA':
+                    if not self.local_infile and re.search(r'\bLOCAL\s+INFILE\b', sql, re.IGNORECASE):
+                        raise click.ClickException('{0}: LOAD DATA LOCAL INFILE must be enabled by ?local_infile=1 '
+                                                   'in db_uri'.format(block_name))
+
+                    self.query(sql, {'data_file': os.path.abspath(file_path)})
+                    rows = max(self.cursor.rowcount, 0)
+
+                else:
+                    rows = self._insert_rows(sql, file_path, options)
+            except click.ClickException:
+                raise
+            except Exception as e:
+                raise BlockExecutionError(block_name, e)
+
+            event['rows'] = rows
+
+        return rows
+
+    def _insert_rows(self, sql, file_path, options):
+        batch_rows = int(options.get('batch_rows', 1000))
+        rows, batch = 0, []
+
+        with io.open(file_path, 'r', newline='', encoding='utf-8') as f:
+            reader = csv.reader(f, delimiter='\t' if file_path.endswith('.tsv') else ',')
+            if options.get('header'):
+                next(reader, None)
+
+            for row in reader:
+                batch.append([value if value != '' else None for value in row])
+                if len(batch) >= batch_rows:
+                    self.cursor.executemany(sql, batch)
+                    rows, batch = rows + len(batch), []
+
+            if batch:
+                self.cursor.executemany(sql, batch)
+                rows += len(batch)
+
+        return rows
+
+    def table_stats(self, tables):
+        """
+        Returns {table: (rows, size, indexes)} of the existing tables of the current schema with a single catalog
+        query (SQLite has no statistics, so rows are counted and size is None). Rows are estimates of the database
+        """
+        if not tables:
+            return {}
+
+        placeholders = ', '.join(['%s'] * len(tables))
+
+        if self.scheme == 'postgres':
+            rows = self.query_all('SELECT c.relname, GREATEST(c.reltuples, 0)::BIGINT, pg_total_relation_size(c.oid), '
+                                  '(SELECT COUNT(*) FROM pg_index i WHERE i.indrelid = c.oid) '
+                                  'FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace '
+                                  "WHERE c.relkind IN ('r', 'p') AND n.nspname = ANY(current_schemas(false)) "
+                                  'AND c.relname IN ({0})'.format(placeholders), list(tables))
+        elif self.scheme == 'mysql':
+            rows = self.query_all('SELECT t.table_name, t.table_rows, t.data_length + t.index_length, '
+                                  '(SELECT COUNT(DISTINCT s.index_name) FROM information_schema.statistics s '
+                                  'WHERE s.table_schema = t.table_schema AND s.table_name = t.table_name) '
+                                  'FROM information_schema.tables t '
+                                  'WHERE t.table_schema = DATABASE() AND t.table_name IN ({0})'.format(placeholders),
+                                  list(tables))
+        else:
+            existing = self.query_all("SELECT m.name, (SELECT COUNT(*) FROM pragma_index_list(m.name)) "
+                                      "FROM sqlite_master m WHERE m.type = 'table' "
+                                      "AND m.name IN ({0})".format(placeholders), list(tables))
+            if not existing:
+                return {}
+
+            counts = dict(self.query_all(' UNION ALL '.join('SELECT %s, COUNT(*) FROM {0}'.format(
+                _quote_identifier(name)) for name, indexes in existing), [name for name, indexes in existing]))
+            rows = [(name, counts[name], None, indexes) for name, indexes in existing]
+
+        return dict((name.lower(), (int(count or 0), None if size is None else int(size), int(indexes)))
+                    for name, count, size, indexes in rows)
+
+    def rewrites_added_columns(self):
+        """
+        Returns whether added columns rewrite tables on the server, see _rewrites_added_columns
+        """
+        if self.scheme == 'postgres':
+            return _rewrites_added_columns(self.scheme, self.query_one('SHOW server_version_num')[0])
+        elif self.scheme == 'mysql':
+            return _rewrites_added_columns(self.scheme, self.query_one('SELECT VERSION()')[0])
+
+        return None
+
+    def explain(self, sql, args=None):
+        """
+        Returns (full_scan, cost) of the DML statement, without executing it. full_scan is set if any table
+        is read sequentially, cost is the planner estimate (None for SQLite, which has no estimates)
+        """
+        if self.scheme == 'postgres':
+            self.query('SAVEPOINT snaql_explain')
+            try:
+                self.query('EXPLAIN (FORMAT JSON) ' + sql, args)
+                plan = self.cursor.fetchone()[0]
+            except Exception:
+                self.query('ROLLBACK TO SAVEPOINT snaql_explain')
+                raise
+
+            plan = (json.loads(plan) if isinstance(plan, str) else plan)[0]['Plan']
+            nodes, full_scan = [plan], False
+            while nodes:
+                node = nodes.pop()
+                full_scan = full_scan or node.get('Node Type') == 'Seq Scan'
+                nodes.extend(node.get('Plans', []))
+
+            return full_scan, float(plan['Total Cost'])
+
+        elif self.scheme == 'mysql':
+            self.query('EXPLAIN FORMAT=JSON ' + sql, args)
+            plan = json.loads(self.cursor.fetchone()[0])
+
+            nodes, full_scan = [plan], False
+            while nodes:
+                node = nodes.pop()
+                if isinstance(node, dict):
+                    full_scan = full_scan or node.get('access_type') == 'ALL'
+                    nodes.extend(node.values())
+                elif isinstance(node, list):
+                    nodes.extend(node)
+
+            return full_scan, float(plan.get('query_block', {}).get('cost_info', {}).get('query_cost', 0))
+
+        self.query('EXPLAIN QUERY PLAN ' + sql, args)
+        return any(re.match(r'^SCAN (TABLE )?\S+$', row[-1]) for row in self.cursor.fetchall()), None
+
+    def chunk_bounds(self, table, key):
+        """
+        Returns (min, max) of the integer key column of the table, None if the table is empty
+        """
+        for name in (table, key):
+            if not name or not re.match(r'^[A-Za-z_][\w.]*$', name):
+                raise click.ClickException('chunked blocks require valid chunk_table and chunk_key, '
+                                           'got "{0}"'.format(name))
+
+        self.query('SELECT MIN({0}), MAX({0}) FROM {1}'.format(key, table))
+        low, high = self.cursor.fetchone()
+
+        return None if low is None else (int(low), int(high))
+
+    def load_progress(self, app, migration, direction):
+        """
+        Returns {block: next_key} of chunked migration checkpoints, next_key is None for finished blocks
+        """
+        rows = self.query_all('SELECT block, next_key FROM snaql_migration_progress '
+                              'WHERE app=%s AND migration=%s AND direction=%s', [app, migration, direction])
+        return dict((block, None if next_key is None else int(next_key)) for block, next_key in rows)
+
+    def save_progress(self, app, migration, direction, block, next_key):
+        """
+        Records checkpoint of the block in the current transaction
+        """
+        self.query('DELETE FROM snaql_migration_progress WHERE app=%s AND migration=%s AND direction=%s AND block=%s',
+                   [app, migration, direction, block])
+        self.query('INSERT INTO snaql_migration_progress(app, migration, direction, block, next_key) '
+                   'VALUES (%s, %s, %s, %s, %s)', [app, migration, direction, block, next_key])
+
+    def clear_progress(self, app, migration):
+        self.query('DELETE FROM snaql_migration_progress WHERE app=%s AND migration=%s', [app, migration])
 
     def query_one(self, sql, *args):
         with self.db.cursor() as cur:
@@ -327,35 +2987,231 @@ class DBWrapper:
             self.commit()
             return result
 
+    def query_all(self, sql, *args):
+        with self.db.cursor() as cur:
+            cur.execute(sql, *args)
+            result = cur.fetchall()
+            self.commit()
+            return result
+
     def commit(self):
-        self.db.commit()
+        with self.events.timed('commit'):
+            self.db.commit()
+
+    def set_autocommit(self, enabled):
+        if self.scheme == 'mysql':
+            self.db.autocommit(enabled)
+        else:
+            self.db.autocommit = enabled
 
     def rollback(self):
         self.db.rollback()
 
+        if self._session_timeouts:
+            self.query('SET SESSION lock_wait_timeout = DEFAULT')
+            self._session_timeouts = False
+
+    def timeout_blocks(self, settings, session=False):
+        """
+        Returns ([(name, sql), ...] setting timeouts of the settings supported by the database,
+        [(name, sql), ...] resetting them to defaults), see _timeout_blocks()
+        """
+        set_blocks, reset_blocks = _timeout_blocks(self.scheme, settings, session)
+        if self.scheme == 'mysql' and set_blocks:
+            self._session_timeouts = True
+
+        return set_blocks, reset_blocks
+
+    def drop_invalid_indexes(self, sql):
+        """
+        Drops invalid indexes left by failed CREATE INDEX CONCURRENTLY (REINDEX CONCURRENTLY) statements of sql,
+        must be called in autocommit mode. Returns names of dropped indexes
+        """
+        if self.scheme != 'postgres':
+            return []
+
+        names = re.findall(r'(?:CREATE\s+(?:UNIQUE\s+)?INDEX|REINDEX\s+INDEX)\s+CONCURRENTLY\s+'
+                           r'(?:IF\s+NOT\s+EXISTS\s+)?(?:\w+\.)?"?(\w+)"?', sql, re.IGNORECASE)
+        if not names:
+            return []
+
+        self.query('SELECT n.nspname, c.relname FROM pg_index i '
+                   'JOIN pg_class c ON c.oid = i.indexrelid '
+                   'JOIN pg_namespace n ON n.oid = c.relnamespace '
+                   'WHERE NOT i.indisvalid AND (' + ' OR '.join(['c.relname ~ %s'] * len(names)) + ')',
+                   ['^{0}(_ccnew\\d*)?$'.format(name) for name in names])  # REINDEX leaves name_ccnew
+
+        dropped = []
+        for schema, index_name in self.cursor.fetchall():
+            self.query('DROP INDEX CONCURRENTLY IF EXISTS {0}.{1}'.format(_quote_identifier(schema),
+                                                                          _quote_identifier(index_name)))
+            dropped.append(index_name)
+
+        return dropped
+
+    def is_lock_timeout(self, error):
+        error = getattr(error, 'error', error)  # BlockExecutionError
+
+        if self.scheme == 'postgres':
+            # psycopg2 (or asyncpg) error, lock_not_available
+            return (getattr(error, 'pgcode', None) or getattr(error, 'sqlstate', None)) == '55P03'
+        elif self.scheme == 'mysql':
+            return bool(error.args) and error.args[0] == 1205  # ER_LOCK_WAIT_TIMEOUT
+        elif self.scheme == 'sqlite':
+            return 'database is locked' in str(error)  # busy timeout of the connection
+
+        return False
+
+    def try_lock(self):
+        """
+        Takes session level advisory lock of the database if it's free, returns False otherwise
+        """
+        if self.scheme == 'postgres':
+            return bool(self.query_one('SELECT pg_try_advisory_lock({0})'.format(LOCK_ID))[0])
+        elif self.scheme == 'sqlite':
+            return True  # database file is locked by writing transactions
+        else:
+            return self.query_one("SELECT GET_LOCK(CONCAT('snaql_migration.', DATABASE()), 0)")[0] == 1
+
+    def lock(self):
+        """
+        Waits for session level advisory lock of the database
+        """
+        if self.scheme == 'postgres':
+            self.query_one('SELECT pg_advisory_lock({0})'.format(LOCK_ID))
+        elif self.scheme == 'mysql':
+            self.query_one("SELECT GET_LOCK(CONCAT('snaql_migration.', DATABASE()), -1)")
+
+    def unlock(self):
+        if self.scheme == 'postgres':
+            self.query_one('SELECT pg_advisory_unlock({0})'.format(LOCK_ID))
+        elif self.scheme == 'mysql':
+            self.query_one("SELECT RELEASE_LOCK(CONCAT('snaql_migration.', DATABASE()))")
+
+    def load_head(self):
+        """
+        Returns schema head digest, None if migrations were reverted (or applied partially) since it was saved
+        """
+        row = self.query_one('SELECT digest FROM snaql_migration_head')
+        return row[0] if row else None
+
+    def save_head(self, digest):
+        self.query('DELETE FROM snaql_migration_head')
+        self.query('INSERT INTO snaql_migration_head(digest) VALUES (%s)', [digest])
+        self.commit()
+
     def is_migration_applied(self, app, migration):
         return self.query_one('SELECT EXISTS(SELECT 1 FROM snaql_migrations '
                               'WHERE app=%s AND migration=%s)',
                               [app, migration])[0]
 
-    def fix_migration(self, app, migration):
-        self.query('INSERT INTO snaql_migrations(app, migration, applied) '
-                   'VALUES (%s, %s, %s)',
-                   [app, migration, datetime.now().strftime('%Y-%m-%d %H:%M:%S')])
-        self.commit()
+    def load_state(self, app=None):
+        """
+        Reads applied migrations (of all apps or of the given one) in a single query
+        """
+        if app is None:
+            rows = self.query_all('SELECT app, migration FROM snaql_migrations')
+        else:
+            rows = self.query_all('SELECT app, migration FROM snaql_migrations WHERE app=%s', [app])
+
+        self.state = MigrationsState(rows)
+        return self.state
+
+    def load_durations(self):
+        """
+        Returns {(app, migration): duration} of applied migrations, duration is None if it's unknown
+        """
+        rows = self.query_all('SELECT app, migration, duration FROM snaql_migrations')
+        return dict(((app, migration), duration) for app, migration, duration in rows)
+
+    def load_checksums(self, app=None):
+        """
+        Returns {(app, migration): checksum} of applied migrations (of all apps or of the given one),
+        checksum is None if it's unknown (applied by previous versions)
+        """
+        if app is None:
+            rows = self.query_all('SELECT app, migration, checksum FROM snaql_migrations')
+        else:
+            rows = self.query_all('SELECT app, migration, checksum FROM snaql_migrations WHERE app=%s', [app])
+
+        return dict(((app, migration), checksum) for app, migration, checksum in rows)
+
+    def fix_migration(self, app, migration, duration=None, checksum=None):
+        self.fix_migrations([(app, migration, duration, checksum)])
+
+    def fix_migrations(self, migrations, commit=True):
+        """
+        Records [(app, migration[, duration[, checksum]]), ...] as applied with a single multi-row insert
+        """
+        if not migrations:
+            return
+
+        applied = datetime.now().replace(microsecond=0)
+        args = []
+        for record in migrations:
+            args.extend([record[0], record[1], applied, record[2] if len(record) > 2 else None,
+                         record[3] if len(record) > 3 else None])
+
+        with self.events.timed('bookkeeping', count=len(migrations)):
+            self.query('INSERT INTO snaql_migrations(app, migration, applied, duration, checksum) '
+                       'VALUES ' + ', '.join(['(%s, %s, %s, %s, %s)'] * len(migrations)),
+                       args)
+        if commit:
+            self.commit()
+
+        if self.state is not None:
+            for record in migrations:
+                self.state.add(record[0], record[1])
 
     def revert_migration(self, app, migration):
-        self.query('DELETE FROM snaql_migrations WHERE app=%s AND migration=%s', [app, migration])
-        self.commit()
+        self.revert_migrations([(app, migration)])
+
+    def revert_migrations(self, migrations, commit=True):
+        """
+        Removes [(app, migration), ...] from applied with a single delete
+        """
+        if not migrations:
+            return
+
+        args = []
+        for record in migrations:
+            args.extend([record[0], record[1]])
+
+        with self.events.timed('bookkeeping', count=len(migrations)):
+            self.query('DELETE FROM snaql_migrations '
+                       'WHERE ' + ' OR '.join(['(app=%s AND migration=%s)'] * len(migrations)),
+                       args)
+            self.query('DELETE FROM snaql_migration_head')  # not all migrations are applied anymore
+        if commit:
+            self.commit()
+
+        if self.state is not None:
+            for record in migrations:
+                self.state.discard(record[0], record[1])
+
+    def close(self):
+        if self._cursor is not None:
+            self._cursor.close()
+            self._cursor = None
+
+        self.db.close()
 
     def __del__(self):
         if hasattr(self, 'db'):
-            self.db.close()
+            self.close()
 
 
 snaql_migration.add_command(show)
+snaql_migration.add_command(list_migrations)
+snaql_migration.add_command(plan)
+snaql_migration.add_command(preflight)
+snaql_migration.add_command(index)
+snaql_migration.add_command(check)
+snaql_migration.add_command(squash)
+snaql_migration.add_command(provision)
 snaql_migration.add_command(apply)
 snaql_migration.add_command(revert)
+snaql_migration.add_command(redo)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,81 @@
+"""
+Asyncio test cases (Python 3.5+), imported by test_aio, as coroutines are a SyntaxError on Python 2
+"""
+
+import asyncio
+
+import yaml
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+from snaql_migration.snaql_migration import DBWrapper
+from snaql_migration.aio import AsyncMigrator, _numbered
+
+
+@unittest.skipIf(asyncpg is None, 'asyncpg is not installed')
+class TestAsyncMigrator(unittest.TestCase):
+    def setUp(self):
+        with open('snaql_migration/tests/db_uri.yml', 'rb') as f:
+            self.db_uri = yaml.safe_load(f)['db_uri']
+
+        self.db = DBWrapper(self.db_uri)
+        self.db.query("DROP TABLE IF EXISTS users;")
+        self.db.query("DROP TABLE IF EXISTS roles CASCADE;")
+        self.db.query("DROP TABLE IF EXISTS snaql_migrations;")
+        self.db.query("DROP TABLE IF EXISTS snaql_migration_head;")
+        self.db.commit()
+
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        self.db.close()
+
+    def test_numbered_parameters(self):
+        self.assertEqual(_numbered('SELECT %s, %s, 100%%', ['a', 'b']), ('SELECT $1, $2, 100%', ['a', 'b']))
+        self.assertEqual(_numbered('WHERE id >= %(start)s AND id < %(end)s OR id = %(start)s', {'start': 1, 'end': 5}),
+                         ('WHERE id >= $1 AND id < $2 OR id = $1', [1, 5]))
+
+    def test_apply_revert(self):
+        ticks = []
+
+        async def ticker(done):
+            while not done.is_set():
+                ticks.append(1)
+                await asyncio.sleep(0.001)
+
+        async def migrate():
+            connection = await asyncpg.connect(self.db_uri.replace('postgres://', 'postgresql://', 1))
+            done = asyncio.Event()
+            ticking = asyncio.ensure_future(ticker(done))
+
+            try:
+                migrator = AsyncMigrator.from_path('snaql_migration/tests/users/migrations', 'users_app', connection)
+                applied = await migrator.apply('all')
+                planned = await migrator.plan('users_app/001-create-users', 'revert')
+                reverted = await migrator.revert('users_app/002-update-users')
+            finally:
+                done.set()
+                await ticking
+                await connection.close()
+
+            return applied, planned, reverted
+
+        applied, planned, reverted = self.loop.run_until_complete(migrate())
+
+        self.assertEqual([migration for app_name, migration in applied],
+                         ['001-create-users', '002-update-users', '003-create-index'])
+        self.assertEqual(len(planned), 3)
+        self.assertEqual(reverted, [('users_app', '003-create-index'), ('users_app', '002-update-users')])
+        self.assertTrue(ticks)  # the loop was not blocked
+
+        self.assertTrue(self.db.is_migration_applied('users_app', '001-create-users'))
+        self.assertFalse(self.db.is_migration_applied('users_app', '002-update-users'))
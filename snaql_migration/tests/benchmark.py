@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""
+Scalability benchmarks over synthetic migration trees:
+
+    $ python -m snaql_migration.tests.benchmark --db-uri postgres://test:@localhost/test \
+        --sizes 10,100,1000 --output baseline.json
+    $ python -m snaql_migration.tests.benchmark --db-uri postgres://test:@localhost/test \
+        --sizes 10,100,1000 --compare baseline.json
+
+Without --db-uri only offline steps (collect, config, load) are measured, sqlite:///bench.db could be used
+to measure database steps without a database server (but not in-memory SQLite, as every command has its own)
+"""
+
+import os
+import sys
+import json
+import shutil
+import platform
+import tempfile
+
+from datetime import datetime
+from timeit import default_timer
+
+import click
+
+from click.testing import CliRunner
+
+from snaql_migration.snaql_migration import snaql_migration, DBWrapper, MigrationLoader, _collect_migrations, \
+    _parse_config
+
+OFFLINE_STEPS = ('collect', 'config', 'load')
+DATABASE_STEPS = ('apply', 'show', 'revert')
+
+
+def generate_tree(root, db_uri, apps=10, migrations=10, blocks=2, fanout=1):
+    """
+    Writes apps with migrations of blocks (every apply block creates a table, chained by depends_on)
+    and migrations.yml to the root directory, every app depends on up to fanout previous apps.
+    Returns path of the config file
+    """
+    config = ['db_uri: "{0}"'.format(db_uri or ''), 'migrations:']
+
+    for app in range(apps):
+        app_name = 'app{0:04d}'.format(app)
+        path = os.path.join(root, app_name, 'migrations')
+        os.makedirs(path)
+
+        for migration in range(migrations):
+            name = '{0:05d}-migration'.format(migration)
+            tables = ['bench_{0}_{1}_{2}'.format(app, migration, block) for block in range(blocks)]
+
+            with open(os.path.join(path, name + '.apply.sql'), 'w') as f:
+                for block, table in enumerate(tables):
+                    depends_on = ", depends_on=['create{0}']".format(block - 1) if block else ''
+                    f.write("{{% sql 'create{0}'{1} %}}\n"
+                            "  CREATE TABLE {2} (id INT NOT NULL, title VARCHAR(100), PRIMARY KEY (id))\n"
+                            "{{% endsql %}}\n".format(block, depends_on, table))
+
+            with open(os.path.join(path, name + '.revert.sql'), 'w') as f:
+                for block, table in enumerate(reversed(tables)):
+                    depends_on = ", depends_on=['drop{0}']".format(block - 1) if block else ''
+                    f.write("{{% sql 'drop{0}'{1} %}}\n"
+                            "  DROP TABLE {2}\n"
+                            "{{% endsql %}}\n".format(block, depends_on, table))
+
+        dependencies = ['app{0:04d}'.format(dependency) for dependency in range(max(0, app - fanout), app)]
+        config.append('  {0}:'.format(app_name))
+        config.append('    path: "{0}"'.format(path.replace(os.sep, '/')))
+        if dependencies:
+            config.append('    depends_on: [{0}]'.format(', '.join(dependencies)))
+
+    config_file = os.path.join(root, 'migrations.yml')
+    with open(config_file, 'w') as f:
+        f.write('\n'.join(config) + '\n')
+
+    return config_file
+
+
+def best_of(repeat, function):
+    """
+    Returns the best time of repeated calls of the function (in seconds)
+    """
+    timings = []
+    for _ in range(repeat):
+        started = default_timer()
+        function()
+        timings.append(default_timer() - started)
+
+    return min(timings)
+
+
+def run_size(size, db_uri, apps, blocks, fanout, repeat):
+    """
+    Returns {step: seconds} for the tree of (about) size migrations
+    """
+    apps = min(apps, size)
+    root = tempfile.mkdtemp()
+
+    try:
+        config_file = generate_tree(root, db_uri, apps, max(1, size // apps), blocks, fanout)
+
+        with open(config_file, 'rb') as f:
+            config = _parse_config(f)
+
+        def collect():
+            for app in config['apps'].values():
+                _collect_migrations(app['path'])
+
+        def parse():
+            with open(config_file, 'rb') as f:
+                _parse_config(f)
+
+        def load():
+            for app in config['apps'].values():
+                loader = MigrationLoader(app['path'])
+                for migration in app['migrations']:
+                    loader.load(migration, 'apply')
+
+        results = {
+            'migrations': sum(len(app['migrations']) for app in config['apps'].values()),
+            'collect': best_of(repeat, collect),
+            'config': best_of(repeat, parse),
+            'load': best_of(repeat, load)
+        }
+
+        if db_uri:
+            results.update(run_database_steps(config_file, config, db_uri, repeat))
+
+        return results
+    finally:
+        shutil.rmtree(root)
+
+
+def run_database_steps(config_file, config, db_uri, repeat):
+    runner = CliRunner()
+    results = dict((step, None) for step in DATABASE_STEPS)
+
+    def invoke(*args):
+        started = default_timer()
+        result = runner.invoke(snaql_migration, ('--config', config_file) + args)
+        if result.exit_code != 0:
+            raise click.ClickException('"{0}" failed\n{1}'.format(' '.join(args), result.output))
+        return default_timer() - started
+
+    db = DBWrapper(db_uri)
+    try:
+        for table in ('snaql_migrations', 'snaql_migration_progress', 'snaql_migration_head'):
+            db.query('DROP TABLE IF EXISTS {0}'.format(table))
+        db.commit()
+    finally:
+        db.close()
+
+    for _ in range(repeat):
+        timings = {'apply': invoke('apply', 'all'), 'show': invoke('show'), 'revert': 0.0}
+
+        for app_name in reversed(list(config['apps'])):  # dependent apps first
+            timings['revert'] += invoke('revert', '{0}/{1}'.format(app_name, config['apps'][app_name]['migrations'][0]))
+
+        for step in DATABASE_STEPS:
+            results[step] = timings[step] if results[step] is None else min(results[step], timings[step])
+
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints ratios of results to baseline ones, returns number of steps slower than baseline * (1 + tolerance)
+    """
+    regressions = 0
+
+    for size, steps in sorted(results.items(), key=lambda item: int(item[0])):
+        for step in OFFLINE_STEPS + DATABASE_STEPS:
+            previous = baseline.get(size, {}).get(step)
+            if steps.get(step) is None or not previous:
+                continue
+
+            ratio = steps[step] / previous
+            regressed = ratio > 1 + tolerance
+            regressions += regressed
+
+            click.echo('{0:>6} {1:<8} {2:>9.3f}s {3:>9.3f}s {4:>6.2f}x{5}'.format(
+                size, step, previous, steps[step], ratio, click.style(' REGRESSION', fg='red') if regressed else ''))
+
+    return regressions
+
+
+@click.command()
+@click.option('--db-uri', default=None, help='Database for apply/show/revert steps, skipped if not set')
+@click.option('--sizes', default='10,100,1000', help='Comma separated total numbers of migrations')
+@click.option('--apps', default=10, type=click.IntRange(1), help='Number of apps')
+@click.option('--blocks', default=2, type=click.IntRange(1), help='Number of blocks per migration file')
+@click.option('--fanout', default=1, type=click.IntRange(0), help='Number of apps every app depends on')
+@click.option('--repeat', default=3, type=click.IntRange(1), help='Number of runs, the best one is reported')
+@click.option('--output', default=None, type=click.Path(dir_okay=False), help='File to save results to, as JSON')
+@click.option('--compare', 'baseline', default=None, type=click.File('r'),
+              help='Results file to compare with, exits with error on regressions')
+@click.option('--tolerance', default=0.25, help='Allowed slowdown against the baseline (0.25 is 25%)')
+def benchmark(db_uri, sizes, apps, blocks, fanout, repeat, output, baseline, tolerance):
+    """
+    Benchmark snaql-migration over synthetic migration trees
+    """
+
+    results = {}
+    for size in [int(size) for size in sizes.split(',')]:
+        click.echo(click.style('Benchmarking {0} migration(s)...'.format(size), fg='blue'))
+        results[str(size)] = run_size(size, db_uri, apps, blocks, fanout, repeat)
+
+        for step in OFFLINE_STEPS + DATABASE_STEPS:
+            if results[str(size)].get(step) is not None:
+                click.echo('  {0:<8} {1:>9.3f}s'.format(step, results[str(size)][step]))
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump({
+                'meta': {
+                    'time': datetime.now().isoformat(),
+                    'python': platform.python_version(),
+                    'platform': platform.platform(),
+                    'database': db_uri.split(':', 1)[0] if db_uri else None,
+                    'apps': apps,
+                    'blocks': blocks,
+                    'fanout': fanout,
+                    'repeat': repeat
+                },
+                'results': results
+            }, f, indent=2, sort_keys=True)
+
+    if baseline is not None:
+        regressions = compare(results, json.load(baseline)['results'], tolerance)
+        if regressions:
+            raise click.ClickException('{0} step(s) regressed'.format(regressions))
+
+
+if __name__ == '__main__':
+    benchmark(sys.argv[1:])
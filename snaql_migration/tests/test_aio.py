@@ -0,0 +1,13 @@
+import sys
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+if sys.version_info >= (3, 5):
+    from snaql_migration.tests.aio_cases import TestAsyncMigrator  # noqa: F401
+else:
+    @unittest.skip('Python 3.5+ only')
+    class TestAsyncMigrator(unittest.TestCase):
+        pass
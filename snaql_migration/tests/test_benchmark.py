@@ -0,0 +1,37 @@
+import shutil
+import tempfile
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from snaql_migration.snaql_migration import _parse_config, _apps_order
+from snaql_migration.tests.benchmark import generate_tree, run_size, OFFLINE_STEPS
+
+
+class TestBenchmark(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_generate_tree(self):
+        config_file = generate_tree(self.root, 'postgres://localhost/test', apps=4, migrations=3, blocks=2, fanout=2)
+
+        with open(config_file, 'rb') as f:
+            config = _parse_config(f)
+
+        self.assertEqual(len(config['apps']), 4)
+        self.assertEqual(config['apps']['app0001']['migrations'],
+                         ['00000-migration', '00001-migration', '00002-migration'])
+        self.assertEqual(config['apps']['app0003']['depends_on'], ['app0001', 'app0002'])
+        self.assertEqual(_apps_order(config['apps']), ['app0000', 'app0001', 'app0002', 'app0003'])
+
+    def test_offline_steps(self):
+        results = run_size(20, None, apps=5, blocks=2, fanout=1, repeat=1)
+
+        self.assertEqual(results['migrations'], 20)
+        for step in OFFLINE_STEPS:
+            self.assertGreaterEqual(results[step], 0)
@@ -0,0 +1,72 @@
+import os
+import shutil
+import tempfile
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+from snaql_migration.snaql_migration import TemplateCache, MigrationLoader
+
+
+class TestCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.migrations_dir = tempfile.mkdtemp()
+
+        shutil.copy('snaql_migration/tests/users/migrations/001-create-users.apply.sql', self.migrations_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        shutil.rmtree(self.migrations_dir)
+
+    def test_cache_invalidation(self):
+        cache = TemplateCache(self.cache_dir)
+
+        cache.set('some/path.sql', 'digest1', [('block', 'SELECT 1')])
+        self.assertEqual(cache.get('some/path.sql', 'digest1'), [('block', 'SELECT 1')])
+        self.assertIsNone(cache.get('some/path.sql', 'digest2'))
+        self.assertIsNone(cache.get('other/path.sql', 'digest1'))
+
+    def test_cache_eviction(self):
+        cache = TemplateCache(self.cache_dir, max_entries=2)
+
+        for i in range(5):
+            cache.set('path{0}.sql'.format(i), 'digest', [])
+
+        self.assertEqual(len(os.listdir(self.cache_dir)), 2)
+
+    def test_cache_eviction_scans(self):
+        cache = TemplateCache(self.cache_dir, max_entries=100)
+        list_entries, scans = cache._list_entries, []
+
+        def counted():
+            scans.append(1)
+            return list_entries()
+
+        cache._list_entries = counted
+
+        for i in range(300):
+            cache.set('path{0}.sql'.format(i), 'digest', [])
+
+        self.assertLessEqual(len(os.listdir(self.cache_dir)), 100)
+        self.assertLessEqual(len(scans), 1 + 300 // 10)  # not once per write
+
+    def test_loader(self):
+        loader = MigrationLoader(self.migrations_dir, TemplateCache(self.cache_dir))
+
+        blocks = loader.load('001-create-users', 'apply')
+        self.assertEqual([name for name, sql in blocks], ['create_roles', 'create_users'])
+        self.assertTrue(blocks[1][1].startswith('CREATE TABLE users'))
+
+        # cached one is the same
+        self.assertEqual(loader.load('001-create-users', 'apply'), blocks)
+        self.assertEqual(MigrationLoader(self.migrations_dir, TemplateCache(self.cache_dir))
+                         .load('001-create-users', 'apply'), blocks)
+
+        # changed file is reloaded
+        with open(os.path.join(self.migrations_dir, '001-create-users.apply.sql'), 'w') as f:
+            f.write("{% sql 'create_roles' %}\n  CREATE TABLE roles (id INT)\n{% endsql %}\n")
+
+        self.assertEqual(loader.load('001-create-users', 'apply'), [('create_roles', 'CREATE TABLE roles (id INT)')])
@@ -1,3 +1,11 @@
+import os
+import sys
+import json
+import shutil
+import tempfile
+import functools
+import threading
+
 import yaml
 
 try:
@@ -5,56 +13,104 @@ try:
 except ImportError:
     import unittest
 
+from click import ClickException
 from click.testing import CliRunner
 
-from snaql_migration.snaql_migration import DBWrapper, snaql_migration
+from snaql_migration.snaql_migration import DBWrapper, BlockExecutionError, Migrator, MigrationLoader, \
+    snaql_migration, LOCK_ID
 
 
-class TestMigrations(unittest.TestCase):
-    CONFIG_VALID = 'snaql_migration/tests/config.yml'
-    CONFIG_INVALID = 'snaql_migration/tests/config_broken.yml'
+def postgres_only(test):
+    @functools.wraps(test)
+    def wrapper(self):
+        if self.db.scheme != 'postgres':
+            self.skipTest('PostgreSQL only')
+        return test(self)
+
+    return wrapper
 
+
+class TestMigrations(unittest.TestCase):
     def setUp(self):
         self.runner = CliRunner()
-
-        with open('snaql_migration/tests/db_uri.yml', 'rb') as f:
-            self.db_uri = yaml.load(f)['db_uri']
+        self.db_uri = self.database_uri()
+        self.config_dir = tempfile.mkdtemp()
+        self.config_valid = os.path.join(self.config_dir, 'config.yml')
+        self.config_invalid = os.path.join(self.config_dir, 'config_broken.yml')
 
         try:
             self.db = DBWrapper(self.db_uri)
         except Exception:
+            shutil.rmtree(self.config_dir)
             self.fail("Unable to connect to database")
 
         # generating config files
-        with open(TestMigrations.CONFIG_VALID, 'w') as f:
+        with open(self.config_valid, 'w') as f:
             f.writelines('db_uri: "{0}"\r\n'
                          'migrations:\r\n'
                          '    users_app: "snaql_migration/tests/users/migrations"\r\n'
                          '    countries_app: "snaql_migration/tests/countries/migrations"'.format(self.db_uri))
 
-        with open(TestMigrations.CONFIG_INVALID, 'w') as f:  # points to broken migrations
+        with open(self.config_invalid, 'w') as f:  # points to broken migrations
             f.writelines('db_uri: "{0}"\r\n'
                          'migrations:\r\n'
                          '    users_app: "snaql_migration/tests/users/migrations_broken"\r\n'.format(self.db_uri))
 
         # initial db cleanup
         self.db.query("DROP TABLE IF EXISTS users;")
-        self.db.query("DROP TABLE IF EXISTS roles CASCADE;")
+        self.db.query("DROP TABLE IF EXISTS roles CASCADE;" if self.db.scheme == 'postgres' else
+                      "DROP TABLE IF EXISTS roles;")
         self.db.query("DROP TABLE IF EXISTS countries;")
         self.db.query("DROP TABLE IF EXISTS snaql_migrations;")
+        self.db.query("DROP TABLE IF EXISTS snaql_migration_head;")
+        self.db.query("DROP TABLE IF EXISTS snaql_migration_progress;")
+        self.db.query("DROP TABLE IF EXISTS items;")
         self.db.query("DROP INDEX IF EXISTS idx1;")
 
         self.db.commit()
 
+    def tearDown(self):
+        self.db.close()
+        shutil.rmtree(self.config_dir)
+
+    def database_uri(self):
+        with open('snaql_migration/tests/db_uri.yml', 'rb') as f:
+            return yaml.safe_load(f)['db_uri']
+
+    def find_table(self, name):
+        if self.db.scheme == 'sqlite':
+            return self.db.query_one("SELECT * FROM sqlite_master WHERE type='table' AND name=%s", [name])
+
+        return self.db.query_one("SELECT * FROM pg_catalog.pg_tables WHERE tablename=%s", [name])
+
+    def find_index(self, name):
+        if self.db.scheme == 'sqlite':
+            return self.db.query_one("SELECT * FROM sqlite_master WHERE type='index' AND name=%s", [name])
+
+        return self.db.query_one("SELECT * FROM pg_catalog.pg_indexes WHERE indexname=%s", [name])
+
     def test_migrations_table_creation(self):
         self.db._prepare_migrations_table()
 
-        self.assertIsNotNone(self.db.query_one(
-            "SELECT * FROM pg_catalog.pg_tables "
-            "WHERE tablename='snaql_migrations';"))
+        self.assertIsNotNone(self.find_table('snaql_migrations'))
+
+    def test_load_state(self):
+        self.runner.invoke(snaql_migration, ['--config', self.config_valid, 'apply', 'all'])
+
+        state = self.db.load_state()
+        self.assertTrue(state.is_applied('users_app', '003-create-index'))
+        self.assertTrue(state.is_applied('countries_app', '001-create-countries'))
+        self.assertFalse(state.is_applied('users_app', '004-unknown'))
+
+        state = self.db.load_state('users_app')
+        self.assertEqual(state.applied('users_app'), {'001-create-users', '002-update-users', '003-create-index'})
+        self.assertFalse(state.is_applied('countries_app', '001-create-countries'))
+
+        self.db.revert_migration('users_app', '003-create-index')
+        self.assertFalse(state.is_applied('users_app', '003-create-index'))
 
     def test_migrations_show(self):
-        result = self.runner.invoke(snaql_migration, ['--config', TestMigrations.CONFIG_VALID, 'show'])
+        result = self.runner.invoke(snaql_migration, ['--config', self.config_valid, 'show'])
         self.assertEqual(result.exit_code, 0)
         self.assertIn('users_app', result.output)
         self.assertIn('countries_app', result.output)
@@ -71,50 +127,81 @@ class TestMigrations(unittest.TestCase):
         self.assertIn('002-update-users', result.output)
 
     def test_apply_all(self):
-        result = self.runner.invoke(snaql_migration, ['--config', TestMigrations.CONFIG_VALID, 'apply', 'all'])
+        result = self.runner.invoke(snaql_migration, ['--config', self.config_valid, 'apply', 'all'])
 
         self.assertEqual(result.exit_code, 0)
 
-        self.assertIsNotNone(self.db.query_one(
-            "SELECT * FROM pg_catalog.pg_tables "
-            "WHERE tablename='countries';"))
+        self.assertIsNotNone(self.find_table('countries'))
 
-        self.assertIsNotNone(self.db.query_one(
-            "SELECT * FROM pg_catalog.pg_tables "
-            "WHERE tablename='users';"))
+        self.assertIsNotNone(self.find_table('users'))
 
-        self.assertIsNotNone(self.db.query_one(
-            "SELECT * FROM pg_catalog.pg_indexes "
-            "WHERE indexname='idx1';"))
+        self.assertIsNotNone(self.find_index('idx1'))
 
         self.assertTrue(self.db.is_migration_applied('countries_app', '001-create-countries'))
         self.assertTrue(self.db.is_migration_applied('users_app', '001-create-users'))
 
+    @postgres_only
+    def test_apply_all_parallel(self):
+        with open(self.config_valid, 'w') as f:
+            f.writelines('db_uri: "{0}"\r\n'
+                         'migrations:\r\n'
+                         '    users_app:\r\n'
+                         '        path: "snaql_migration/tests/users/migrations"\r\n'
+                         '        depends_on: [countries_app]\r\n'
+                         '    countries_app: "snaql_migration/tests/countries/migrations"'.format(self.db_uri))
+
+        module = sys.modules[Migrator.__module__]
+        connect, connections = module._connect, []
+
+        def recording_connect(*args, **kwargs):
+            connections.append(connect(*args, **kwargs))
+            return connections[-1]
+
+        module._connect = recording_connect
+        try:
+            result = self.runner.invoke(snaql_migration,
+                                        ['--config', self.config_valid, 'apply', '--jobs', '2', 'all'])
+        finally:
+            module._connect = connect
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertLess(result.output.index('[countries_app]   OK.'), result.output.index('[users_app] Applying'))
+        self.assertGreater(len(connections), 1)
+        self.assertTrue(all(db.db.closed for db in connections[1:]))  # the first one is of Migrator, not of workers
+
+        self.assertTrue(self.db.is_migration_applied('countries_app', '001-create-countries'))
+        self.assertTrue(self.db.is_migration_applied('users_app', '003-create-index'))
+
+    @postgres_only
+    def test_apply_broken_parallel(self):
+        result = self.runner.invoke(snaql_migration,
+                                    ['--config', self.config_invalid, 'apply', '--jobs', '2', 'all'])
+
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertTrue(self.db.is_migration_applied('users_app', '001-create-roles'))
+        self.assertFalse(self.db.is_migration_applied('users_app', '002-create-users'))
+
     def test_apply_specific(self):
         result = self.runner.invoke(snaql_migration,
-                                    ['--config', TestMigrations.CONFIG_VALID, 'apply', 'users_app/002-update-users'])
+                                    ['--config', self.config_valid, 'apply', 'users_app/002-update-users'])
 
         self.assertEqual(result.exit_code, 0)
 
-        self.assertIsNone(self.db.query_one(
-            "SELECT * FROM pg_catalog.pg_indexes "
-            "WHERE indexname='idx1';"))
+        self.assertIsNone(self.find_index('idx1'))
 
         self.assertTrue(self.db.is_migration_applied('users_app', '001-create-users'))
         self.assertTrue(self.db.is_migration_applied('users_app', '002-update-users'))
         self.assertFalse(self.db.is_migration_applied('users_app', '003-create-index'))
 
     def test_revert(self):
-        self.runner.invoke(snaql_migration, ['--config', TestMigrations.CONFIG_VALID, 'apply', 'all'])
+        self.runner.invoke(snaql_migration, ['--config', self.config_valid, 'apply', 'all'])
 
         result = self.runner.invoke(snaql_migration,
-                                    ['--config', TestMigrations.CONFIG_VALID, 'revert', 'users_app/002-update-users'])
+                                    ['--config', self.config_valid, 'revert', 'users_app/002-update-users'])
 
         self.assertEqual(result.exit_code, 0)
 
-        self.assertIsNone(self.db.query_one(
-            "SELECT * FROM pg_catalog.pg_indexes "
-            "WHERE indexname='idx1';"))
+        self.assertIsNone(self.find_index('idx1'))
 
         self.assertFalse(self.db.is_migration_applied('users_app', '003-create-index'))
         self.assertFalse(self.db.is_migration_applied('users_app', '002-update-users'))
@@ -122,36 +209,772 @@ class TestMigrations(unittest.TestCase):
 
     def test_apply_broken(self):
         result = self.runner.invoke(snaql_migration,
-                                    ['--config', TestMigrations.CONFIG_INVALID, 'apply', 'all'])
+                                    ['--config', self.config_invalid, 'apply', 'all'])
 
         self.assertNotEqual(result.exit_code, 0)
 
-        self.assertIsNone(self.db.query_one(
-            "SELECT * FROM pg_catalog.pg_tables "
-            "WHERE tablename='users';"))
+        self.assertIsNone(self.find_table('users'))
 
-        self.assertIsNotNone(self.db.query_one(
-            "SELECT * FROM pg_catalog.pg_tables "
-            "WHERE tablename='roles';"))
+        self.assertIsNotNone(self.find_table('roles'))
 
         self.assertTrue(self.db.is_migration_applied('users_app', '001-create-roles'))
         self.assertFalse(self.db.is_migration_applied('users_app', '002-create-users'))
 
     def test_revert_broken(self):
-        self.runner.invoke(snaql_migration, ['--config', TestMigrations.CONFIG_INVALID, 'apply', 'all'])
+        self.runner.invoke(snaql_migration, ['--config', self.config_invalid, 'apply', 'all'])
 
         result = self.runner.invoke(snaql_migration,
-                                    ['--config', TestMigrations.CONFIG_INVALID, 'revert', 'users_app/001-create-roles'])
+                                    ['--config', self.config_invalid, 'revert', 'users_app/001-create-roles'])
 
         self.assertNotEqual(result.exit_code, 0)
 
-        self.assertIsNotNone(self.db.query_one(
-            "SELECT * FROM pg_catalog.pg_tables "
-            "WHERE tablename='roles';"))
+        self.assertIsNotNone(self.find_table('roles'))
 
-        self.assertIsNone(self.db.query_one(
-            "SELECT * FROM pg_catalog.pg_tables "
-            "WHERE tablename='users';"))
+        self.assertIsNone(self.find_table('users'))
 
         self.assertTrue(self.db.is_migration_applied('users_app', '001-create-roles'))
         self.assertFalse(self.db.is_migration_applied('users_app', '002-create-users'))
+
+    def test_apply_atomic(self):
+        result = self.runner.invoke(snaql_migration,
+                                    ['--config', self.config_valid, 'apply', '--atomic', 'all'])
+
+        self.assertEqual(result.exit_code, 0)
+
+        self.assertIsNotNone(self.find_index('idx1'))
+
+        self.assertTrue(self.db.is_migration_applied('countries_app', '001-create-countries'))
+        self.assertTrue(self.db.is_migration_applied('users_app', '003-create-index'))
+
+        result = self.runner.invoke(snaql_migration,
+                                    ['--config', self.config_valid, 'revert', '--atomic',
+                                     'users_app/002-update-users'])
+
+        self.assertEqual(result.exit_code, 0)
+
+        self.assertFalse(self.db.is_migration_applied('users_app', '003-create-index'))
+        self.assertFalse(self.db.is_migration_applied('users_app', '002-update-users'))
+        self.assertTrue(self.db.is_migration_applied('users_app', '001-create-users'))
+
+    def test_apply_atomic_broken(self):
+        result = self.runner.invoke(snaql_migration,
+                                    ['--config', self.config_invalid, 'apply', '--atomic', 'all'])
+
+        self.assertNotEqual(result.exit_code, 0)
+
+        # everything is rolled back, including the first (valid) migration
+        self.assertIsNone(self.find_table('roles'))
+
+        self.assertFalse(self.db.is_migration_applied('users_app', '001-create-roles'))
+        self.assertFalse(self.db.is_migration_applied('users_app', '002-create-users'))
+
+    def test_execute_blocks_batch(self):
+        self.db.execute_blocks([('create_roles', 'CREATE TABLE roles (id INT NOT NULL, PRIMARY KEY (id));'),
+                                ('create_users', 'CREATE TABLE users (id INT NOT NULL)'),
+                                ('alter_users', 'ALTER TABLE users ADD COLUMN role_id INT')], batch_size=2)
+        self.db.commit()
+
+        self.assertIsNotNone(self.find_table('users'))
+
+        with self.assertRaises(BlockExecutionError) as cm:
+            self.db.execute_blocks([('insert_roles', 'INSERT INTO roles VALUES (1)'),
+                                    ('broken_insert', 'INSERT INTO rolez VALUES (2)'),
+                                    ('insert_users', 'INSERT INTO users VALUES (1, 1)')], batch_size=3)
+        self.db.rollback()
+
+        self.assertEqual(cm.exception.block_name, 'broken_insert')
+
+        # savepoints of successful batches are released
+        self.db.execute_blocks([('select{0}'.format(i), 'SELECT {0}'.format(i)) for i in range(200)], batch_size=2)
+        self.assertRaises(Exception, self.db.query, 'RELEASE SAVEPOINT snaql_batch')
+        self.db.rollback()
+
+    def test_apply_batch(self):
+        result = self.runner.invoke(snaql_migration,
+                                    ['--config', self.config_valid, 'apply', '--batch-size', '10', 'all'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertTrue(self.db.is_migration_applied('users_app', '003-create-index'))
+
+        result = self.runner.invoke(snaql_migration,
+                                    ['--config', self.config_valid, 'revert', '--batch-size', '10',
+                                     'users_app/001-create-users'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIsNone(self.find_table('roles'))
+
+    def _schema(self):
+        if self.db.scheme == 'sqlite':
+            return (self.db.query_all("SELECT name, sql FROM sqlite_master WHERE tbl_name IN ('users', 'roles') "
+                                      "ORDER BY name"),
+                    [self.db.query_all("PRAGMA table_info({0})".format(table)) for table in ('users', 'roles')])
+
+        return (self.db.query_all("SELECT table_name, column_name, data_type, is_nullable "
+                                  "FROM information_schema.columns "
+                                  "WHERE table_schema='public' AND table_name IN ('users', 'roles') "
+                                  "ORDER BY table_name, column_name"),
+                self.db.query_all("SELECT tablename, indexname, indexdef FROM pg_catalog.pg_indexes "
+                                  "WHERE tablename IN ('users', 'roles') ORDER BY indexname"))
+
+    def test_squash(self):
+        migrations_dir = os.path.join(tempfile.mkdtemp(), 'migrations')
+        shutil.copytree('snaql_migration/tests/users/migrations', migrations_dir)
+        args = ['--db-uri', self.db_uri, '--migrations', migrations_dir, '--app', 'users_app']
+
+        try:
+            # full replay
+            result = self.runner.invoke(snaql_migration, args + ['apply', 'all'])
+            self.assertEqual(result.exit_code, 0)
+            replayed = self._schema()
+
+            result = self.runner.invoke(snaql_migration, args + ['revert', 'users_app/001-create-users'])
+            self.assertEqual(result.exit_code, 0)
+
+            result = self.runner.invoke(snaql_migration, args + ['squash', 'users_app/002-update-users'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertTrue(os.path.isfile(os.path.join(migrations_dir, '002-update-users.baseline.sql')))
+
+            # bootstrap from baseline
+            result = self.runner.invoke(snaql_migration, args + ['apply', 'all'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn('Applying baseline of 2 migration(s)', result.output)
+            self.assertNotIn('Applying 001-create-users', result.output)
+            self.assertEqual(self._schema(), replayed)
+
+            self.assertTrue(self.db.is_migration_applied('users_app', '001-create-users'))
+            self.assertTrue(self.db.is_migration_applied('users_app', '002-update-users'))
+            self.assertTrue(self.db.is_migration_applied('users_app', '003-create-index'))
+
+            # existing databases replay migrations as usual
+            result = self.runner.invoke(snaql_migration, args + ['revert', 'users_app/002-update-users'])
+            self.assertEqual(result.exit_code, 0)
+
+            result = self.runner.invoke(snaql_migration, args + ['apply', 'all'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertNotIn('baseline', result.output)
+            self.assertIn('Applying 002-update-users', result.output)
+            self.assertEqual(self._schema(), replayed)
+        finally:
+            shutil.rmtree(os.path.dirname(migrations_dir))
+
+    @postgres_only
+    def test_provision(self):
+        migrations_dir = os.path.join(tempfile.mkdtemp(), 'migrations')
+        shutil.copytree('snaql_migration/tests/users/migrations', migrations_dir)
+        args = ['--db-uri', self.db_uri, '--migrations', migrations_dir, '--app', 'users_app']
+
+        def databases():
+            return set(row[0] for row in self.db.query_all("SELECT datname FROM pg_database"))
+
+        try:
+            result = self.runner.invoke(snaql_migration, args + ['provision', 'snaql_provisioned'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn('Building template', result.output)
+
+            provisioned = DBWrapper(self.db_uri.rsplit('/', 1)[0] + '/snaql_provisioned')
+            self.assertTrue(provisioned.is_migration_applied('users_app', '003-create-index'))
+            self.assertIsNotNone(provisioned.query_one("SELECT * FROM pg_catalog.pg_indexes "
+                                                       "WHERE indexname='idx1';"))
+            provisioned.close()
+
+            # template is reused
+            result = self.runner.invoke(snaql_migration, args + ['provision', '--replace', 'snaql_provisioned'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertNotIn('Building template', result.output)
+            templates = set(db for db in databases() if '_tpl_' in db)
+            self.assertEqual(len(templates), 1)
+
+            # changed migrations make a new template, evicting the stale one
+            with open(os.path.join(migrations_dir, '003-create-index.apply.sql'), 'a') as f:
+                f.write('\n')
+
+            result = self.runner.invoke(snaql_migration, args + ['provision', '--replace', 'snaql_provisioned'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn('Building template', result.output)
+            self.assertIn('Dropping stale template', result.output)
+            self.assertEqual(len(set(db for db in databases() if '_tpl_' in db) - templates), 1)
+            self.assertFalse(templates & databases())
+        finally:
+            shutil.rmtree(os.path.dirname(migrations_dir))
+
+            self.db.set_autocommit(True)
+            for database in databases():
+                if database == 'snaql_provisioned' or '_tpl_' in database:
+                    self.db.query('DROP DATABASE IF EXISTS "{0}"'.format(database))
+            self.db.set_autocommit(False)
+
+    def test_timings(self):
+        event_log = tempfile.NamedTemporaryFile(suffix='.jsonl', delete=False)
+        event_log.close()
+
+        try:
+            result = self.runner.invoke(snaql_migration, ['--config', self.config_valid,
+                                                          '--event-log', event_log.name, 'apply', 'all'])
+            self.assertEqual(result.exit_code, 0)
+
+            with open(event_log.name) as f:
+                events = [json.loads(line) for line in f]
+        finally:
+            os.remove(event_log.name)
+
+        kinds = set(event['event'] for event in events)
+        self.assertTrue(set(['render', 'block', 'commit', 'bookkeeping', 'migration']) <= kinds)
+
+        blocks = [event for event in events if event['event'] == 'block' and event['block'] == 'create_users']
+        self.assertEqual(len(blocks), 1)
+        self.assertEqual(blocks[0]['app'], 'users_app')
+        self.assertEqual(blocks[0]['migration'], '001-create-users')
+        self.assertEqual(blocks[0]['status'], 'ok')
+        self.assertGreaterEqual(blocks[0]['duration'], 0)
+
+        durations = self.db.load_durations()
+        self.assertIsNotNone(durations[('users_app', '001-create-users')])
+
+        result = self.runner.invoke(snaql_migration, ['--config', self.config_valid, 'show', '--timings'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('Slowest migrations', result.output)
+        self.assertIn('s users_app/001-create-users', result.output)
+
+    def test_migrations_table_upgrade(self):
+        self.db.query('CREATE TABLE snaql_migrations ('
+                      'app VARCHAR(50) NOT NULL,'
+                      'migration VARCHAR(50) NOT NULL,'
+                      'applied TIMESTAMP NOT NULL,'
+                      'PRIMARY KEY (app, migration))')
+        self.db.commit()
+
+        self.db._prepare_migrations_table()
+        self.db.fix_migration('users_app', '001-create-users', 1.5)
+
+        self.assertEqual(self.db.load_durations(), {('users_app', '001-create-users'): 1.5})
+
+    @postgres_only
+    def test_lock_timeout_retry(self):
+        with open(self.config_valid, 'w') as f:
+            f.writelines('db_uri: "{0}"\r\n'
+                         'lock_timeout: 100ms\r\n'
+                         'migrations:\r\n'
+                         '    users_app:\r\n'
+                         '        path: "snaql_migration/tests/users/migrations"\r\n'
+                         '        retries: 10\r\n'
+                         '        retry_delay: 0.1\r\n'
+                         '        retry_max_delay: 0.2\r\n'.format(self.db_uri))
+
+        result = self.runner.invoke(snaql_migration,
+                                    ['--config', self.config_valid, 'apply', 'users_app/001-create-users'])
+        self.assertEqual(result.exit_code, 0)
+
+        # lock held by "live traffic" is released in a while
+        self.db.query('LOCK TABLE users IN ACCESS EXCLUSIVE MODE')
+        release = threading.Timer(0.5, self.db.rollback)
+        release.start()
+
+        try:
+            result = self.runner.invoke(snaql_migration, ['--config', self.config_valid,
+                                                          'apply', '--verbose', 'users_app/002-update-users'])
+        finally:
+            release.join()
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn("SET LOCAL lock_timeout = '100ms'", result.output)
+        self.assertIn('LOCK TIMEOUT, retrying', result.output)
+        self.assertTrue(self.db.is_migration_applied('users_app', '002-update-users'))
+
+    def test_chunked_resume(self):
+        migrations_dir = tempfile.mkdtemp()
+        args = ['--db-uri', self.db_uri, '--migrations', migrations_dir, '--app', 'items_app']
+        backfill = ("{{# snaql backfill: chunk_table=items chunk_key=id chunk_size=10 #}}\n"
+                    "{{% sql 'add_column' %}}\n"
+                    "  ALTER TABLE items ADD COLUMN doubled INT CHECK (doubled <= 100)\n"
+                    "{{% endsql %}}\n"
+                    "{{% sql 'backfill', depends_on=['add_column'] %}}\n"
+                    "  UPDATE items SET counter = counter + 1, doubled = {0}\n"
+                    "  WHERE id >= %(chunk_start)s AND id < %(chunk_end)s\n"
+                    "{{% endsql %}}")
+
+        with open(os.path.join(migrations_dir, '001-create-items.apply.sql'), 'w') as f:
+            f.write("{% sql 'create_items' %}\n"
+                    "  CREATE TABLE items (id INT NOT NULL PRIMARY KEY, counter INT NOT NULL DEFAULT 0)\n"
+                    "{% endsql %}\n"
+                    "{% sql 'fill_items', depends_on=['create_items'] %}\n"
+                    "  WITH RECURSIVE ids(id) AS (SELECT 1 UNION ALL SELECT id + 1 FROM ids WHERE id < 100)\n"
+                    "  INSERT INTO items (id) SELECT id FROM ids\n"
+                    "{% endsql %}")
+        with open(os.path.join(migrations_dir, '002-backfill-items.apply.sql'), 'w') as f:
+            f.write(backfill.format('id * 2'))  # fails on the 6th chunk
+        for migration in ('001-create-items', '002-backfill-items'):
+            with open(os.path.join(migrations_dir, migration + '.revert.sql'), 'w') as f:
+                f.write("{% sql 'noop' %}\n  SELECT 1\n{% endsql %}")
+
+        try:
+            result = self.runner.invoke(snaql_migration, args + ['apply', 'all'])
+            self.assertEqual(result.exit_code, 1)
+            self.assertFalse(self.db.is_migration_applied('items_app', '002-backfill-items'))
+            self.assertEqual(self.db.query_one('SELECT SUM(counter) FROM items')[0], 50)  # first chunks are kept
+
+            with open(os.path.join(migrations_dir, '002-backfill-items.apply.sql'), 'w') as f:
+                f.write(backfill.format('id'))
+
+            result = self.runner.invoke(snaql_migration, args + ['apply', '--verbose', 'all'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn('add_column: done by the previous run', result.output)
+            self.assertIn('backfill: resuming from id=51', result.output)
+            self.assertIn('backfill: 50 row(s) in 5 chunk(s)', result.output)
+
+            self.assertTrue(self.db.is_migration_applied('items_app', '002-backfill-items'))
+            self.assertEqual(self.db.query_all('SELECT DISTINCT counter FROM items'), [(1,)])
+            self.assertEqual(self.db.query_one('SELECT COUNT(*) FROM items WHERE doubled = id AND id > 50')[0],
+                             50)
+            self.assertEqual(self.db.query_all('SELECT * FROM snaql_migration_progress'), [])
+        finally:
+            shutil.rmtree(migrations_dir)
+
+    def test_data_blocks(self):
+        migrations_dir = tempfile.mkdtemp()
+        args = ['--db-uri', self.db_uri, '--migrations', migrations_dir, '--app', 'items_app']
+
+        if self.db.scheme == 'postgres':
+            load = "COPY items (id, title) FROM STDIN WITH (FORMAT csv, HEADER true)"
+        else:
+            load = "INSERT INTO items (id, title) VALUES (%s, %s)"
+
+        with open(os.path.join(migrations_dir, '001-load-items.apply.sql'), 'w') as f:
+            f.write("{{# snaql load_items: data=items.csv header buffer_size=1024 batch_rows=100 #}}\n"
+                    "{{% sql 'create_items' %}}\n"
+                    "  CREATE TABLE items (id INT NOT NULL PRIMARY KEY, title VARCHAR(100))\n"
+                    "{{% endsql %}}\n"
+                    "{{% sql 'load_items', depends_on=['create_items'] %}}\n"
+                    "  {0}\n"
+                    "{{% endsql %}}".format(load))
+        with open(os.path.join(migrations_dir, '001-load-items.revert.sql'), 'w') as f:
+            f.write("{% sql 'drop_items' %}\n  DROP TABLE items\n{% endsql %}")
+
+        def write_data(broken_id=None):
+            with open(os.path.join(migrations_dir, 'items.csv'), 'w') as f:
+                f.write('id,title\n')
+                for i in range(1, 5001):
+                    f.write('{0},"item {1}, #{1}"\n'.format(i if i != broken_id else 1, i) if i % 10 else
+                            '{0},\n'.format(i))
+
+        try:
+            write_data(broken_id=4001)  # duplicated key, everything is rolled back
+            result = self.runner.invoke(snaql_migration, args + ['apply', 'all'])
+            self.assertEqual(result.exit_code, 1)
+            self.assertIn('block "load_items" failed', result.output)
+            self.assertIsNone(self.find_table('items'))
+
+            write_data()
+            result = self.runner.invoke(snaql_migration, args + ['apply', 'all'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertEqual(self.db.query_one('SELECT COUNT(*), COUNT(title) FROM items'), (5000, 4500))
+            self.assertEqual(self.db.query_one('SELECT title FROM items WHERE id = 42')[0], 'item 42, #42')
+
+            # squashed migrations keep loading the data
+            self.assertEqual(self.runner.invoke(snaql_migration, args + ['squash', 'items_app/001-load-items'])
+                             .exit_code, 0)
+            with open(os.path.join(migrations_dir, '001-load-items.baseline.sql')) as f:
+                self.assertIn('{# snaql 001-load-items/load_items: batch_rows=100 buffer_size=1024 data=items.csv '
+                              'header #}', f.read())
+
+            self.assertEqual(self.runner.invoke(snaql_migration, args + ['revert', 'items_app/001-load-items'])
+                             .exit_code, 0)
+
+            result = self.runner.invoke(snaql_migration, args + ['apply', 'all'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn('Applying baseline', result.output)
+            self.assertEqual(self.db.query_one('SELECT COUNT(*) FROM items')[0], 5000)
+
+            # local files are sent to the server only if it's enabled in db_uri
+            with self.assertRaises(ClickException) as cm:
+                self.db.load_data('load_local', 'LOAD DATA LOCAL INFILE %(data_file)s INTO TABLE items',
+                                  {'data': os.path.join(migrations_dir, 'items.csv')})
+            self.assertIn('?local_infile=1', cm.exception.message)
+        finally:
+            shutil.rmtree(migrations_dir)
+
+    def test_emit_sql(self):
+        script = tempfile.NamedTemporaryFile(mode='w', suffix='.sql', delete=False)
+        script.close()
+
+        try:
+            result = self.runner.invoke(snaql_migration, ['--config', self.config_valid, 'apply',
+                                                          'countries_app/001-create-countries'])
+            self.assertEqual(result.exit_code, 0)
+
+            result = self.runner.invoke(snaql_migration, ['--config', self.config_valid, 'plan',
+                                                          '--emit-sql', script.name, 'all'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertEqual(result.output, '')
+
+            with open(script.name) as f:
+                sql = f.read()
+            self.assertNotIn('CREATE TABLE countries', sql)
+
+            self.db.query(sql)  # what psql -f or mysql < would do
+            self.db.commit()
+
+            self.assertIsNotNone(self.find_index('idx1'))
+            self.assertTrue(self.db.is_migration_applied('users_app', '003-create-index'))
+            self.assertEqual(self.db.load_checksums('users_app')[('users_app', '003-create-index')],
+                             MigrationLoader('snaql_migration/tests/users/migrations').checksum('003-create-index'))
+
+            result = self.runner.invoke(snaql_migration, ['--config', self.config_valid, 'apply', 'all'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn('Database is up to date.', result.output)
+        finally:
+            os.remove(script.name)
+
+    def test_redo(self):
+        migrations_dir = tempfile.mkdtemp()
+        args = ['--db-uri', self.db_uri, '--migrations', migrations_dir, '--app', 'items_app']
+        files = {
+            '001-create-items': ('CREATE TABLE items (id INT)', 'DROP TABLE items'),
+            '002-create-tags': ('CREATE TABLE tags (id INT)', 'DROP TABLE tags'),
+            '003-noop': ('SELECT 1', 'SELECT 1')
+        }
+
+        def write(migration, apply_sql):
+            with open(os.path.join(migrations_dir, migration + '.apply.sql'), 'w') as f:
+                f.write("{{% sql 'apply' %}}{0}{{% endsql %}}".format(apply_sql))
+
+        for migration, (apply_sql, revert_sql) in files.items():
+            write(migration, apply_sql)
+            with open(os.path.join(migrations_dir, migration + '.revert.sql'), 'w') as f:
+                f.write("{{% sql 'revert' %}}{0}{{% endsql %}}".format(revert_sql))
+
+        migrator = Migrator.from_path(self.db_uri, migrations_dir, 'items_app')
+        stop = threading.Event()
+
+        try:
+            self.db.query('DROP TABLE IF EXISTS tags')
+            self.db.commit()
+
+            self.assertEqual(self.runner.invoke(snaql_migration, args + ['apply', 'all']).exit_code, 0)
+
+            result = self.runner.invoke(snaql_migration, args + ['redo'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn('No applied migrations were changed.', result.output)
+
+            write('002-create-tags', 'CREATE TABLE tags (id INT, name VARCHAR(10))')
+
+            result = self.runner.invoke(snaql_migration, args + ['redo', 'items_app'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertNotIn('001-create-items', result.output)
+            self.assertLess(result.output.index('Reverting items_app/003-noop'),
+                            result.output.index('Reverting items_app/002-create-tags'))
+            self.assertLess(result.output.index('Applying 002-create-tags'), result.output.index('Applying 003-noop'))
+            self.assertEqual(self.db.query_all('SELECT name FROM tags'), [])
+
+            # watching
+            watcher = threading.Thread(target=migrator.watch, kwargs={'interval': 0.05, 'stop': stop})
+            watcher.start()
+
+            write('002-create-tags', 'CREATE TABLE tags (id INT, title VARCHAR(10))')
+            checksum = MigrationLoader(migrations_dir).checksum('002-create-tags')
+            for _ in range(100):
+                checksums = self.db.load_checksums('items_app')
+                if len(checksums) == 3 and checksums[('items_app', '002-create-tags')] == checksum:
+                    break
+                stop.wait(0.05)
+
+            stop.set()
+            watcher.join()
+            self.assertEqual(self.db.query_all('SELECT title FROM tags'), [])
+
+            # migrations applied by previous versions have no checksums
+            self.db.query('UPDATE snaql_migrations SET checksum = NULL')
+            self.db.commit()
+            write('001-create-items', 'CREATE TABLE items (id BIGINT)')
+            self.assertEqual(migrator.changed(), [])
+        finally:
+            stop.set()
+            migrator.close()
+            shutil.rmtree(migrations_dir)
+
+            self.db.query('DROP TABLE IF EXISTS tags')
+            self.db.commit()
+
+    def test_preflight(self):
+        migrations_dir = tempfile.mkdtemp()
+        args = ['--db-uri', self.db_uri, '--migrations', migrations_dir, '--app', 'items_app']
+        files = {
+            '001-items': [('add_flag', 'ALTER TABLE items ADD COLUMN flag INT DEFAULT 0'),
+                          ('backfill', "UPDATE items SET title = 'x'"),
+                          ('fix_one', "UPDATE items SET title = 'y' WHERE id = 5"),
+                          ('index', 'CREATE INDEX idx1 ON items (title)')],
+            '002-tags': [('create', 'CREATE TABLE tags (id INT)'),
+                         ('fill', 'UPDATE tags SET id = 1')]
+        }
+
+        for migration, blocks in files.items():
+            with open(os.path.join(migrations_dir, migration + '.apply.sql'), 'w') as f:
+                for block_name, sql in blocks:
+                    f.write("{{% sql '{0}' %}}{1}{{% endsql %}}\n".format(block_name, sql))
+            with open(os.path.join(migrations_dir, migration + '.revert.sql'), 'w') as f:
+                f.write("{% sql 'revert' %}SELECT 1{% endsql %}")
+
+        try:
+            self.db.query('DROP TABLE IF EXISTS tags')
+            self.db.query('CREATE TABLE items (id INTEGER PRIMARY KEY, title VARCHAR(10))')
+            self.db.query('INSERT INTO items (id, title) ' + (
+                'SELECT i, NULL FROM generate_series(1, 1000) i' if self.db.scheme == 'postgres' else
+                'WITH RECURSIVE s(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM s WHERE i < 1000) SELECT i, NULL FROM s'))
+            self.db.query('ANALYZE items')
+            self.db.commit()
+
+            migrator = Migrator.from_path(self.db_uri, migrations_dir, 'items_app')
+            try:
+                blocks = dict((block['block'], block) for block in migrator.preflight())
+            finally:
+                migrator.close()
+
+            self.assertEqual(dict((name, block['kind']) for name, block in blocks.items()), {
+                'add_flag': 'rewrite' if self.db.rewrites_added_columns() else 'metadata-only',
+                'backfill': 'full scan', 'fix_one': 'index scan', 'index': 'full scan',
+                'create': 'metadata-only', 'fill': 'full scan'
+            })
+            self.assertEqual(blocks['backfill']['rows'], 1000)
+            self.assertEqual(blocks['backfill']['table'], 'items')
+            self.assertGreater(blocks['backfill']['cost'], blocks['fix_one']['cost'])
+            if not self.db.rewrites_added_columns():  # PostgreSQL 11+ only stores the default
+                self.assertEqual(blocks['add_flag']['cost'], 0)
+            self.assertIn('EXPLAIN failed', blocks['fill']['note'])
+            self.assertIsNone(self.find_index('idx1'))  # nothing is executed
+
+            result = self.runner.invoke(snaql_migration, args + ['preflight'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn('items_app/001-items', result.output)
+            self.assertIn('Total estimated cost', result.output)
+
+            result = self.runner.invoke(snaql_migration, args + ['preflight', '--max-cost', '5'])
+            self.assertEqual(result.exit_code, 1)
+            self.assertIn('block(s) above the cost of 5', result.output)
+
+            self.assertEqual(self.runner.invoke(snaql_migration, args + ['apply', 'all']).exit_code, 0)
+            result = self.runner.invoke(snaql_migration, args + ['preflight', '--max-cost', '5'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn('Nothing to apply.', result.output)
+        finally:
+            shutil.rmtree(migrations_dir)
+
+            self.db.query('DROP TABLE IF EXISTS tags')
+            self.db.commit()
+
+    @postgres_only
+    def test_autocommit_concurrent_index(self):
+        migrations_dir = tempfile.mkdtemp()
+        args = ['--db-uri', self.db_uri, '--migrations', migrations_dir, '--app', 'items_app']
+
+        with open(os.path.join(migrations_dir, '001-create-items.apply.sql'), 'w') as f:
+            f.write("{% sql 'create_items' %}\n"
+                    "  CREATE TABLE items (id INT NOT NULL PRIMARY KEY, counter INT NOT NULL DEFAULT 0)\n"
+                    "{% endsql %}\n"
+                    "{% sql 'fill_items', depends_on=['create_items'] %}\n"
+                    "  WITH RECURSIVE ids(id) AS (SELECT 1 UNION ALL SELECT id + 1 FROM ids WHERE id < 100)\n"
+                    "  INSERT INTO items (id) SELECT id FROM ids\n"
+                    "{% endsql %}")
+        with open(os.path.join(migrations_dir, '002-index-items.apply.sql'), 'w') as f:
+            f.write("{# snaql create_index: autocommit #}\n"
+                    "{% sql 'create_index' %}\n"
+                    "  CREATE UNIQUE INDEX CONCURRENTLY idx_counter ON items (counter)\n"
+                    "{% endsql %}")
+        for migration in ('001-create-items', '002-index-items'):
+            with open(os.path.join(migrations_dir, migration + '.revert.sql'), 'w') as f:
+                f.write("{% sql 'noop' %}\n  SELECT 1\n{% endsql %}")
+
+        invalid_indexes = ("SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                           "WHERE NOT i.indisvalid AND c.relname = 'idx_counter'")
+
+        try:
+            # duplicates break the concurrent build
+            result = self.runner.invoke(snaql_migration, args + ['apply', 'all'])
+            self.assertEqual(result.exit_code, 1)
+            self.assertIn('Dropped invalid index idx_counter', result.output)
+            self.assertEqual(self.db.query_all(invalid_indexes), [])
+            self.assertTrue(self.db.is_migration_applied('items_app', '001-create-items'))
+            self.assertFalse(self.db.is_migration_applied('items_app', '002-index-items'))
+
+            # leftovers of a killed run
+            self.db.set_autocommit(True)
+            with self.assertRaises(Exception):
+                self.db.query('CREATE UNIQUE INDEX CONCURRENTLY idx_counter ON items (counter)')
+            self.db.set_autocommit(False)
+            self.assertEqual(self.db.query_all(invalid_indexes), [('idx_counter',)])
+
+            self.db.query('UPDATE items SET counter = id')
+            self.db.commit()
+
+            result = self.runner.invoke(snaql_migration, args + ['apply', 'all'])
+            self.assertEqual(result.exit_code, 0)
+            self.assertIn('Warning: dropped invalid index idx_counter', result.output)
+            self.assertTrue(self.db.is_migration_applied('items_app', '002-index-items'))
+            self.assertEqual(self.db.query_one("SELECT i.indisvalid FROM pg_index i JOIN pg_class c "
+                                               "ON c.oid = i.indexrelid WHERE c.relname = 'idx_counter'"), (True,))
+
+            # could not be a part of a single transaction
+            result = self.runner.invoke(snaql_migration, args + ['revert', 'items_app/002-index-items'])
+            self.assertEqual(result.exit_code, 0)
+            result = self.runner.invoke(snaql_migration, args + ['apply', '--atomic', 'all'])
+            self.assertEqual(result.exit_code, 1)
+            self.assertIn('could not be executed in a single transaction', result.output)
+        finally:
+            shutil.rmtree(migrations_dir)
+
+    def test_migrator(self):
+        migrator = Migrator.from_file(self.config_valid)
+
+        try:
+            self.assertIn(('users_app', '001-create-users'), migrator.plan())
+
+            applied = migrator.apply('users_app/002-update-users')
+            self.assertEqual(applied, [('users_app', '001-create-users'), ('users_app', '002-update-users')])
+            self.assertEqual(migrator.plan('users_app/003-create-index'), [('users_app', '003-create-index')])
+
+            self.assertEqual(migrator.revert('users_app/002-update-users'), [('users_app', '002-update-users')])
+            self.assertFalse(self.db.is_migration_applied('users_app', '002-update-users'))
+            self.assertTrue(self.db.is_migration_applied('users_app', '001-create-users'))
+        finally:
+            migrator.close()
+
+    def test_schema_head(self):
+        result = self.runner.invoke(snaql_migration, ['--config', self.config_valid, 'apply', 'all'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIsNotNone(self.db.load_head())
+
+        result = self.runner.invoke(snaql_migration, ['--config', self.config_valid, 'apply', 'all'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('Database is up to date.', result.output)
+        self.assertNotIn('Migrating', result.output)
+
+        # reverting invalidates the head
+        result = self.runner.invoke(snaql_migration, ['--config', self.config_valid,
+                                                      'revert', 'users_app/003-create-index'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIsNone(self.db.load_head())
+
+        result = self.runner.invoke(snaql_migration, ['--config', self.config_valid, 'apply', 'all'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertNotIn('Database is up to date.', result.output)
+        self.assertTrue(self.db.is_migration_applied('users_app', '003-create-index'))
+
+    @postgres_only
+    def test_advisory_lock(self):
+        # other replica is migrating
+        self.db.query_one('SELECT pg_advisory_lock({0})'.format(LOCK_ID))
+        release = threading.Timer(0.3, self.db.query_one, ['SELECT pg_advisory_unlock({0})'.format(LOCK_ID)])
+        release.start()
+
+        try:
+            result = self.runner.invoke(snaql_migration, ['--config', self.config_valid, 'apply', 'all'])
+        finally:
+            release.join()
+
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('Waiting for other migrating process...', result.output)
+        self.assertTrue(self.db.is_migration_applied('users_app', '003-create-index'))
+        self.assertTrue(self.db.try_lock())  # released
+        self.db.unlock()
+
+
+class TestSqliteMigrations(TestMigrations):
+    """
+    Same tests (the ones SQL of which SQLite supports) over a temporary SQLite database
+    """
+
+    def database_uri(self):
+        self.database_dir = tempfile.mkdtemp()
+        return 'sqlite:///' + os.path.join(self.database_dir, 'test.db')
+
+    def tearDown(self):
+        super(TestSqliteMigrations, self).tearDown()
+        shutil.rmtree(self.database_dir)
+
+    def test_transactions_without_in_transaction(self):
+        class Connection(object):  # sqlite3 connection of Python 2
+            def __init__(self, db):
+                self.db = db
+
+            def __getattr__(self, name):
+                if name == 'in_transaction':
+                    raise AttributeError(name)
+                return getattr(self.db, name)
+
+        self.db.db.db = Connection(self.db.db.db)
+
+        self.db.query('CREATE TABLE items (id INT)')
+        self.db.rollback()
+        self.assertIsNone(self.find_table('items'))
+
+        self.db.query('CREATE TABLE items (id INT)')
+        self.db.commit()
+        self.db.rollback()  # nothing to roll back
+        self.assertIsNotNone(self.find_table('items'))
+
+    def test_in_memory(self):
+        args = ['--migrations', 'snaql_migration/tests/users/migrations', '--app', 'users_app']
+
+        result = self.runner.invoke(snaql_migration, ['--db-uri', 'sqlite://:memory:'] + args + ['apply', 'all'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('Applying 003-create-index', result.output)
+
+        args[1] = 'snaql_migration/tests/users/migrations_broken'
+        result = self.runner.invoke(snaql_migration, ['--db-uri', 'sqlite://:memory:'] + args + ['apply', 'all'])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('block "create_users" failed', result.output)
+
+    def test_shards(self):
+        with open(self.config_valid, 'w') as f:
+            f.writelines('db_uri: "sqlite:///{0}/shard_{{shard}}.db"\r\n'
+                         'shards: 3\r\n'
+                         'migrations:\r\n'
+                         '    users_app: "snaql_migration/tests/users/migrations"\r\n'
+                         '    countries_app: "snaql_migration/tests/countries/migrations"'.format(self.database_dir))
+
+        broken = DBWrapper('sqlite:///' + os.path.join(self.database_dir, 'shard_0.db'))
+        broken.query('CREATE TABLE roles (id INT)')  # 001-create-users fails on the first shard
+        broken.commit()
+        broken.close()
+
+        args = ['--config', self.config_valid]
+
+        # stopped on the first failure
+        result = self.runner.invoke(snaql_migration, args + ['apply', 'all', '--shard-jobs', '1'])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('[0]     FAILED.', result.output)
+        self.assertNotIn('[1] ', result.output)
+        self.assertIn('3 of 3 shard(s) failed or skipped', result.output)
+
+        # other shards are migrated
+        result = self.runner.invoke(snaql_migration, args + ['apply', 'all', '--keep-going'])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('1 of 3 shard(s) failed or skipped', result.output)
+
+        summary = [line.split() for line in result.output.splitlines()[-4:-1]]
+        self.assertEqual(summary[0][:2], ['0', 'FAILED'])
+        self.assertIn('table roles already exists', result.output.splitlines()[-4])
+        self.assertEqual([row[:3] for row in summary[1:]], [['1', 'OK', '4'], ['2', 'OK', '4']])
+
+        result = self.runner.invoke(snaql_migration, args + ['show'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual([line.split()[:4] for line in result.output.splitlines()[-3:]],
+                         [['0', 'OK', '1', '3'], ['1', 'OK', '4', '0'], ['2', 'OK', '4', '0']])
+
+        broken = DBWrapper('sqlite:///' + os.path.join(self.database_dir, 'shard_0.db'))
+        broken.query('DROP TABLE roles')
+        broken.commit()
+        broken.close()
+
+        result = self.runner.invoke(snaql_migration, args + ['apply', 'all'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertIn('[1] Database is up to date.', result.output)
+
+        result = self.runner.invoke(snaql_migration, args + ['revert', 'users_app/001-create-users'])
+        self.assertEqual(result.exit_code, 0)
+
+        result = self.runner.invoke(snaql_migration, args + ['show'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertEqual([line.split()[:4] for line in result.output.splitlines()[-3:]],
+                         [['0', 'OK', '1', '3'], ['1', 'OK', '1', '3'], ['2', 'OK', '1', '3']])
+
+        # commands using a single database
+        result = self.runner.invoke(snaql_migration, args + ['plan', 'all'])
+        self.assertEqual(result.exit_code, 1)
+        self.assertIn('db_uri is a list of 3 shards', result.output)
@@ -0,0 +1,47 @@
+import subprocess
+import sys
+import timeit
+
+try:
+    import unittest2 as unittest
+except ImportError:
+    import unittest
+
+# runs an offline command in the fresh interpreter, reporting heavy modules it has imported
+STARTUP_SCRIPT = '''
+import sys
+from snaql_migration.snaql_migration import snaql_migration
+
+try:
+    snaql_migration(['--migrations', 'snaql_migration/tests/users/migrations', '--app', 'users_app', 'list'])
+except SystemExit:
+    pass
+
+heavy = ('yaml', 'snaql', 'jinja2', 'psycopg2', 'pymysql')
+sys.stderr.write(','.join(m for m in heavy if m in sys.modules))
+'''
+
+
+class TestStartup(unittest.TestCase):
+    # generous limit, it only guards against gross regressions (like connecting or importing drivers on startup)
+    MAX_STARTUP_TIME = 1.0
+
+    def run_offline_command(self):
+        process = subprocess.Popen([sys.executable, '-c', STARTUP_SCRIPT],
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, stderr = process.communicate()
+        self.assertEqual(process.returncode, 0)
+
+        return stdout.decode('utf-8'), stderr.decode('utf-8')
+
+    def test_offline_command_imports(self):
+        stdout, heavy_modules = self.run_offline_command()
+
+        self.assertIn('001-create-users', stdout)
+        self.assertEqual(heavy_modules, '')
+
+    def test_startup_time(self):
+        best = min(timeit.repeat(self.run_offline_command, number=1, repeat=5))
+        sys.stdout.write('\noffline command startup: {0:.3f}s\n'.format(best))
+
+        self.assertLess(best, TestStartup.MAX_STARTUP_TIME)